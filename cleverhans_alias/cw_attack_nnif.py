@@ -141,10 +141,16 @@ class CWL2_NNIF(object):
         self.loss1 = reduce_sum(self.const * (loss1 + self.helpful_dist))  # here LID added loss1 + loss_lid
         self.loss = self.loss1 + self.loss2
 
+        # the instance of the current iteration, saved before the optimizer updates the modifier. The host fetches
+        # it only when a sample improves its best attack
+        self.iter_img = tf.Variable(np.zeros(shape), dtype=tf_dtype, trainable=False, name='iter_img')
+        save_iter_img = tf.assign(self.iter_img, self.newimg)
+
         # Setup the adam optimizer and keep track of variables we're creating
         start_vars = set(x.name for x in tf.global_variables())
         optimizer = tf.train.AdamOptimizer(self.LEARNING_RATE)
-        self.train = optimizer.minimize(self.loss, var_list=[modifier])
+        with tf.control_dependencies([save_iter_img]):
+            self.train = optimizer.minimize(self.loss, var_list=[modifier])
         end_vars = tf.global_variables()
         new_vars = [x for x in end_vars if x.name not in start_vars]
 
@@ -183,20 +189,18 @@ class CWL2_NNIF(object):
         Run the attack on a batch of instance and labels.
         """
 
-        def compare(x, y):
-            if not isinstance(x, (float, int, np.int64)):
-                x = np.copy(x)
-                if self.TARGETED:
-                    x[y] -= self.CONFIDENCE
-                else:
-                    x[y] += self.CONFIDENCE
-                x = np.argmax(x)
+        def succeeded(logits, labels):
+            """:return: whether every sample is adversarial, with the confidence margin ([batch_size])"""
+            logits = np.array(logits, copy=True)
             if self.TARGETED:
-                return x == y
+                logits[rows, labels] -= self.CONFIDENCE
+                return logits.argmax(axis=1) == labels
             else:
-                return x != y
+                logits[rows, labels] += self.CONFIDENCE
+                return logits.argmax(axis=1) != labels
 
         batch_size = self.batch_size
+        rows = np.arange(batch_size)
 
         oimgs = np.clip(imgs, self.clip_min, self.clip_max)
 
@@ -214,9 +218,9 @@ class CWL2_NNIF(object):
         upper_bound = np.ones(batch_size) * 1e10
 
         # placeholders for the best l2, score, and instance attack found so far
-        o_bestl2 = [1e10] * batch_size
-        o_bestln = [1e10] * batch_size
-        o_bestscore = [-1] * batch_size
+        o_bestl2 = np.full(batch_size, 1e10)
+        o_bestln = np.full(batch_size, 1e10)
+        o_bestscore = np.full(batch_size, -1, dtype=np.int64)
         o_bestattack = np.copy(oimgs)
 
         for outer_step in range(self.BINARY_SEARCH_STEPS):
@@ -226,10 +230,11 @@ class CWL2_NNIF(object):
             batchlab     = labs[:batch_size]
             batch_m_help = m_help[:batch_size]
             batch_m_harm = m_harm[:batch_size]
+            lab          = np.argmax(batchlab, axis=1)
 
-            bestl2 = [1e10] * batch_size
-            bestln = [1e10] * batch_size
-            bestscore = [-1] * batch_size
+            bestl2 = np.full(batch_size, 1e10)
+            bestln = np.full(batch_size, 1e10)
+            bestscore = np.full(batch_size, -1, dtype=np.int64)
             _logger.debug("  Binary search step %s of %s",
                           outer_step, self.BINARY_SEARCH_STEPS)
 
@@ -250,8 +255,8 @@ class CWL2_NNIF(object):
             prev = 1e6
             for iteration in range(self.MAX_ITERATIONS):
                 # perform the attack
-                _, l, l2s, l_nnif, scores, nimg = self.sess.run([
-                    self.train, self.loss, self.l2dist, self.helpful_dist, self.output, self.newimg
+                _, l, l2s, l_nnif, scores = self.sess.run([
+                    self.train, self.loss, self.l2dist, self.helpful_dist, self.output
                 ])
                 # LID added self.clean_logits:
                 # _, l, l2s, scores, nimg = self.sess.run([self.train, self.loss,
@@ -275,46 +280,36 @@ class CWL2_NNIF(object):
                     prev = l
 
                 # adjust the best result found so far
-                for e, (l2, ln, sc, ii) in enumerate(zip(l2s, l_nnif, scores, nimg)):
-                    lab = np.argmax(batchlab[e])
-                    if l2 < bestl2[e] and compare(sc, lab):
-                        bestl2[e] = l2
-                        bestln[e] = ln
-                        bestscore[e] = np.argmax(sc)
-                    if l2 < o_bestl2[e] and compare(sc, lab):
-                        o_bestl2[e] = l2
-                        o_bestln[e] = ln
-                        o_bestscore[e] = np.argmax(sc)
-                        o_bestattack[e] = ii
-
-            # adjust the constant as needed
-            for e in range(batch_size):
-                if compare(bestscore[e], np.argmax(batchlab[e])) and \
-                        bestscore[e] != -1:
-                    # success, divide const by two
-                    upper_bound[e] = min(upper_bound[e], CONST[e])
-                    if upper_bound[e] < 1e9:
-                        CONST[e] = (lower_bound[e] + upper_bound[e]) / 2
-                else:
-                    # failure, either multiply by 10 if no solution found yet
-                    #          or do binary search with the known upper bound
-                    lower_bound[e] = max(lower_bound[e], CONST[e])
-                    if upper_bound[e] < 1e9:
-                        CONST[e] = (lower_bound[e] + upper_bound[e]) / 2
-                    else:
-                        CONST[e] *= 10
+                success = succeeded(scores, lab)
+                improved = success & (l2s < bestl2)
+                bestl2[improved] = l2s[improved]
+                bestln[improved] = l_nnif[improved]
+                bestscore[improved] = scores[improved].argmax(axis=1)
+
+                o_improved = success & (l2s < o_bestl2)
+                if o_improved.any():
+                    o_bestl2[o_improved] = l2s[o_improved]
+                    o_bestln[o_improved] = l_nnif[o_improved]
+                    o_bestscore[o_improved] = scores[o_improved].argmax(axis=1)
+                    o_bestattack[o_improved] = self.sess.run(self.iter_img)[o_improved]
+
+            # adjust the constant as needed. A sample succeeded if any iteration found an adversarial instance
+            success = bestscore != -1
+            # success, divide const by two
+            upper_bound[success] = np.minimum(upper_bound[success], CONST[success])
+            # failure, either multiply by 10 if no solution found yet
+            #          or do binary search with the known upper bound
+            lower_bound[~success] = np.maximum(lower_bound[~success], CONST[~success])
+            CONST = np.where(upper_bound < 1e9, (lower_bound + upper_bound) / 2,
+                             np.where(success, CONST, CONST * 10))
             _logger.debug("  Successfully generated adversarial examples " +
                           "on {} of {} instances.".format(
                               sum(upper_bound < 1e9), batch_size))
-            o_bestl2 = np.array(o_bestl2)
-            o_bestln = np.array(o_bestln)
             l2_mean = np.mean(np.sqrt(o_bestl2[o_bestl2 < 1e9]))
             ln_mean = np.mean(np.sqrt(o_bestln[o_bestln < 1e9]))
             _logger.debug("   Mean successful l2 distortion: {:.4g}, l_nnif distortion: {:.4g}".format(l2_mean, ln_mean))
 
         # return the best solution found
-        o_bestl2 = np.array(o_bestl2)
-        o_bestln = np.array(o_bestln)
         return o_bestattack
 
 
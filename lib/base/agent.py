@@ -30,9 +30,7 @@ class Agent(AgentBase):
         """
         Building all trainer agents: train/validation/test sessions, file writers, retentions, hooks, etc.
         """
-        self.model.build_graph()
-        # self.print_model_info()
-        self.dataset.build()
+        self.build_model_and_dataset()
 
         self.saver = tf.train.Saver(max_to_keep=1, name=str(self), filename='model_ref')
 
@@ -57,6 +55,12 @@ class Agent(AgentBase):
 
         self.log.info('Done building agent {}'.format(str(self)))
 
+    def build_model_and_dataset(self):
+        """Building the model graph and the dataset operations"""
+        self.model.build_graph()
+        # self.print_model_info()
+        self.dataset.build()
+
     def build_retentions(self):
         # Retention for train/validation stats
         pass
@@ -0,0 +1,259 @@
+'''Influence functions for a batch of test points at once, on top of darkon.Influence'''
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import json
+import hashlib
+import logging
+import numpy as np
+import tensorflow as tf
+import darkon.darkon as darkon
+
+logger = logging.getLogger(__name__)
+
+
+class BatchedInfluence(darkon.Influence):
+    """
+    darkon.Influence which handles many test points together:
+    1) The LiSSA recursion of all the test points shares every train minibatch: one sess.run per recursion step
+       evaluates the forward pass and the first backward pass once, and the Hessian-vector products of all the
+       estimates on top of it.
+    2) The train-gradient sweep runs once per batch of test points: every training sample gradient is multiplied
+       with the [num_params, batch] matrix of the stacked inverse-HVPs.
+    The inverse-HVP of every test point is cached in the workspace under the same file name that darkon uses
+    for test_indices=[index], so artifacts of single point _prepare runs are reused and vice versa.
+    Optionally (grad_cache_dir), the per-sample training gradients, which do not depend on the test points, are
+    computed once per checkpoint into a memory-mapped [num_train, dim] matrix, and the scores become a streaming
+    matrix-vector product against it. dim is the number of parameters, or grad_projection_dim for a count-sketch
+    random projection, which preserves the inner products in expectation.
+    """
+
+    def __init__(self, workspace, feeder, loss_op_train, loss_op_test, x_placeholder, y_placeholder,
+                 max_test_batch=8, grad_cache_dir=None, grad_projection_dim=None, grad_projection_seed=0,
+                 **kwargs):
+        """
+        :param max_test_batch: maximal number of test points to solve the inverse-HVPs for together
+        :param grad_cache_dir: dir of the per-sample training gradients cache. None disables the cache.
+                               Can be shared by inspectors with the same training set and loss_op_train
+        :param grad_projection_dim: dimension of the cached (projected) gradients. None for no projection
+        :param grad_projection_seed: seed of the random projection
+        Other parameters are as in darkon.Influence
+        """
+        super(BatchedInfluence, self).__init__(workspace, feeder, loss_op_train, loss_op_test,
+                                               x_placeholder, y_placeholder, **kwargs)
+        self.max_test_batch       = max_test_batch
+        self.grad_cache_dir       = grad_cache_dir
+        self.grad_projection_dim  = grad_projection_dim
+        self.grad_projection_seed = grad_projection_seed
+
+        self._sketch_buckets = None  # parameter index -> projected coordinate
+        self._sketch_signs   = None  # parameter index -> +1/-1
+
+        with tf.name_scope('batched_ihvp'):
+            grads = tf.gradients(loss_op_train, self.trainable_variables)
+            self.v_cur_estimated_batch = []
+            self.hessian_vector_batch_op = []
+            for _ in range(self.max_test_batch):
+                v_cur = [tf.placeholder(tf.float32, shape=a.get_shape()) for a in self.trainable_variables]
+                elemwise_products = [tf.reduce_sum(g * tf.stop_gradient(v)) for g, v in zip(grads, v_cur)]
+                self.v_cur_estimated_batch.append(v_cur)
+                self.hessian_vector_batch_op.append(tf.gradients(tf.add_n(elemwise_products), self.trainable_variables))
+
+        with tf.name_scope('batched_grad_diff'):
+            # the stacked inverse-HVPs ([num_params, batch]) are assigned once per test batch rather than fed to every
+            # per-sample run. A local variable, so savers of the model checkpoint do not see it
+            self.v_ihvp_batch_feed = tf.placeholder(tf.float64, shape=[None, None])
+            self.v_ihvp_batch = tf.Variable(tf.zeros([0, 0], dtype=tf.float64), trainable=False, validate_shape=False,
+                                            collections=[tf.GraphKeys.LOCAL_VARIABLES], name='v_ihvp_batch')
+            self.assign_ihvp_batch_op = tf.assign(self.v_ihvp_batch, self.v_ihvp_batch_feed, validate_shape=False)
+            flatten_grads = tf.concat([tf.reshape(a, (-1,)) for a in self.grad_op_train], 0)
+            flatten_grads = tf.cast(tf.reshape(flatten_grads, shape=(1, -1)), tf.float64)
+            flatten_grads /= self.v_param_total_trainset
+            self.grad_diff_batch_op = tf.matmul(flatten_grads, self.v_ihvp_batch)[0]
+            self.flat_grad_train_op = tf.concat([tf.reshape(a, (-1,)) for a in self.grad_op_train], 0)
+
+    def _variables_sha(self, sess):
+        sha = hashlib.sha1()
+        for a in sess.run(self.trainable_variables):
+            sha.update(a.data)
+        return sha
+
+    def _approx_filenames(self, sess, test_indices):
+        """Same as darkon's _approx_filename(sess, [index]) for every index, hashing the variables only once"""
+        sha = self._variables_sha(sess)
+        config_str = json.dumps(self.ihvp_config, sort_keys=True).encode('utf-8')
+
+        filenames = []
+        for index in test_indices:
+            index_sha = sha.copy()
+            index_sha.update(np.array([index]).data)
+            index_sha.update(config_str)
+            filenames.append('ihvp.' + index_sha.hexdigest() + '.npz')
+        return filenames
+
+    def _get_inverse_hvp_lissa_batch(self, sess, test_grad_losses):
+        """
+        LiSSA recursion for a list of test gradients (at most max_test_batch), sharing the train minibatches
+        :param test_grad_losses: list of test gradients (list of arrays per trainable variable)
+        :return: list of inverse-HVPs, matching test_grad_losses
+        """
+        cfg = self.ihvp_config
+        num_points  = len(test_grad_losses)
+        print_iter  = max(1, cfg['recursion_depth'] // 10)
+        inverse_hvp = [None] * num_points
+
+        for _ in range(cfg['num_repeats']):
+            cur_estimates = [[np.asarray(a) for a in g] for g in test_grad_losses]
+            for j in range(cfg['recursion_depth']):
+                train_batch_data, train_batch_label = self.feeder.train_batch(cfg['recursion_batch_size'])
+                feed_dict = self._make_train_feed_dict(train_batch_data, train_batch_label)
+                for p in range(num_points):
+                    for placeholder, var in zip(self.v_cur_estimated_batch[p], cur_estimates[p]):
+                        feed_dict[placeholder] = var
+                hvps = sess.run(self.hessian_vector_batch_op[:num_points], feed_dict=feed_dict)
+                for p in range(num_points):
+                    cur_estimates[p] = [g + (1 - cfg['damping']) * c - h / cfg['scale']
+                                        for g, c, h in zip(test_grad_losses[p], cur_estimates[p], hvps[p])]
+
+                if (j % print_iter == 0) or (j == cfg['recursion_depth'] - 1):
+                    norms = [np.linalg.norm(np.concatenate([a.reshape(-1) for a in c])) for c in cur_estimates]
+                    logger.info('Recursion at depth {}: norms are {}'.format(j, norms))
+
+            for p in range(num_points):
+                estimate = np.array(cur_estimates[p]) / cfg['scale']
+                inverse_hvp[p] = estimate if inverse_hvp[p] is None else inverse_hvp[p] + estimate
+
+        return [ihvp / cfg['num_repeats'] for ihvp in inverse_hvp]
+
+    def prepare_batch(self, sess, test_indices, test_batch_size, approx_params, force_refresh=False):
+        """
+        Calculating (or loading from the workspace) the inverse-HVP of every test point
+        :return: list of flattened inverse-HVPs, matching test_indices
+        """
+        if approx_params is not None:
+            for param_key in approx_params.keys():
+                if param_key not in self.ihvp_config:
+                    raise RuntimeError('unknown ihvp config param is approx_params')
+            self.ihvp_config.update(approx_params)
+
+        paths = [self._path(f) for f in self._approx_filenames(sess, test_indices)]
+        inverse_hvps = [None] * len(test_indices)
+        missing = []
+        for i, path in enumerate(paths):
+            if os.path.exists(path) and not force_refresh:
+                inverse_hvps[i] = np.load(path, encoding='bytes')['inverse_hvp']
+                logger.info('Loaded inverse HVP from {}'.format(path))
+            else:
+                missing.append(i)
+
+        for b in range(0, len(missing), self.max_test_batch):
+            chunk = missing[b:b + self.max_test_batch]
+            test_grad_losses = [self._get_test_grad_loss(sess, [test_indices[i]], test_batch_size) for i in chunk]
+            self.feeder.reset()
+            for i, ihvp in zip(chunk, self._get_inverse_hvp_lissa_batch(sess, test_grad_losses)):
+                inverse_hvps[i] = ihvp
+                np.savez(paths[i], inverse_hvp=ihvp, encoding='bytes')
+                logger.info('Saved inverse HVP to {}'.format(paths[i]))
+
+        return [np.concatenate([a.reshape(-1) for a in ihvp]) for ihvp in inverse_hvps]
+
+    def project(self, vec):
+        """
+        Count-sketch random projection of a flattened parameters vector. Identity if grad_projection_dim is None
+        :param vec: np.ndarray ([num_params])
+        :return: np.ndarray ([grad_projection_dim])
+        """
+        if self.grad_projection_dim is None:
+            return vec
+        if self._sketch_buckets is None:
+            rand_gen = np.random.RandomState(self.grad_projection_seed)
+            self._sketch_buckets = rand_gen.randint(0, self.grad_projection_dim, size=vec.shape[0])
+            self._sketch_signs   = rand_gen.choice([-1.0, 1.0], size=vec.shape[0])
+        return np.bincount(self._sketch_buckets, weights=self._sketch_signs * vec, minlength=self.grad_projection_dim)
+
+    def get_train_gradient_cache(self, sess, train_batch_size, train_iterations):
+        """
+        Loading the per-sample training gradients cache of the current variables, computing it on the first call
+        :return: np.memmap of (projected) gradients ([train_iterations * train_batch_size, dim])
+        """
+        sha = self._variables_sha(sess)
+        sha.update(json.dumps({'train_batch_size': train_batch_size, 'train_iterations': train_iterations,
+                               'projection_dim': self.grad_projection_dim,
+                               'projection_seed': self.grad_projection_seed}, sort_keys=True).encode('utf-8'))
+        path = os.path.join(self.grad_cache_dir, 'train_grads.' + sha.hexdigest() + '.npy')
+        if os.path.exists(path):
+            logger.info('Loaded training gradients cache from {}'.format(path))
+            return np.load(path, mmap_mode='r')
+
+        if not os.path.exists(self.grad_cache_dir):
+            os.makedirs(self.grad_cache_dir)
+        num_total_train_example = train_iterations * train_batch_size
+        tmp_path = path + '.tmp.{}.npy'.format(os.getpid())
+        cache = None
+
+        logger.info('Calculating training gradients cache for {} samples into {}'.format(num_total_train_example, path))
+        self.feeder.reset()
+        counter = 0
+        for it in range(train_iterations):
+            train_batch_data, train_batch_label = self.feeder.train_batch(train_batch_size)
+            for single_data, single_label in zip(train_batch_data, train_batch_label):
+                feed_dict = self._make_train_feed_dict([single_data], [single_label])
+                grad = self.project(sess.run(self.flat_grad_train_op, feed_dict=feed_dict))
+                if cache is None:
+                    cache = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float32,
+                                                      shape=(num_total_train_example, grad.shape[0]))
+                cache[counter] = grad
+                counter += 1
+            if (it % 100) == 0:
+                logger.info('iter: {}/{}'.format(it, train_iterations))
+
+        cache.flush()
+        del cache
+        os.rename(tmp_path, path)
+        return np.load(path, mmap_mode='r')
+
+    def _grad_diffs_cached(self, sess, ihvp_mat, train_batch_size, train_iterations, chunk_size=1024):
+        """Streaming (projected) gradients cache x inverse-HVPs matrix product"""
+        cache = self.get_train_gradient_cache(sess, train_batch_size, train_iterations)
+        num_total_train_example = train_iterations * train_batch_size
+        ihvp_proj = np.stack([self.project(ihvp_mat[:, p]) for p in range(ihvp_mat.shape[1])], axis=1)
+
+        scores = np.zeros([ihvp_mat.shape[1], num_total_train_example])
+        for b in range(0, num_total_train_example, chunk_size):
+            e = min(b + chunk_size, num_total_train_example)
+            scores[:, b:e] = np.dot(np.asarray(cache[b:e], dtype=np.float64), ihvp_proj).T
+        scores /= num_total_train_example
+        return scores
+
+    def upweighting_influence_multi(self, sess, test_indices, test_batch_size, approx_params,
+                                    train_batch_size, train_iterations, force_refresh=False):
+        """
+        Same as upweighting_influence_batch (without subsampling), for every test point in test_indices.
+        The training set is swept once for all the test points.
+        :return: np.ndarray of scores with shape [len(test_indices), train_iterations * train_batch_size]
+        """
+        inverse_hvps = self.prepare_batch(sess, test_indices, test_batch_size, approx_params, force_refresh)
+        ihvp_mat = np.stack(inverse_hvps, axis=1)  # [num_params, len(test_indices)]
+
+        if self.grad_cache_dir is not None:
+            return self._grad_diffs_cached(sess, ihvp_mat, train_batch_size, train_iterations)
+
+        num_total_train_example = train_iterations * train_batch_size
+        scores = np.zeros([len(test_indices), num_total_train_example])
+
+        sess.run(self.assign_ihvp_batch_op, feed_dict={self.v_ihvp_batch_feed: ihvp_mat})
+        self.feeder.reset()
+        counter = 0
+        for it in range(train_iterations):
+            train_batch_data, train_batch_label = self.feeder.train_batch(train_batch_size)
+            for single_data, single_label in zip(train_batch_data, train_batch_label):
+                feed_dict = self._make_train_feed_dict([single_data], [single_label])
+                feed_dict[self.v_param_total_trainset] = num_total_train_example
+                scores[:, counter] = sess.run(self.grad_diff_batch_op, feed_dict=feed_dict)
+                counter += 1
+            if (it % 100) == 0:
+                logger.info('iter: {}/{}'.format(it, train_iterations))
+
+        return scores
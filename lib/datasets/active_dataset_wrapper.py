@@ -3,6 +3,8 @@ from __future__ import print_function
 from __future__ import absolute_import
 
 import os
+import numpy as np
+import tensorflow as tf
 from tensorflow_TB.lib.datasets.dataset_wrapper import DatasetWrapper
 from tensorflow_TB.utils.enums import Mode
 
@@ -25,6 +27,13 @@ class ActiveDatasetWrapper(DatasetWrapper):
         self.train_pool_eval_handle     = None
         self.train_unpool_eval_handle   = None
 
+        # the pool datasets are driven by these index variables, so the pool is updated without rebuilding the graph
+        self.train_pool_indices_var     = None
+        self.train_unpool_indices_var   = None
+        self.train_pool_indices_ph      = None
+        self.train_unpool_indices_ph    = None
+        self.assign_pool_indices_op     = None
+
     def set_data_info(self):
         """
         There is no ref to load data info from. Therefore we need to construct a dataset with pool size of init_size
@@ -35,64 +44,65 @@ class ActiveDatasetWrapper(DatasetWrapper):
         # from all the train samples, chose only init_size samples
         train_indices = self.get_all_train_indices()
         train_pool_indices = self.rand_gen.choice(train_indices, self.init_size, replace=False)
-        train_pool_indices = train_pool_indices.tolist()
-        train_pool_indices.sort()
-        for sample in self.train_validation_info:
-            if sample['index'] in train_pool_indices:
-                sample['in_pool'] = True
-
-    def get_all_train_indices(self):
-        """
-        :return: all train indices, regardless of 'in_pool' values
-        """
-        indices = []
-        for sample in self.train_validation_info:
-            if sample['dataset'] == 'train':
-                indices.append(sample['index'])
-        indices.sort()
-        return indices
+        self.train_validation_info.set_in_pool(train_pool_indices)
 
     def get_all_unpool_train_indices(self):
         """
-        :return: all unpooled train indices, with 'in_pool'=False
+        :return: all unpooled train indices (sorted np.ndarray), with 'in_pool'=False
         """
-        indices = []
-        for sample in self.train_validation_info:
-            if sample['dataset'] == 'train' and not sample['in_pool']:
-                indices.append(sample['index'])
-        indices.sort()
-        return indices
+        return self.train_validation_info.indices('train', in_pool=False)
 
     def get_all_pool_train_indices(self):
         """
-        :return: all pooled train indices, with 'in_pool'=True
+        :return: all pooled train indices (sorted np.ndarray), with 'in_pool'=True
         """
-        indices = []
-        for sample in self.train_validation_info:
-            if sample['dataset'] == 'train' and sample['in_pool']:
-                indices.append(sample['index'])
-        indices.sort()
-        return indices
+        return self.train_validation_info.indices('train', in_pool=True)
 
     def set_datasets(self, X_train, y_train, X_test, y_test):
         super(ActiveDatasetWrapper, self).set_datasets(X_train, y_train, X_test, y_test)
 
+        with tf.name_scope('pool_indices'):
+            self.train_pool_indices_var   = self.indices_variable('train_pool_indices'  , self.get_all_pool_train_indices())
+            self.train_unpool_indices_var = self.indices_variable('train_unpool_indices', self.get_all_unpool_train_indices())
+            self.train_pool_indices_ph    = tf.placeholder(tf.int32, shape=[None], name='train_pool_indices_ph')
+            self.train_unpool_indices_ph  = tf.placeholder(tf.int32, shape=[None], name='train_unpool_indices_ph')
+            self.assign_pool_indices_op   = tf.group(
+                tf.assign(self.train_pool_indices_var  , self.train_pool_indices_ph  , validate_shape=False),
+                tf.assign(self.train_unpool_indices_var, self.train_unpool_indices_ph, validate_shape=False))
+            train_images = tf.constant(X_train, name='train_images')
+            train_labels = tf.constant(y_train, name='train_labels')
+
         # train_pool_set
-        train_pool_indices             = self.get_all_pool_train_indices()
-        train_pool_images              = X_train[train_pool_indices]
-        train_pool_labels              = y_train[train_pool_indices]
-        self.train_pool_dataset        = self.set_transform('train_pool'     , Mode.TRAIN, train_pool_indices, train_pool_images, train_pool_labels)
-        self.train_pool_eval_dataset   = self.set_transform('train_pool_eval', Mode.EVAL , train_pool_indices, train_pool_images, train_pool_labels)
+        self.train_pool_dataset        = self.set_transform('train_pool', Mode.TRAIN, None, None, None,
+                                                            dataset=self.indexed_dataset(self.train_pool_indices_var, train_images, train_labels))
+        self.train_pool_eval_dataset   = self.set_transform('train_pool_eval', Mode.EVAL, None, None, None,
+                                                            dataset=self.indexed_dataset(self.train_pool_indices_var, train_images, train_labels))
 
         # train_unpool_set
-        train_unpool_indices           = self.get_all_unpool_train_indices()
-        train_unpool_images            = X_train[train_unpool_indices]
-        train_unpool_labels            = y_train[train_unpool_indices]
-        self.train_unpool_eval_dataset = self.set_transform('train_unpool_eval', Mode.EVAL, train_unpool_indices, train_unpool_images, train_unpool_labels)
+        self.train_unpool_eval_dataset = self.set_transform('train_unpool_eval', Mode.EVAL, None, None, None,
+                                                            dataset=self.indexed_dataset(self.train_unpool_indices_var, train_images, train_labels))
+
+    @staticmethod
+    def indices_variable(name, indices):
+        """Local (not checkpointed, not reset by the model init_op) int32 variable of a varying size indices list"""
+        return tf.Variable(np.array(indices, dtype=np.int32), trainable=False, validate_shape=False,
+                           collections=[tf.GraphKeys.LOCAL_VARIABLES], name=name)
+
+    @staticmethod
+    def indexed_dataset(indices_var, images, labels):
+        """
+        Dataset of (index, image, label) for the indices stored in indices_var, read when the iterator is initialized
+        :param indices_var: variable of indices to images/labels
+        :param images: tensor of all the train(+validation) images
+        :param labels: tensor of all the train(+validation) labels
+        :return: tf.data.Dataset
+        """
+        dataset = tf.data.Dataset.from_tensor_slices(tf.reshape(indices_var, [-1]))
+        return dataset.map(lambda index: (index, tf.gather(images, index), tf.gather(labels, index)))
 
     def build_iterators(self):
         super(ActiveDatasetWrapper, self).build_iterators()
-        self.train_pool_iterator        = self.train_pool_dataset.make_one_shot_iterator()
+        self.train_pool_iterator        = self.train_pool_dataset.make_initializable_iterator()
         self.train_pool_eval_iterator   = self.train_pool_eval_dataset.make_initializable_iterator()
         self.train_unpool_eval_iterator = self.train_unpool_eval_dataset.make_initializable_iterator()
 
@@ -101,6 +111,7 @@ class ActiveDatasetWrapper(DatasetWrapper):
         self.train_pool_handle        = sess.run(self.train_pool_iterator.string_handle())
         self.train_pool_eval_handle   = sess.run(self.train_pool_eval_iterator.string_handle())
         self.train_unpool_eval_handle = sess.run(self.train_unpool_eval_iterator.string_handle())
+        sess.run(self.train_pool_iterator.initializer)
 
     def get_handle(self, name):
         if name == 'train_pool':
@@ -117,11 +128,12 @@ class ActiveDatasetWrapper(DatasetWrapper):
         self.log.info(' INIT_SIZE: {}'.format(self.init_size))
         self.log.info(' CAP: {}'.format(self.cap))
 
-    def update_pool(self, clusters=None, indices=None):
+    def update_pool(self, clusters=None, indices=None, sess=None):
         """
         updating the train_pool indices with #clusters of samples, or with specific indices
         :param clusters: integer, number of new samples to add to train_pool
         :param indices: list of indices to add to train_pool
+        :param sess: optional session. If given, the pool datasets on the graph are updated in place (refresh_pool)
         :return: None
         """
         if clusters is None:
@@ -138,16 +150,28 @@ class ActiveDatasetWrapper(DatasetWrapper):
                 indices.sort()
         self.update_pool_with_indices(indices)
         self.save_data_info()
+        if sess is not None:
+            self.refresh_pool(sess)
+
+    def refresh_pool(self, sess):
+        """Swapping the indices of the train_pool/train_unpool datasets to the current pool, without rebuilding the
+        graph, and restarting the train_pool iterator
+        :param sess: session
+        :return: None
+        """
+        sess.run(self.assign_pool_indices_op,
+                 feed_dict={self.train_pool_indices_ph  : self.get_all_pool_train_indices(),
+                            self.train_unpool_indices_ph: self.get_all_unpool_train_indices()})
+        sess.run(self.train_pool_iterator.initializer)
+        self.log.info('refreshed the train_pool datasets on the graph. pool size: {}'.format(self.pool_size))
 
     def update_pool_with_indices(self, indices):
         """Updating train_pool dataset with new indices
         :param indices: list of new indices(int)
         :return None
         """
-        self.assert_unique_indices(indices)  # time consuming.
-        for sample in self.train_validation_info:
-            if sample['index'] in indices:
-                sample['in_pool'] = True
+        self.assert_unique_indices(indices)
+        self.train_validation_info.set_in_pool(indices)
 
         self.log.info('updated train_pool length to {}'.format(self.pool_size))
         if self.pool_size > self.cap:
@@ -157,18 +181,18 @@ class ActiveDatasetWrapper(DatasetWrapper):
 
     @property
     def pool_size(self):
-        return len(self.get_all_pool_train_indices())
+        return self.train_validation_info.count('train', in_pool=True)
 
     @property
     def unpool_size(self):
-        return len(self.get_all_unpool_train_indices())
+        return self.train_validation_info.count('train', in_pool=False)
 
     def assert_unique_indices(self, indices):
         """Asserting that the new indices to add to train_pool are not already in train_pool
         :param indices: new indices to add to train_pool dataset
         :return: None
         """
-        if not set(self.get_all_pool_train_indices()).isdisjoint(indices):
+        if self.train_validation_info.is_in_pool(indices).any():
             err_str = 'assert_unique_indices: some index/indices are already in pool.\nindices={}'.format(indices)
             self.log.error(err_str)
             raise AssertionError(err_str)
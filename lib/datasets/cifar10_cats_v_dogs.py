@@ -5,7 +5,7 @@ from __future__ import absolute_import
 
 import numpy as np
 from tensorflow_TB.lib.datasets.dataset_wrapper import DatasetWrapper
-import tensorflow as tf
+from tensorflow_TB.lib.datasets.dataset_cache import load_raw_data
 
 
 class CIFAR10_CatsVDogs(DatasetWrapper):
@@ -22,8 +22,7 @@ class CIFAR10_CatsVDogs(DatasetWrapper):
         assert self.num_classes == 2
         assert self.randomize_subset is True  # not supporting uneven dataset
 
-        data = tf.keras.datasets.cifar10
-        (X_train, y_train), (X_test, y_test) = data.load_data()
+        (X_train, y_train), (X_test, y_test) = load_raw_data('cifar10')
         num_samples_per_class = int(self.train_set_size / self.num_classes)
 
         train_indices = []
@@ -0,0 +1,119 @@
+'''Local on-disk cache of decoded (and optionally preprocessed) dataset arrays, opened as memory-mapped .npy shards.
+All the processes on a host which open the same shard share its pages through the OS page cache.'''
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import os
+import json
+import hashlib
+import numpy as np
+import tensorflow as tf
+import tensorflow_TB.lib.logger.logger as logger
+from tensorflow_TB.utils.work_queue import file_lock
+
+# bump to invalidate all the existing shards if the way they are built changes
+CACHE_VERSION = 1
+CACHE_DIR = os.environ.get('TB_DATASET_CACHE_DIR',
+                           os.path.join(os.path.expanduser('~'), '.keras', 'datasets', 'tensorflow_TB_cache'))
+SVHN_PATH = '/data/dataset/SVHN_MINI'
+
+KERAS_DATASETS = {
+    'cifar10' : tf.keras.datasets.cifar10,
+    'cifar100': tf.keras.datasets.cifar100,
+    'mnist'   : tf.keras.datasets.mnist,
+}
+
+log = logger.get_logger('dataset_cache')
+
+
+def cache_key(*parts):
+    """
+    :param parts: values that determine the cached arrays: strings, numbers, None or numpy arrays (hashed by content)
+    :return: short hex digest
+    """
+    h = hashlib.sha1(str(CACHE_VERSION).encode('utf-8'))
+    for part in parts:
+        if isinstance(part, np.ndarray):
+            h.update(str((part.dtype.str, part.shape)).encode('utf-8'))
+            h.update(np.ascontiguousarray(part).tobytes())
+        else:
+            h.update(repr(part).encode('utf-8'))
+        h.update(b'|')
+    return h.hexdigest()[:16]
+
+
+def _write_shard(shard_dir, arrays):
+    if not os.path.exists(shard_dir):
+        os.makedirs(shard_dir)
+    for name, arr in arrays.items():
+        path = os.path.join(shard_dir, name + '.npy')
+        tmp_path = '{}.tmp.{}'.format(path, os.getpid())
+        with open(tmp_path, 'wb') as f:  # np.save appends .npy to file names
+            np.save(f, np.ascontiguousarray(arr))
+        os.rename(tmp_path, path)
+    # the index is written last: a shard without it is incomplete
+    index_path = os.path.join(shard_dir, 'index.json')
+    with open(index_path + '.tmp', 'w') as f:
+        json.dump(sorted(arrays.keys()), f)
+    os.rename(index_path + '.tmp', index_path)
+
+
+def cached_arrays(name, key, build_fn, cache_dir=None, mmap_mode='c'):
+    """
+    Loading the arrays of shard <cache_dir>/<name>.<key>, building and saving them on the first call.
+    Concurrent first calls on the same host build the shard only once.
+    :param name: shard name, e.g. 'cifar10.raw'
+    :param key: string that identifies the content, see cache_key()
+    :param build_fn: function with no arguments returning a {array_name: np.ndarray} dictionary
+    :param cache_dir: cache root directory. Default: CACHE_DIR ($TB_DATASET_CACHE_DIR)
+    :param mmap_mode: np.load mmap_mode. The default 'c' (copy-on-write) shares the pages between processes while
+                      keeping any in-place modification private to the process
+    :return: {array_name: np.ndarray (memory-mapped)}
+    """
+    shard_dir  = os.path.join(cache_dir or CACHE_DIR, '{}.{}'.format(name, key))
+    index_path = os.path.join(shard_dir, 'index.json')
+
+    def load():
+        with open(index_path) as f:
+            names = json.load(f)
+        return {k: np.load(os.path.join(shard_dir, k + '.npy'), mmap_mode=mmap_mode) for k in names}
+
+    if os.path.isfile(index_path):
+        return load()
+
+    arrays = None
+    try:
+        if not os.path.exists(os.path.dirname(shard_dir)):
+            os.makedirs(os.path.dirname(shard_dir))
+        with file_lock(shard_dir + '.lock'):
+            if not os.path.isfile(index_path):  # another process may have built it while we waited
+                log.info('building dataset cache shard {}'.format(shard_dir))
+                arrays = build_fn()
+                _write_shard(shard_dir, arrays)
+        return load()
+    except (IOError, OSError) as e:
+        log.warning('could not use the dataset cache in {} ({}). Using in-memory arrays'.format(shard_dir, e))
+        return arrays if arrays is not None else build_fn()
+
+
+def load_raw_data(dataset):
+    """
+    Cached equivalent of tf.keras.datasets.<dataset>.load_data() (and of the SVHN .npy files)
+    :param dataset: cifar10, cifar100, mnist or svhn
+    :return: (X_train, y_train), (X_test, y_test), exactly as decoded by the original loader, memory-mapped
+    """
+    if dataset in KERAS_DATASETS:
+        def build_fn():
+            (X_train, y_train), (X_test, y_test) = KERAS_DATASETS[dataset].load_data()
+            return {'X_train': X_train, 'y_train': y_train, 'X_test': X_test, 'y_test': y_test}
+    elif dataset == 'svhn':
+        def build_fn():
+            return {k: np.load(os.path.join(SVHN_PATH, k + '.npy')) for k in ['X_train', 'y_train', 'X_test', 'y_test']}
+    else:
+        err_str = 'dataset {} is not supported'.format(dataset)
+        log.error(err_str)
+        raise AssertionError(err_str)
+
+    arrays = cached_arrays(dataset + '.raw', cache_key(dataset), build_fn)
+    return (arrays['X_train'], arrays['y_train']), (arrays['X_test'], arrays['y_test'])
@@ -6,8 +6,9 @@ import numpy as np
 import os
 from tensorflow_TB.lib.base.agent_base import AgentBase
 import tensorflow_TB.lib.logger.logger as logger
-import csv
 import tensorflow as tf
+from tensorflow_TB.lib.datasets.dataset_cache import load_raw_data
+from tensorflow_TB.lib.datasets.split_info import SplitInfo
 from tensorflow_TB.utils.enums import Mode
 from tensorflow_TB.utils.misc import numericalSort, one_hot
 
@@ -38,7 +39,7 @@ class DatasetWrapper(AgentBase):
         self.eval_batch_size          = self.prm.train.train_control.EVAL_BATCH_SIZE
         self.rand_gen                 = np.random.RandomState(prm.SUPERSEED)
 
-        self.train_validation_info    = []
+        self.train_validation_info    = None  # SplitInfo
 
         self.train_dataset            = None
         self.train_eval_dataset       = None
@@ -75,7 +76,7 @@ class DatasetWrapper(AgentBase):
 
     def map_train_validation(self):
         """
-        Sets the dictionary that maps each sample in the train set to 'train' or 'validation'
+        Sets the split metadata that maps each sample in the train set to 'train' or 'validation'
         :return: None. Updates self.train_validation_info.
         """
         # optionally load train-validation mapping reference reference
@@ -87,43 +88,24 @@ class DatasetWrapper(AgentBase):
 
     def load_data_info(self):
         """Loading self.train_validation_info from ref"""
-        self.log.info('train_validation_map_ref was given. loading csv {}'.format(self.train_validation_map_ref))
-        with open(self.train_validation_map_ref) as csv_file:
-            self.train_validation_info = \
-                [{'index': int(row['index']), 'dataset': row['dataset'], 'in_pool': row['in_pool'] == 'True'}
-                 for row in csv.DictReader(csv_file, skipinitialspace=True)]
+        self.log.info('train_validation_map_ref was given. loading {}'.format(self.train_validation_map_ref))
+        self.train_validation_info = SplitInfo.load(self.train_validation_map_ref)
 
     def set_data_info(self):
-        """Updating self.train_validation_info dictionary is one is not loaded from ref"""
+        """Setting self.train_validation_info if it is not loaded from ref"""
         self.log.info('train_validation_map_ref is None. Creating new mapping')
 
         validation_indices = self.rand_gen.choice(range(self.train_validation_size), self.validation_set_size, replace=False)
-        validation_indices = validation_indices.tolist()
-        validation_indices.sort()
-
-        for ind in range(self.train_validation_size):
-            if ind in validation_indices:
-                self.train_validation_info.append({'index': ind,
-                                                   'dataset': 'validation',
-                                                   'in_pool': False})
-            else:
-                self.train_validation_info.append({'index': ind,
-                                                   'dataset': 'train',
-                                                   'in_pool': False})  # 'in_pool' is only used for active learning.
+        self.train_validation_info = SplitInfo.create(self.train_validation_size, validation_indices)
 
     def save_data_info(self, info_save_path=None):
-        """Saving self.train_validation_info into disk"""
+        """Saving self.train_validation_info into disk (.npz), with a csv export"""
         if info_save_path is None:
             info_save_path = os.path.join(self.prm.train.train_control.ROOT_DIR, 'train_validation_info.csv')
-        self.log.info('saving train-validation mapping csv file to {}'.format(info_save_path))
-        keys = self.train_validation_info[0].keys()
-        with open(info_save_path, 'wb') as csv_file:
-            dict_writer = csv.DictWriter(csv_file, keys)
-            dict_writer.writeheader()
-            dict_writer.writerows(self.train_validation_info)
+        self.log.info('saving train-validation mapping to {}'.format(info_save_path))
 
         # updating ref
-        self.train_validation_map_ref = info_save_path
+        self.train_validation_map_ref = self.train_validation_info.save(info_save_path)
 
     def get_raw_data(self, dataset_name):
         """This function get the string dataset_name (such as cifar10 or cifar100) and returns images and labels
@@ -134,17 +116,17 @@ class DatasetWrapper(AgentBase):
         """
 
         if 'cifar100' in dataset_name:
-            data = tf.keras.datasets.cifar100
+            data = 'cifar100'
         elif 'cifar10' in dataset_name:
-            data = tf.keras.datasets.cifar10
+            data = 'cifar10'
         elif 'mnist' in dataset_name:
-            data = tf.keras.datasets.mnist
+            data = 'mnist'
         else:
             err_str = 'dataset {} is not legal'.format(dataset_name)
             self.log.error(err_str)
             raise AssertionError(err_str)
 
-        (X_train, y_train), (X_test, y_test) = data.load_data()
+        (X_train, y_train), (X_test, y_test) = load_raw_data(data)
 
         if self.randomize_subset:
             num_samples_per_class = int(self.train_set_size / self.num_classes)
@@ -278,7 +260,7 @@ class DatasetWrapper(AgentBase):
         self.validation_handle = sess.run(self.validation_iterator.string_handle())
         self.test_handle       = sess.run(self.test_iterator.string_handle())
 
-    def set_transform(self, name, mode, indices, images, labels, batch_size=None):
+    def set_transform(self, name, mode, indices, images, labels, batch_size=None, dataset=None):
         """
         Adding some transformation on a dataset
         :param name: name of the dataset (string). Examples: 'train'/'validation'/'test/train_eval'
@@ -287,6 +269,7 @@ class DatasetWrapper(AgentBase):
         :param images: rgb data
         :param labels: labels
         :param batch_size: optional batch size
+        :param dataset: optional tf.data.Dataset of (index, image, label) to transform, instead of indices/images/labels
         :return: None.
         """
 
@@ -333,7 +316,8 @@ class DatasetWrapper(AgentBase):
 
         with tf.name_scope(name + '_data'):
             # feed all datasets with the same model placeholders:
-            dataset = tf.data.Dataset.from_tensor_slices((indices, images, labels))
+            if dataset is None:
+                dataset = tf.data.Dataset.from_tensor_slices((indices, images, labels))
             dataset = dataset.map(map_func=_cast, num_parallel_calls=batch_size)
 
             if mode == Mode.TRAIN:
@@ -402,25 +386,15 @@ class DatasetWrapper(AgentBase):
 
     def get_all_train_indices(self):
         """
-        :return: all train indices, regardless of 'in_pool' values
+        :return: all train indices (sorted np.ndarray), regardless of 'in_pool' values
         """
-        indices = []
-        for sample in self.train_validation_info:
-            if sample['dataset'] == 'train':
-                indices.append(sample['index'])
-        indices.sort()
-        return indices
+        return self.train_validation_info.indices('train')
 
     def get_all_validation_indices(self):
         """
-        :return: all train indices, regardless of 'in_pool' values
+        :return: all validation indices (sorted np.ndarray), regardless of 'in_pool' values
         """
-        indices = []
-        for sample in self.train_validation_info:
-            if sample['dataset'] == 'validation':
-                indices.append(sample['index'])
-        indices.sort()
-        return indices
+        return self.train_validation_info.indices('validation')
 
 # debug
 # import os
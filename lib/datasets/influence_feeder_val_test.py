@@ -8,11 +8,7 @@ import darkon.darkon as darkon
 from tensorflow_TB.utils.misc import one_hot
 from sklearn.model_selection import train_test_split
 from copy import copy, deepcopy
-import tensorflow as tf
-import scipy.io
-import os
-
-SVHN_PATH = '/data/dataset/SVHN_MINI'
+from tensorflow_TB.lib.datasets.dataset_cache import SVHN_PATH, cached_arrays, cache_key, load_raw_data
 
 class MyFeederValTest(darkon.InfluenceFeeder):
     def __init__(self, dataset, rand_gen, as_one_hot, val_inds=None, test_val_set=False, mini_train_inds=None):
@@ -21,101 +17,80 @@ class MyFeederValTest(darkon.InfluenceFeeder):
         self.test_val_set = test_val_set
         self.use_mini_train = mini_train_inds is not None
 
-        # load train data
         if dataset == 'cifar10':
-            (data, label), (_, _) = tf.keras.datasets.cifar10.load_data()
-            data = data.astype(np.float32)
             self.num_classes = 10
             self.num_val_set = 1000
         elif dataset == 'cifar100':
-            (data, label), (_, _) = tf.keras.datasets.cifar100.load_data()
-            data = data.astype(np.float32)
             self.num_classes = 100
             self.num_val_set = 1000
         elif dataset == 'svhn':
-            data  = np.load(os.path.join(SVHN_PATH, 'X_train.npy'))
-            label = np.load(os.path.join(SVHN_PATH, 'y_train.npy'))
-            data = data.astype(np.float32)
             self.num_classes = 10
             self.num_val_set = 1000
         else:
             raise AssertionError('dataset {} not supported'.format(dataset))
-        data /= 255.
-        label = np.squeeze(label, axis=1)
+        (X_train, y_train), (X_test, y_test) = load_raw_data(dataset)
+        label = np.squeeze(y_train, axis=1)
 
         if val_inds is None:
             # here we split the data set to train and validation
             print('Feeder {} did not get val indices, therefore splitting trainset'.format(str(self)))
-            indices = np.arange(data.shape[0])
+            indices = np.arange(label.shape[0])
             train_inds, val_inds = \
                 train_test_split(indices, test_size=self.num_val_set, random_state=rand_gen, shuffle=True, stratify=label)
         else:
             # val_inds were provided, so we need to infer all other indices
-            train_inds = []
-            # here we split the data set to train, validation, and test
-            for ind in range(data.shape[0]):
-                if ind not in val_inds:
-                    train_inds.append(ind)
-            train_inds = np.asarray(train_inds, dtype=np.int32)
+            train_inds = np.setdiff1d(np.arange(label.shape[0], dtype=np.int32), val_inds)
 
         train_inds.sort()
         val_inds.sort()
-        # # save entire train data just for corner usage
-        # self.complete_data = data
-        # if as_one_hot:
-        #     self.complete_label = one_hot(label.astype(np.int32), 10).astype(np.float32)
-        # else:
-        #     self.complete_label = label
+
+        def build_fn():
+            """float32 images in [0, 1] and (optionally one hot) labels of all the sets"""
+            def preprocess(data, label):
+                data = data.astype(np.float32)
+                data /= 255.
+                if as_one_hot:
+                    label = one_hot(label.astype(np.int32), self.num_classes).astype(np.float32)
+                return data, label
+
+            arrays = {}
+            arrays['train_data'], arrays['train_label'] = preprocess(X_train[train_inds], label[train_inds])
+            arrays['val_data']  , arrays['val_label']   = preprocess(X_train[val_inds], label[val_inds])
+            arrays['test_data'] , arrays['test_label']  = preprocess(X_test, np.squeeze(y_test, axis=1))
+            if mini_train_inds is not None:
+                arrays['mini_train_data'], arrays['mini_train_label'] = \
+                    preprocess(X_train[mini_train_inds], label[mini_train_inds])
+            return arrays
+
+        # the preprocessed sets are cached per split, so every feeder of the same split maps the same pages.
+        # origin_data and data share the same (read only in practice) arrays
+        arrays = cached_arrays('{}.feeder'.format(dataset),
+                               cache_key(dataset, 'float32/255', as_one_hot, train_inds, val_inds, mini_train_inds),
+                               build_fn)
 
         # train data
         self.train_inds        = train_inds
-        self.train_origin_data = data[train_inds]
-        self.train_data        = data[train_inds]
-        if as_one_hot:
-            self.train_label = one_hot(label[train_inds].astype(np.int32), self.num_classes).astype(np.float32)
-        else:
-            self.train_label = label[train_inds]
+        self.train_origin_data = arrays['train_data']
+        self.train_data        = arrays['train_data']
+        self.train_label       = arrays['train_label']
 
         if mini_train_inds is not None:
             self.mini_train_inds        = mini_train_inds
-            self.mini_train_origin_data = data[mini_train_inds]
-            self.mini_train_data        = data[mini_train_inds]
-            if as_one_hot:
-                self.mini_train_label = one_hot(label[mini_train_inds].astype(np.int32), self.num_classes).astype(np.float32)
-            else:
-                self.mini_train_label = label[mini_train_inds]
+            self.mini_train_origin_data = arrays['mini_train_data']
+            self.mini_train_data        = arrays['mini_train_data']
+            self.mini_train_label       = arrays['mini_train_label']
 
         # validation data
         self.val_inds          = val_inds
-        self.val_origin_data   = data[val_inds]
-        self.val_data          = data[val_inds]
-        if as_one_hot:
-            self.val_label = one_hot(label[val_inds].astype(np.int32), self.num_classes).astype(np.float32)
-        else:
-            self.val_label = label[val_inds]
-
-        if dataset == 'cifar10':
-            (_, _), (data, label) = tf.keras.datasets.cifar10.load_data()
-            data = data.astype(np.float32)
-        elif dataset == 'cifar100':
-            (_, _), (data, label) = tf.keras.datasets.cifar100.load_data()
-            data = data.astype(np.float32)
-        elif dataset == 'svhn':
-            data  = np.load(os.path.join(SVHN_PATH, 'X_test.npy'))
-            label = np.load(os.path.join(SVHN_PATH, 'y_test.npy'))
-            data = data.astype(np.float32)
-        else:
-            raise AssertionError('dataset {} not supported'.format(dataset))
-        data /= 255.
-        label = np.squeeze(label, axis=1)
-
-        self.test_inds        = np.arange(label.shape[0])
-        self.test_origin_data = data
-        self.test_data        = data
-        if as_one_hot:
-            self.test_label = one_hot(label.astype(np.int32), self.num_classes).astype(np.float32)
-        else:
-            self.test_label = label
+        self.val_origin_data   = arrays['val_data']
+        self.val_data          = arrays['val_data']
+        self.val_label         = arrays['val_label']
+
+        # test data
+        self.test_inds        = np.arange(y_test.shape[0])
+        self.test_origin_data = arrays['test_data']
+        self.test_data        = arrays['test_data']
+        self.test_label       = arrays['test_label']
 
         self.train_batch_offset = 0
 
@@ -4,7 +4,7 @@ from __future__ import absolute_import
 
 import numpy as np
 from tensorflow_TB.lib.datasets.dataset_wrapper import DatasetWrapper
-import tensorflow as tf
+from tensorflow_TB.lib.datasets.dataset_cache import load_raw_data
 
 
 class MNIST_1V7(DatasetWrapper):
@@ -21,8 +21,7 @@ class MNIST_1V7(DatasetWrapper):
         assert self.num_classes == 2
         assert self.randomize_subset is True  # not supporting uneven dataset
 
-        data = tf.keras.datasets.mnist
-        (X_train, y_train), (X_test, y_test) = data.load_data()
+        (X_train, y_train), (X_test, y_test) = load_raw_data('mnist')
         num_samples_per_class = int(self.train_set_size / self.num_classes)
 
         train_indices = []
@@ -85,33 +85,19 @@ class SemiSupervisedDatasetWrapper(DatasetWrapper):
         # from all the train samples, choose only pool_set_size samples
         train_indices = self.get_all_train_indices()
         train_pool_indices = self.rand_gen.choice(train_indices, self.pool_set_size, replace=False)
-        train_pool_indices = train_pool_indices.tolist()
-        train_pool_indices.sort()
-        for sample in self.train_validation_info:
-            if sample['index'] in train_pool_indices:
-                sample['in_pool'] = True
+        self.train_validation_info.set_in_pool(train_pool_indices)
 
     def get_all_unpool_train_indices(self):
         """
-        :return: all unpooled train indices, with 'in_pool'=False
+        :return: all unpooled train indices (sorted np.ndarray), with 'in_pool'=False
         """
-        indices = []
-        for sample in self.train_validation_info:
-            if sample['dataset'] == 'train' and not sample['in_pool']:
-                indices.append(sample['index'])
-        indices.sort()
-        return indices
+        return self.train_validation_info.indices('train', in_pool=False)
 
     def get_all_pool_train_indices(self):
         """
-        :return: all pooled train indices, with 'in_pool'=True
+        :return: all pooled train indices (sorted np.ndarray), with 'in_pool'=True
         """
-        indices = []
-        for sample in self.train_validation_info:
-            if sample['dataset'] == 'train' and sample['in_pool']:
-                indices.append(sample['index'])
-        indices.sort()
-        return indices
+        return self.train_validation_info.indices('train', in_pool=True)
 
     def set_datasets(self, X_train, y_train, X_test, y_test):
         super(SemiSupervisedDatasetWrapper, self).set_datasets(X_train, y_train, X_test, y_test)
@@ -196,16 +182,13 @@ class SemiSupervisedDatasetWrapper(DatasetWrapper):
             raise AssertionError(err_str)
 
         train_unpool_indices = self.get_all_unpool_train_indices()
-        soft_labels = np.zeros([self.unpool_batch_size, self.num_classes])
-        for i, j in enumerate(batch_unpool_indices):
-            soft_labels[i] = self.train_unpool_soft_labels[train_unpool_indices.index(j)]
-        return soft_labels
+        return self.train_unpool_soft_labels[np.searchsorted(train_unpool_indices, batch_unpool_indices)]
 
     @property
     def pool_size(self):
-        return len(self.get_all_pool_train_indices())
+        return self.train_validation_info.count('train', in_pool=True)
 
     @property
     def unpool_size(self):
-        return len(self.get_all_unpool_train_indices())
+        return self.train_validation_info.count('train', in_pool=False)
 
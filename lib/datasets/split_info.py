@@ -0,0 +1,119 @@
+'''Array-backed train/validation split metadata'''
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import os
+import csv
+import numpy as np
+
+SPLITS = ['train', 'validation']
+
+
+class SplitInfo(object):
+    """
+    Split metadata of the train+validation samples, as numpy arrays sorted by sample index:
+    index   - int64 sample index (row in the raw train data)
+    split   - int8 position in SPLITS ('train'/'validation')
+    in_pool - bool, used only for active/semi-supervised learning
+    Persisted in a binary .npz file. The legacy csv (index,dataset,in_pool) is written as an export and still loaded.
+    """
+
+    def __init__(self, index, split, in_pool):
+        order = np.argsort(index, kind='mergesort')
+        self.index   = np.asarray(index, dtype=np.int64)[order]
+        self.split   = np.asarray(split, dtype=np.int8)[order]
+        self.in_pool = np.asarray(in_pool, dtype=np.bool_)[order]
+        self._contiguous = self.index.size == 0 or \
+            (self.index[0] == 0 and self.index[-1] == self.index.size - 1)
+
+    def __len__(self):
+        return self.index.size
+
+    @classmethod
+    def create(cls, size, validation_indices):
+        """
+        :param size: number of train+validation samples
+        :param validation_indices: indices of the validation samples. All the rest are train samples
+        :return: SplitInfo with an empty pool
+        """
+        split = np.zeros(size, dtype=np.int8)
+        split[np.asarray(validation_indices, dtype=np.int64)] = SPLITS.index('validation')
+        return cls(np.arange(size), split, np.zeros(size, dtype=np.bool_))
+
+    def positions(self, indices):
+        """:return: positions of sample indices in the arrays"""
+        indices = np.asarray(indices, dtype=np.int64)
+        if self._contiguous:
+            return indices
+        return np.searchsorted(self.index, indices)
+
+    def mask(self, split=None, in_pool=None):
+        """:return: boolean mask of the samples in split (all splits if None) with in_pool (any if None)"""
+        mask = np.ones(self.index.size, dtype=np.bool_)
+        if split is not None:
+            mask &= self.split == SPLITS.index(split)
+        if in_pool is not None:
+            mask &= self.in_pool == in_pool
+        return mask
+
+    def indices(self, split=None, in_pool=None):
+        """:return: sorted sample indices of split (all splits if None) with in_pool (any if None)"""
+        return self.index[self.mask(split, in_pool)]
+
+    def count(self, split=None, in_pool=None):
+        return int(np.count_nonzero(self.mask(split, in_pool)))
+
+    def set_in_pool(self, indices, value=True):
+        self.in_pool[self.positions(indices)] = value
+
+    def is_in_pool(self, indices):
+        """:return: boolean array, whether every index is in the pool"""
+        return self.in_pool[self.positions(indices)]
+
+    @staticmethod
+    def paths(path):
+        """:return: the .npz path and the .csv export path of a save path (with or without an extension)"""
+        base, ext = os.path.splitext(path)
+        if ext not in ['.npz', '.csv']:
+            base, ext = path, ''
+        return base + '.npz', (path if ext == '' else base + '.csv')
+
+    def save(self, path, export_csv=True):
+        """
+        Saving to <path>.npz, and optionally exporting the legacy csv
+        :param path: save path, with or without an extension
+        :param export_csv: whether or not to write the csv export as well
+        :return: path of the .npz file
+        """
+        npz_path, csv_path = self.paths(path)
+        if export_csv:  # written first, so that load() finds the .npz not older than the csv
+            self.export_csv(csv_path)
+        with open(npz_path, 'wb') as f:  # np.savez appends .npz to file names
+            np.savez(f, index=self.index, split=self.split, in_pool=self.in_pool)
+        return npz_path
+
+    def export_csv(self, path):
+        split_names = np.array(SPLITS)[self.split]
+        in_pool = np.where(self.in_pool, 'True', 'False')
+        with open(path, 'w') as f:
+            f.write('index,dataset,in_pool\n')
+            f.writelines('{},{},{}\n'.format(*row) for row in zip(self.index, split_names, in_pool))
+
+    @classmethod
+    def load(cls, path):
+        """
+        Loading a .npz file, or a legacy csv. A csv is loaded from its .npz sibling if that is not older
+        :param path: path to a .npz or csv file
+        :return: SplitInfo
+        """
+        npz_path, _ = cls.paths(path)
+        if os.path.isfile(npz_path) and os.path.getmtime(npz_path) >= os.path.getmtime(path):
+            with np.load(npz_path) as data:
+                return cls(data['index'], data['split'], data['in_pool'])
+
+        with open(path) as csv_file:
+            rows = list(csv.DictReader(csv_file, skipinitialspace=True))
+        return cls(np.array([int(row['index']) for row in rows], dtype=np.int64),
+                   np.array([SPLITS.index(row['dataset']) for row in rows], dtype=np.int8),
+                   np.array([row['in_pool'] == 'True' for row in rows], dtype=np.bool_))
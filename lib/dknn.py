@@ -0,0 +1,110 @@
+'''Deep k-Nearest Neighbors (Papernot & McDaniel, 2018) conformal p-values, for many k values and layers at once'''
+from __future__ import division
+from __future__ import absolute_import
+from __future__ import print_function
+
+import numpy as np
+from tensorflow_TB.lib.knn import MultiKNeighborsClassifier
+import tensorflow_TB.lib.logger.logger as logger
+
+
+class DkNN(object):
+    """
+    The nonconformity of a sample x with label j is the number of its k nearest training neighbors which do not have
+    label j, summed over all the layers. The empirical p-value of (x, j) is the fraction of calibration samples whose
+    nonconformity (with their true label) is >= the nonconformity of (x, j).
+    The training neighbors are indexed once per layer and queried once for max(k). The calibration nonconformity is
+    sorted once, so the p-values of all the samples and classes are a single searchsorted call per k.
+    """
+
+    def __init__(self, name, k_list, n_jobs=None, batch_size=None):
+        """
+        :param name: name of the DkNN (for logging)
+        :param k_list: list of number of neighbors
+        :param n_jobs: number of parallel jobs for the neighbors search
+        :param batch_size: optional number of query samples to process at once, bounding the host memory
+        """
+        self.name       = name
+        self.log        = logger.get_logger(name)
+        self.k_list     = sorted(set(k_list))
+        self.n_jobs     = n_jobs
+        self.batch_size = batch_size
+
+        self.knn          = []    # MultiKNeighborsClassifier for every layer
+        self.num_classes  = None
+        self.calibration_ = None  # dictionary mapping every k to the sorted calibration nonconformity
+
+    def __str__(self):
+        return self.name
+
+    @staticmethod
+    def _as_layers(features):
+        """:return: list of per-layer features, for either a single layer array or a list of arrays"""
+        if isinstance(features, np.ndarray):
+            return [features]
+        return list(features)
+
+    def fit(self, train_features, train_labels):
+        """
+        :param train_features: training features ([n_train, n_features]), or a list of such arrays, one per layer
+        :param train_labels: training labels ([n_train]), encoded as 0..num_classes-1
+        :return: self
+        """
+        self.knn = []
+        for layer_index, layer_features in enumerate(self._as_layers(train_features)):
+            knn = MultiKNeighborsClassifier(name='{}_layer{}'.format(self.name, layer_index), k_list=self.k_list,
+                                            n_jobs=self.n_jobs, batch_size=self.batch_size)
+            self.knn.append(knn.fit(layer_features.reshape((layer_features.shape[0], -1)), train_labels))
+        self.num_classes = len(self.knn[0].classes_)
+        return self
+
+    def nonconformity(self, features):
+        """
+        :param features: query features, in the same layers layout as in fit()
+        :return: dictionary mapping every k to the nonconformity of every sample and class ([n_samples, n_classes])
+        """
+        layers = self._as_layers(features)
+        if len(layers) != len(self.knn):
+            err_str = 'got features of {} layers, but the DkNN was fitted on {} layers'.format(len(layers), len(self.knn))
+            self.log.error(err_str)
+            raise AssertionError(err_str)
+
+        nonconformity = {k: np.full((layers[0].shape[0], self.num_classes), k * len(layers), dtype=np.int32)
+                         for k in self.k_list}
+        for knn, layer_features in zip(self.knn, layers):
+            proba = knn.predict_proba(layer_features.reshape((layer_features.shape[0], -1)))
+            for k in self.k_list:
+                # how many neighbors vote for every label
+                nonconformity[k] -= np.rint(proba[k] * k).astype(np.int32)
+        return nonconformity
+
+    def calibrate(self, cal_features, cal_labels):
+        """
+        Calculating the calibration nonconformity: of every calibration sample with its true label
+        :param cal_features: calibration features, in the same layers layout as in fit()
+        :param cal_labels: calibration labels ([n_cal])
+        :return: dictionary mapping every k to the calibration vector ([n_cal]), sorted
+        """
+        nonconformity = self.nonconformity(cal_features)
+        rows = np.arange(len(cal_labels))
+        self.calibration_ = {k: np.sort(nonconformity[k][rows, cal_labels]) for k in self.k_list}
+        return self.calibration_
+
+    def p_values(self, features):
+        """
+        :param features: query features, in the same layers layout as in fit()
+        :return: dictionary mapping every k to the empirical p-values of every sample and class ([n_samples, n_classes])
+        """
+        if self.calibration_ is None:
+            err_str = 'calibrate() must be called before p_values()'
+            self.log.error(err_str)
+            raise AssertionError(err_str)
+
+        nonconformity = self.nonconformity(features)
+        empirical_p = {}
+        for k in self.k_list:
+            calibration_vec = self.calibration_[k]
+            # number of calibration values >= every nonconformity value
+            num_greater = len(calibration_vec) - np.searchsorted(calibration_vec, nonconformity[k], side='left')
+            empirical_p[k] = (num_greater / len(calibration_vec)).astype(np.float32)
+        return empirical_p
@@ -0,0 +1,161 @@
+'''Persistent, content-addressed store for network features (embeddings, labels, predictions) of testers'''
+from __future__ import division
+from __future__ import absolute_import
+from __future__ import print_function
+
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+from tensorflow_TB.lib.base.agent_base import AgentBase
+from tensorflow_TB.utils.work_queue import file_lock
+
+
+def file_digest(path, block_size=2 ** 20):
+    """
+    :param path: path to a file
+    :param block_size: read block size
+    :return: sha1 hex digest of the file content
+    """
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+class FeatureStore(AgentBase):
+    """
+    Stores arrays on disk under a key made of the checkpoint content, the layer name, the dataset split and the PCA
+    settings. Every entry is a directory of .npy files (plus meta.json) which is read back memory-mapped.
+    A matching entry is a cache hit and the forward pass that computed it is never repeated.
+    """
+
+    def __init__(self, name, store_dir, mmap_mode='c'):
+        """
+        :param name: name of the store
+        :param store_dir: root directory of the store
+        :param mmap_mode: np.load mmap_mode. 'c' (copy-on-write) lets the caller modify the loaded arrays in memory
+        """
+        super(FeatureStore, self).__init__(name)
+        self.store_dir = store_dir
+        self.mmap_mode = mmap_mode
+        self._checkpoint_digests = {}  # checkpoint path -> content digest
+
+        if not os.path.exists(self.store_dir):
+            os.makedirs(self.store_dir)
+
+    def print_stats(self):
+        self.log.info(str(self) + ' parameters:')
+        self.log.info(' STORE_DIR: {}'.format(self.store_dir))
+        self.log.info(' MMAP_MODE: {}'.format(self.mmap_mode))
+
+    def checkpoint_digest(self, checkpoint_path):
+        """
+        Digest of a checkpoint content. The .index file of a V2 checkpoint holds a checksum of every tensor,
+        so hashing it identifies the weights without reading the (large) data shards.
+        :param checkpoint_path: checkpoint prefix, e.g. /path/to/checkpoint/model.ckpt-50000
+        :return: hex digest
+        """
+        if checkpoint_path not in self._checkpoint_digests:
+            if os.path.isfile(checkpoint_path + '.index'):
+                digest = file_digest(checkpoint_path + '.index')
+            elif os.path.isfile(checkpoint_path):
+                digest = file_digest(checkpoint_path)
+            else:
+                err_str = 'checkpoint {} was not found'.format(checkpoint_path)
+                self.log.error(err_str)
+                raise AssertionError(err_str)
+            self._checkpoint_digests[checkpoint_path] = digest
+        return self._checkpoint_digests[checkpoint_path]
+
+    def get_key(self, checkpoint_path, layer_name, dataset_name, pca=None, **kwargs):
+        """
+        :param checkpoint_path: checkpoint prefix the features were computed with
+        :param layer_name: name of the layer in model.net
+        :param dataset_name: dataset split, e.g. 'train_eval', 'test'
+        :param pca: PCA settings (e.g. number of dims) applied on the features. None for raw features
+        :param kwargs: any other (json serializable) setting that the features depend on
+        :return: key (dictionary)
+        """
+        key = {'checkpoint': self.checkpoint_digest(checkpoint_path),
+               'layer': layer_name,
+               'dataset': dataset_name,
+               'pca': pca}
+        key.update(kwargs)
+        return key
+
+    def get_entry_dir(self, key):
+        key_str = json.dumps(key, sort_keys=True)
+        return os.path.join(self.store_dir, hashlib.sha1(key_str.encode('utf-8')).hexdigest())
+
+    def contains(self, key, names):
+        """Whether all the arrays in names are stored under key"""
+        entry_dir = self.get_entry_dir(key)
+        return all(os.path.isfile(os.path.join(entry_dir, name + '.npy')) for name in names)
+
+    def load(self, key, names):
+        """
+        :param key: entry key
+        :param names: list of array names
+        :return: tuple of (memory-mapped) arrays
+        """
+        entry_dir = self.get_entry_dir(key)
+        self.log.info('Loading {} from feature store entry {}'.format(names, entry_dir))
+        return tuple(np.load(os.path.join(entry_dir, name + '.npy'), mmap_mode=self.mmap_mode) for name in names)
+
+    def save(self, key, names, arrays):
+        """
+        Saving arrays under key. The entry is written to a temporary directory and renamed, so parallel testers
+        never read a partially written entry. Entries are content-addressed: an existing entry is never deleted or
+        overwritten, only the arrays it is missing are added to it.
+        :param key: entry key
+        :param names: list of array names
+        :param arrays: list of np.ndarray, matching names
+        :return: None
+        """
+        entry_dir = self.get_entry_dir(key)
+        tmp_dir   = entry_dir + '.tmp.{}'.format(os.getpid())
+        self.log.info('Saving {} to feature store entry {}'.format(names, entry_dir))
+        if os.path.exists(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        os.makedirs(tmp_dir)
+        for name, arr in zip(names, arrays):
+            np.save(os.path.join(tmp_dir, name + '.npy'), arr)
+
+        with file_lock(entry_dir + '.lock'):
+            if not os.path.exists(entry_dir):
+                with open(os.path.join(tmp_dir, 'meta.json'), 'w') as fp:
+                    json.dump({'key': key, 'names': list(names)}, fp, sort_keys=True, indent=2)
+                os.rename(tmp_dir, entry_dir)
+                return
+
+            # another tester stored this entry first. Keep its arrays and add only the missing ones
+            with open(os.path.join(entry_dir, 'meta.json'), 'r') as fp:
+                meta = json.load(fp)
+            for name in names:
+                if not os.path.isfile(os.path.join(entry_dir, name + '.npy')):
+                    os.rename(os.path.join(tmp_dir, name + '.npy'), os.path.join(entry_dir, name + '.npy'))
+                    meta['names'].append(name)
+            with open(os.path.join(tmp_dir, 'meta.json'), 'w') as fp:
+                json.dump(meta, fp, sort_keys=True, indent=2)
+            os.rename(os.path.join(tmp_dir, 'meta.json'), os.path.join(entry_dir, 'meta.json'))
+            shutil.rmtree(tmp_dir)
+
+    def fetch(self, key, names, compute_fn):
+        """
+        Getting arrays from the store, or computing and storing them on a cache miss
+        :param key: entry key
+        :param names: list of array names
+        :param compute_fn: function with no arguments returning the arrays (matching names)
+        :return: tuple of arrays
+        """
+        if self.contains(key, names):
+            self.log.info('Feature store hit for {}'.format(key))
+            return self.load(key, names)
+
+        self.log.info('Feature store miss for {}'.format(key))
+        arrays = compute_fn()
+        self.save(key, names, arrays)
+        return self.load(key, names)
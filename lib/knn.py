@@ -0,0 +1,156 @@
+'''k-NN classification engines that share a single sorted neighbors query between many k values'''
+from __future__ import division
+
+import numpy as np
+from sklearn.neighbors import NearestNeighbors
+import tensorflow_TB.lib.logger.logger as logger
+
+
+def get_weights(dist, weights):
+    """
+    Calculating the neighbors weights, exactly as sklearn's KNeighborsClassifier does
+    :param dist: sorted neighbors distances ([n_samples, n_neighbors])
+    :param weights: 'uniform' or 'distance'
+    :return: weights of the neighbors ([n_samples, n_neighbors])
+    """
+    if weights == 'uniform':
+        return np.ones(dist.shape, dtype=np.float64)
+
+    # weights == 'distance'. If a query has a zero distance neighbor, only its zero distance neighbors vote
+    with np.errstate(divide='ignore'):
+        w = 1.0 / dist
+    inf_mask = np.isinf(w)
+    inf_row  = np.any(inf_mask, axis=1)
+    w[inf_row] = inf_mask[inf_row]
+    return w
+
+
+def cumulative_class_proba(neigh_labels, neigh_weights, k_list, num_classes):
+    """
+    Calculating the k-NN probabilities for every k from the cumulative (weighted) class votes
+    :param neigh_labels: labels of the sorted neighbors ([n_samples, n_neighbors]), encoded as 0..num_classes-1
+    :param neigh_weights: weights of the sorted neighbors ([n_samples, n_neighbors])
+    :param k_list: sorted list of k values. max(k_list) <= n_neighbors
+    :param num_classes: number of classes
+    :return: probabilities, np.ndarray of shape [len(k_list), n_samples, num_classes]
+    """
+    cols = np.asarray(k_list, dtype=np.int64) - 1
+    votes = np.empty((len(k_list), neigh_labels.shape[0], num_classes), dtype=np.float64)
+    for cls in range(num_classes):
+        votes[:, :, cls] = np.cumsum(neigh_weights * (neigh_labels == cls), axis=1)[:, cols].T
+
+    normalizer = votes.sum(axis=2, keepdims=True)
+    normalizer[normalizer == 0.0] = 1.0
+    votes /= normalizer
+    return votes
+
+
+class MultiKNeighborsClassifier(object):
+    """
+    k-NN classifier for a list of k values.
+    Runs one brute force neighbors query for max(k) and derives predict_proba for every k from the cumulative
+    class votes of the sorted neighbors, instead of fitting and querying a KNeighborsClassifier per k.
+    """
+
+    def __init__(self, name, k_list, weights='uniform', p=2, n_jobs=None, batch_size=None):
+        """
+        :param name: name of the classifier (for logging)
+        :param k_list: list of number of neighbors
+        :param weights: 'uniform' or 'distance'
+        :param p: Minkowski norm. 1 for L1, 2 for L2
+        :param n_jobs: number of parallel jobs for the neighbors search
+        :param batch_size: optional number of query samples to process at once, bounding the host memory
+        """
+        self.name       = name
+        self.log        = logger.get_logger(name)
+        self.k_list     = sorted(set(k_list))
+        self.weights    = weights
+        self.p          = p
+        self.n_jobs     = n_jobs
+        self.batch_size = batch_size
+        self.max_k      = self.k_list[-1]
+
+        if self.weights not in ['uniform', 'distance']:
+            err_str = 'weights {} is not supported'.format(self.weights)
+            self.log.error(err_str)
+            raise AssertionError(err_str)
+
+        self.nn = NearestNeighbors(
+            n_neighbors=self.max_k,
+            p=self.p,
+            n_jobs=self.n_jobs,
+            algorithm='brute')
+
+        self.classes_ = None  # the unique labels seen in fit
+        self._X       = None  # a reference to the training features (not a copy), for predict_proba_fit_set_loo
+        self._y       = None  # the training labels, encoded as indices of classes_
+
+    def __str__(self):
+        return self.name
+
+    def fit(self, X, y):
+        """
+        :param X: training features ([n_samples, n_features]). A reference to X is kept until the next fit, so modifying
+                  X in place afterwards changes the predict_proba_fit_set_loo results
+        :param y: training labels ([n_samples])
+        :return: self
+        """
+        self.classes_, self._y = np.unique(y, return_inverse=True)
+        self._X = X
+        self.nn.fit(X)
+        return self
+
+    def kneighbors(self, X, n_neighbors=None):
+        """Sorted distances and indices of the nearest training neighbors of X"""
+        return self.nn.kneighbors(X, n_neighbors=n_neighbors)
+
+    def _fill_proba(self, proba, b, e, batch_proba):
+        """Copying the (float64) probabilities of a batch of samples [b, e) to the float32 per-k arrays"""
+        for i, k in enumerate(self.k_list):
+            proba[k][b:e] = batch_proba[i]
+
+    def predict_proba(self, X):
+        """
+        :param X: query features ([n_samples, n_features])
+        :return: dictionary mapping every k in k_list to its float32 probabilities ([n_samples, n_classes])
+        """
+        num_samples = X.shape[0]
+        batch_size  = self.batch_size or num_samples
+        num_classes = len(self.classes_)
+        proba = {k: np.empty((num_samples, num_classes), dtype=np.float32) for k in self.k_list}
+
+        self.log.info('Querying {} neighbors for {} samples, for {} different k values'
+                      .format(self.max_k, num_samples, len(self.k_list)))
+        for b in range(0, num_samples, batch_size):
+            e = min(b + batch_size, num_samples)
+            dist, ind = self.kneighbors(X[b:e])
+            self._fill_proba(proba, b, e, cumulative_class_proba(self._y[ind], get_weights(dist, self.weights),
+                                                                 self.k_list, num_classes))
+
+        return proba
+
+    def predict_proba_fit_set_loo(self):
+        """
+        Predicting the set passed to fit() (through the reference kept to it), excluding every sample from its own
+        neighbors (leave-one-out). Queries max(k)+1 neighbors and drops the self match. If the sample is not found in its own neighbors (due to
+        duplicates at zero distance) the farthest neighbor is dropped instead.
+        :return: dictionary mapping every k in k_list to the float32 train set probabilities ([n_samples, n_classes])
+        """
+        num_samples = self._X.shape[0]
+        batch_size  = self.batch_size or num_samples
+        num_classes = len(self.classes_)
+        proba = {k: np.empty((num_samples, num_classes), dtype=np.float32) for k in self.k_list}
+
+        self.log.info('Querying {} leave-one-out neighbors for {} training samples, for {} different k values'
+                      .format(self.max_k, num_samples, len(self.k_list)))
+        for b in range(0, num_samples, batch_size):
+            e = min(b + batch_size, num_samples)
+            dist, ind = self.kneighbors(self._X[b:e], n_neighbors=self.max_k + 1)
+            self_mask = ind == np.arange(b, e)[:, np.newaxis]
+            self_mask[~self_mask.any(axis=1), -1] = True
+            dist = dist[~self_mask].reshape(e - b, self.max_k)
+            ind  = ind[~self_mask].reshape(e - b, self.max_k)
+            self._fill_proba(proba, b, e, cumulative_class_proba(self._y[ind], get_weights(dist, self.weights),
+                                                                 self.k_list, num_classes))
+
+        return proba
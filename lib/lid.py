@@ -0,0 +1,53 @@
+'''Local Intrinsic Dimensionality (Ma et al., 2018) maximum likelihood estimation, for many k values and layers at once'''
+from __future__ import division
+from __future__ import absolute_import
+from __future__ import print_function
+
+import numpy as np
+from scipy.spatial.distance import cdist
+
+
+def mle_lid(ref, query, k_list):
+    """
+    Vectorized equivalent of mle_batch(ref, query, k) of lid_adversarial_subspace_detection.util, for every k at once:
+    LID(q) = -k / sum_{i=1..k} log(d_i(q) / d_k(q)), where d_1 <= ... <= d_k are the distances of q to its nearest
+    reference samples, skipping the nearest one (the sample itself when q is in ref).
+    The distances are exact float64 (cdist, as in mle_batch): LID is a log-ratio of the smallest distances, which the
+    float32 ||q||^2 + ||x||^2 - 2 q.x expansion loses to cancellation on high dimensional activations
+    :param ref: reference activations ([n_ref, n_features])
+    :param query: query activations ([n_query, n_features])
+    :param k_list: list of number of neighbors
+    :return: LIDs ([len(k_list), n_query])
+    """
+    k_list = [min(k, ref.shape[0] - 1) for k in k_list]
+    num_cols = max(k_list) + 1
+    dist = cdist(query, ref)
+    if num_cols < dist.shape[1]:
+        dist = np.partition(dist, num_cols - 1, axis=1)[:, :num_cols]
+    dist = np.sort(dist, axis=1)[:, 1:]
+
+    lids = np.empty((len(k_list), query.shape[0]), dtype=np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        log_dist = np.log(dist)
+        cum_log_dist = np.cumsum(log_dist, axis=1)
+        for i, k in enumerate(k_list):
+            lids[i] = -k / (cum_log_dist[:, k - 1] - k * log_dist[:, k - 1])
+    return lids
+
+
+def mle_lid_layers(layers_act, num_ref, k_list, pool=None):
+    """
+    Estimating the LIDs of a batch in every layer, with the first num_ref samples of the batch as the reference
+    :param layers_act: list of the activations of every layer ([n_batch, ...])
+    :param num_ref: number of reference (clean) samples at the beginning of the batch
+    :param k_list: list of number of neighbors
+    :param pool: optional multiprocessing.pool.ThreadPool to process the layers concurrently (cdist and the numpy
+                 kernels release the GIL)
+    :return: LIDs ([len(k_list), n_batch, num_layers])
+    """
+    def layer_lids(layer_index):
+        act = np.asarray(layers_act[layer_index], dtype=np.float32).reshape((layers_act[layer_index].shape[0], -1))
+        return mle_lid(act[:num_ref], act, k_list)
+
+    map_fn = map if pool is None else pool.map
+    return np.stack(list(map_fn(layer_lids, range(len(layers_act)))), axis=2)
@@ -0,0 +1,122 @@
+'''Linear probe classifier for embeddings: a primal linear SVM (or logistic regression) with a one-shot temperature
+calibration of its probabilities'''
+from __future__ import division
+from __future__ import absolute_import
+from __future__ import print_function
+
+import numpy as np
+from scipy.optimize import minimize_scalar
+from scipy.special import logsumexp
+from sklearn.svm import LinearSVC
+from sklearn.linear_model import LogisticRegression
+from sklearn.model_selection import train_test_split
+import tensorflow_TB.lib.logger.logger as logger
+
+
+def log_softmax(scores):
+    return scores - logsumexp(scores, axis=1, keepdims=True)
+
+
+class LinearProbeClassifier(object):
+    """
+    Replacing SVC(kernel='linear', probability=True), whose dual solver scales super-linearly with the number of samples
+    and whose Platt scaling fits 5 extra SVMs in an internal cross validation.
+    The linear model is trained in the primal (LinearSVC with the squared hinge loss, or LogisticRegression with
+    L-BFGS), so its cost is linear in the number of samples. The probabilities are softmax(decision_function / T),
+    where the temperature T minimizes the negative log likelihood of a held-out calibration split. The model is then
+    refitted on all the samples, keeping T.
+    """
+
+    def __init__(self, name, loss='hinge', tol=1e-3, C=1.0, max_iter=1000, calibration_fraction=0.1,
+                 random_state=None):
+        """
+        :param name: name of the classifier (for logging)
+        :param loss: 'hinge' for a linear SVM or 'logistic' for logistic regression
+        :param tol: tolerance of the solver stopping criterion
+        :param C: inverse of the L2 regularization strength
+        :param max_iter: maximum number of solver iterations
+        :param calibration_fraction: fraction of the training samples held out for the temperature calibration
+        :param random_state: np.random.RandomState (or seed) of the calibration split
+        """
+        self.name                 = name
+        self.log                  = logger.get_logger(name)
+        self.loss                 = loss
+        self.tol                  = tol
+        self.C                    = C
+        self.max_iter             = max_iter
+        self.calibration_fraction = calibration_fraction
+        self.random_state         = random_state
+
+        if self.loss not in ['hinge', 'logistic']:
+            err_str = 'loss {} is not supported'.format(self.loss)
+            self.log.error(err_str)
+            raise AssertionError(err_str)
+
+        self.model        = None
+        self.classes_     = None
+        self.temperature_ = 1.0
+
+    def __str__(self):
+        return '{}(loss={}, tol={}, C={}, temperature={})'.format(self.name, self.loss, self.tol, self.C,
+                                                                   self.temperature_)
+
+    def _new_model(self):
+        if self.loss == 'hinge':
+            return LinearSVC(C=self.C, dual=False, tol=self.tol, max_iter=self.max_iter)
+        return LogisticRegression(C=self.C, solver='lbfgs', tol=self.tol, max_iter=self.max_iter)
+
+    def _scores(self, model, X):
+        """:return: decision scores of every class ([n_samples, n_classes]), also for a binary model"""
+        scores = model.decision_function(X)
+        if scores.ndim == 1:
+            scores = np.column_stack([-scores, scores]) / 2.0
+        return scores.astype(np.float64)
+
+    def _fit_temperature(self, scores, y):
+        """:return: the temperature minimizing the NLL of softmax(scores / T) for the labels y"""
+        labels = np.searchsorted(self.classes_, y)
+        rows   = np.arange(len(labels))
+
+        def nll(log_t):
+            return -np.mean(log_softmax(scores / np.exp(log_t))[rows, labels])
+
+        res = minimize_scalar(nll, bounds=(-7.0, 7.0), method='bounded')
+        return float(np.exp(res.x))
+
+    def fit(self, X, y):
+        """
+        :param X: training features ([n_samples, n_features])
+        :param y: training labels ([n_samples])
+        :return: self
+        """
+        self.classes_, y_inds = np.unique(y, return_inverse=True)
+        num_cal = int(round(self.calibration_fraction * X.shape[0]))
+        # the stratified calibration split needs at least two samples of every class. Otherwise T=1
+        if num_cal >= len(self.classes_) and np.bincount(y_inds).min() >= 2:
+            X_fit, X_cal, y_fit, y_cal = train_test_split(X, y, test_size=num_cal, random_state=self.random_state,
+                                                          stratify=y)
+            self.log.info('Fitting {} on {} samples for the temperature calibration on {} samples...'
+                          .format(self.name, X_fit.shape[0], X_cal.shape[0]))
+            model = self._new_model().fit(X_fit, y_fit)
+            self.temperature_ = self._fit_temperature(self._scores(model, X_cal), y_cal)
+            self.log.info('{} temperature: {}'.format(self.name, self.temperature_))
+        else:
+            self.log.warning('Too few samples (per class) to calibrate {}. Using temperature 1'.format(self.name))
+            self.temperature_ = 1.0
+
+        self.log.info('Fitting {} on all the {} samples...'.format(self.name, X.shape[0]))
+        self.model = self._new_model().fit(X, y)
+        return self
+
+    def decision_function(self, X):
+        return self._scores(self.model, X)
+
+    def predict_proba(self, X):
+        """
+        :param X: features ([n_samples, n_features])
+        :return: calibrated probabilities ([n_samples, n_classes])
+        """
+        return np.exp(log_softmax(self.decision_function(X) / self.temperature_))
+
+    def predict(self, X):
+        return self.classes_[self.decision_function(X).argmax(axis=1)]
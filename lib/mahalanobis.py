@@ -0,0 +1,130 @@
+'''Mahalanobis adversarial detector (Lee et al., 2018): class conditional Gaussian statistics with a tied covariance
+per layer, and the corresponding confidence scores with input pre-processing'''
+from __future__ import division
+from __future__ import absolute_import
+from __future__ import print_function
+
+import os
+import numpy as np
+import sklearn.covariance
+import tensorflow as tf
+
+# per channel scale hyper params given from the official deep_Mahalanobis_detector repo (CIFAR-10 RGB std)
+RGB_STD = [0.2023, 0.1994, 0.2010]
+
+
+def class_statistics(features, labels, num_classes):
+    """
+    :param features: training features of one layer ([n_samples, n_features])
+    :param labels: training labels ([n_samples]), encoded as 0..num_classes-1
+    :param num_classes: number of classes
+    :return: class means ([num_classes, n_features]) and the precision of the tied covariance ([n_features, n_features])
+    """
+    features = features.reshape((features.shape[0], -1))
+    sample_mean = np.zeros((num_classes, features.shape[1]), dtype=np.float64)
+    for cls in range(num_classes):
+        sample_mean[cls] = np.mean(features[labels == cls], axis=0)
+
+    # the covariance of the features around their class means
+    group_lasso = sklearn.covariance.EmpiricalCovariance(assume_centered=False)
+    group_lasso.fit(features - sample_mean[labels])
+    return sample_mean, group_lasso.precision_
+
+
+def save_class_statistics(path, layers, sample_means, precisions):
+    """
+    :param path: .npz path
+    :param layers: list of layer names
+    :param sample_means: list of the class means of every layer
+    :param precisions: list of the precision matrices of every layer
+    :return: None
+    """
+    arrays = {'layers': np.array(layers)}
+    for i in range(len(layers)):
+        arrays['mean_{}'.format(i)]      = sample_means[i]
+        arrays['precision_{}'.format(i)] = precisions[i]
+    out_dir = os.path.dirname(os.path.abspath(path))
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    with open(path, 'wb') as f:  # np.savez appends .npz to file names
+        np.savez(f, **arrays)
+
+
+def load_class_statistics(path, layers):
+    """
+    :param path: .npz path written by save_class_statistics
+    :param layers: the expected list of layer names
+    :return: list of class means and list of precision matrices, one per layer. None, None if the file is missing or
+             was calculated for other layers
+    """
+    if not os.path.isfile(path):
+        return None, None
+    with np.load(path) as data:
+        if [str(layer) for layer in data['layers']] != list(layers):
+            return None, None
+        return [data['mean_{}'.format(i)] for i in range(len(layers))], \
+               [data['precision_{}'.format(i)] for i in range(len(layers))]
+
+
+def gaussian_score_tensors(features, x, sample_mean, precision):
+    """
+    Building the Mahalanobis confidence of a layer for all the classes at once, and the input gradients of the
+    pre-processing loss.
+    :param features: layer activations tensor ([B, H, W, C] are global average pooled, or [B, D])
+    :param x: input placeholder
+    :param sample_mean: class means ([num_classes, D])
+    :param precision: tied precision matrix ([D, D])
+    :return: gaussian_score ([B, num_classes]): -0.5 * Mahalanobis distance to every class mean
+             grads ([B, ...x.shape[1:]]): per sample input gradients of -gaussian_score of the closest class. The loss
+             is a sum over the batch, so the gradients do not depend on the batch composition
+    """
+    if len(features.shape) == 4:
+        features = tf.reduce_mean(features, axis=[1, 2])
+    elif len(features.shape) != 2:
+        raise AssertionError('Expecting size of 2 or 4 but got {}'.format(len(features.shape)))
+
+    precision_mat      = tf.convert_to_tensor(precision  , dtype=tf.float32)
+    sample_mean_tensor = tf.convert_to_tensor(sample_mean, dtype=tf.float32)
+
+    # (f - mu)^T P (f - mu) = f^T P f - 2 f^T P mu + mu^T P mu, for all the classes in one matrix product
+    features_prec = tf.matmul(features, precision_mat)
+    mean_prec     = tf.matmul(sample_mean_tensor, precision_mat)
+    features_term = tf.reduce_sum(features_prec * features, axis=1)
+    mean_term     = tf.reduce_sum(mean_prec * sample_mean_tensor, axis=1)
+    gaussian_score = -0.5 * (tf.expand_dims(features_term, 1)
+                             - 2.0 * tf.matmul(features_prec, sample_mean_tensor, transpose_b=True)
+                             + tf.expand_dims(mean_term, 0))
+
+    # input pre-processing: gradients of -gaussian_score of the closest class
+    sample_pred = tf.argmax(gaussian_score, axis=1)
+    zero_f      = features - tf.gather(sample_mean_tensor, sample_pred)
+    pure_gau    = -0.5 * tf.reduce_sum(tf.matmul(zero_f, precision_mat) * zero_f, axis=1)
+    grads       = tf.gradients(tf.reduce_sum(-pure_gau), x)[0]
+
+    return gaussian_score, grads
+
+
+def mean_loss_scale(num_samples, batch_size):
+    """
+    :return: 1/(size of the batch of every sample) when num_samples are processed in batches of batch_size. Scales
+             gradients of a summed loss to the gradients of a batch mean loss ([num_samples])
+    """
+    sizes = np.full(num_samples, batch_size, dtype=np.float32)
+    last_batch = num_samples % batch_size
+    if last_batch > 0:
+        sizes[num_samples - last_batch:] = last_batch
+    return 1.0 / sizes
+
+
+def preprocess_inputs(X, gradients, magnitude, scale):
+    """
+    :param X: inputs ([N, H, W, 3])
+    :param gradients: input gradients of the pre-processing loss ([N, H, W, 3])
+    :param magnitude: noise magnitude
+    :param scale: scale of the RGB std
+    :return: X - magnitude * (processed gradients)
+    """
+    gradients = gradients.clip(min=0)
+    gradients = (gradients - 0.5) * 2
+    gradients_scaled = gradients / (np.array(RGB_STD, dtype=np.float32) * scale)
+    return X - magnitude * gradients_scaled
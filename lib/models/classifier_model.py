@@ -19,6 +19,7 @@ class ClassifierModel(ModelBase):
 
         self.xent_cost        = None # contribution of cross entropy to loss
         self.predictions_prob = None # output of the classifier softmax
+        self.input_minibatch  = None # optional (indices, images, labels) tensors to wire as the default inputs
 
     def print_stats(self):
         super(ClassifierModel, self).print_stats()
@@ -29,13 +30,30 @@ class ClassifierModel(ModelBase):
         self.log.info(' NORMALIZE_EMBEDDING: {}'.format(self.normalize_embedding))
         self.log.info(' EMBEDDING_DIMS: {}'.format(self.embedding_dims))
 
+    def set_input_minibatch(self, next_minibatch):
+        """
+        Wiring the model inputs to a dataset iterator. Must be called before build_graph()
+        :param next_minibatch: the (indices, images, labels) output of iterator.get_next()
+        :return: None
+        """
+        self.input_minibatch = next_minibatch
+
     def _set_placeholders(self):
         super(ClassifierModel, self)._set_placeholders()
-        self.images = tf.placeholder(tf.float32, [None, self.image_height, self.image_width, self.num_channels])
+        images_shape = [None, self.image_height, self.image_width, self.num_channels]
         if self.one_hot_labels:
-            self.labels = tf.placeholder(tf.int32, [None, self.num_classes])
+            labels_shape = [None, self.num_classes]
+        else:
+            labels_shape = [None]
+
+        if self.input_minibatch is None:
+            self.images = tf.placeholder(tf.float32, images_shape)
+            self.labels = tf.placeholder(tf.int32, labels_shape)
         else:
-            self.labels = tf.placeholder(tf.int32, [None])
+            # the inputs are pulled from the iterator inside the graph, but can still be fed like placeholders
+            _, images, labels = self.input_minibatch
+            self.images = tf.placeholder_with_default(images, images_shape)
+            self.labels = tf.placeholder_with_default(labels, labels_shape)
 
     def add_fidelity_loss(self):
         with tf.variable_scope('xent_cost'):
@@ -22,6 +22,7 @@ class FC2Net(ClassifierModel):
                 self.net['input_images'] = self.images
                 x = slim.flatten(self.images)
                 x = slim.fully_connected(x, self.embedding_dims, scope='fc1')
+                self.net['pre_dropout'] = x
                 x = tf.nn.dropout(x, keep_prob=self.dropout_keep_prob)
                 if self.normalize_embedding:
                     x = tf.nn.l2_normalize(x, axis=1, name='normalize_vec')
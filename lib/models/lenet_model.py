@@ -34,6 +34,7 @@ class LeNet(ClassifierModel):
                 for key in self.net.keys():
                     self.net[key + '_gap'] = global_avg_pool(self.net[key])
 
+                self.net['pre_dropout'] = x
                 x = tf.nn.dropout(x, keep_prob=self.dropout_keep_prob)
                 if self.normalize_embedding:
                     x = tf.nn.l2_normalize(x, axis=1, name='normalize_vec')
@@ -69,6 +69,7 @@ class ResNet(ClassifierModel):
             x = relu(x, self.relu_leakiness)
             x = global_avg_pool(x)
             x = self.post_pool_operations(x)
+            self.net['pre_dropout'] = x
             x = tf.nn.dropout(x, keep_prob=self.dropout_keep_prob)
             if self.normalize_embedding:
                 x = tf.nn.l2_normalize(x, axis=1, name='normalize_vec')  # was x = slim.unit_norm(x, dim=1, scope='normalize_vec')
@@ -0,0 +1,205 @@
+'''Exact, blocked (tiled) L2 nearest-neighbors index over a training set, with full-rank output tables'''
+from __future__ import division
+from __future__ import absolute_import
+from __future__ import print_function
+
+import os
+import numpy as np
+import tensorflow_TB.lib.logger.logger as logger
+
+
+def inverse_permutation(neighbor_indices):
+    """
+    Inverting sorted neighbors lists into ranks, once per query.
+    :param neighbor_indices: training indices sorted by distance, for every query ([n_queries, n_train])
+    :return: ranks ([n_queries, n_train]), where ranks[i, j] is the position of training sample j in the sorted
+             neighbors list of query i
+    """
+    neighbor_indices = np.asarray(neighbor_indices)
+    ranks = np.empty(neighbor_indices.shape, dtype=np.int32)
+    rows = np.arange(neighbor_indices.shape[0])[:, np.newaxis]
+    ranks[rows, neighbor_indices] = np.arange(neighbor_indices.shape[1], dtype=np.int32)
+    return ranks
+
+
+class RankTable(object):
+    """
+    Neighbors ranks and distances of every (query, training sample) pair, stored in training index order:
+    ranks[i, j] is the position of training sample j in the sorted neighbors list of query i, and dists[i, j] is their
+    distance. Answers "rank of training index j for query i" in O(1) without searching the sorted permutation.
+    """
+
+    def __init__(self, ranks, dists):
+        """
+        :param ranks: np.ndarray/np.memmap of int32 ([n_queries, n_train])
+        :param dists: np.ndarray/np.memmap of float32 ([n_queries, n_train])
+        """
+        self.ranks = ranks
+        self.dists = dists
+
+    def __len__(self):
+        return self.ranks.shape[0]
+
+    @classmethod
+    def load(cls, out_prefix, mmap_mode='r'):
+        """
+        Opening the tables written by BlockedNNIndex.rank_table(out_prefix=...)
+        :param out_prefix: path prefix of the <out_prefix>_ranks.npy and <out_prefix>_dists.npy files
+        :param mmap_mode: np.load mmap_mode. The default 'r' is read-only, so many processes can share the tables
+        :return: RankTable
+        """
+        return cls(np.load(out_prefix + '_ranks.npy', mmap_mode=mmap_mode),
+                   np.load(out_prefix + '_dists.npy', mmap_mode=mmap_mode))
+
+    @classmethod
+    def from_neighbors(cls, neighbor_dists, neighbor_indices):
+        """
+        Building a table from full sorted neighbors lists (e.g. the output of NearestNeighbors.kneighbors with
+        n_neighbors=n_train)
+        :param neighbor_dists: sorted distances ([n_queries, n_train])
+        :param neighbor_indices: sorted training indices ([n_queries, n_train])
+        :return: RankTable
+        """
+        ranks = inverse_permutation(neighbor_indices)
+        rows = np.arange(ranks.shape[0])[:, np.newaxis]
+        dists = np.asarray(neighbor_dists, dtype=np.float32)[rows, ranks]
+        return cls(ranks, dists)
+
+    def lookup(self, query_index, train_indices):
+        """
+        Vectorized lookup of many training indices at once.
+        :param query_index: index of the query
+        :param train_indices: array of training indices, of any shape (e.g. [2, k] for the helpful and harmful sets)
+        :return: ranks and distances of train_indices for the query, in the shape of train_indices
+        """
+        train_indices = np.asarray(train_indices)
+        return np.asarray(self.ranks[query_index])[train_indices], np.asarray(self.dists[query_index])[train_indices]
+
+    def nearest(self, query_index, k):
+        """
+        :param query_index: index of the query
+        :param k: number of neighbors
+        :return: the training indices of the k nearest neighbors of the query, sorted by distance
+        """
+        ranks = np.asarray(self.ranks[query_index])
+        inds = np.nonzero(ranks < k)[0]
+        return inds[np.argsort(ranks[inds])]
+
+
+class BlockedNNIndex(object):
+    """
+    Exact L2 nearest neighbors computed tile by tile with BLAS (||q||^2 + ||x||^2 - 2 q.x), without any neighbor
+    search structure or GPU. Only a [query_block, n_train] distances tile is held in memory at once.
+    """
+
+    def __init__(self, name, query_block=256, train_block=8192):
+        """
+        :param name: name of the index (for logging)
+        :param query_block: number of queries to process at once
+        :param train_block: number of training samples in every distances tile
+        """
+        self.name        = name
+        self.log         = logger.get_logger(name)
+        self.query_block = query_block
+        self.train_block = train_block
+
+        self._X       = None  # training features, float32
+        self._X_norms = None  # squared L2 norms of the training features
+
+    def __str__(self):
+        return self.name
+
+    @property
+    def n_train(self):
+        return self._X.shape[0]
+
+    def fit(self, X):
+        """
+        :param X: training features ([n_train, n_features])
+        :return: self
+        """
+        self._X = np.ascontiguousarray(X, dtype=np.float32).reshape((X.shape[0], -1))
+        self._X_norms = np.einsum('ij,ij->i', self._X, self._X)
+        return self
+
+    def distances(self, Q):
+        """
+        :param Q: query features ([n_queries, n_features]), with n_queries in the order of query_block
+        :return: L2 distances to all the training samples ([n_queries, n_train])
+        """
+        Q = np.asarray(Q, dtype=np.float32).reshape((Q.shape[0], -1))
+        Q_norms = np.einsum('ij,ij->i', Q, Q)
+        dist = np.empty((Q.shape[0], self.n_train), dtype=np.float32)
+        for b in range(0, self.n_train, self.train_block):
+            e = min(b + self.train_block, self.n_train)
+            tile = np.dot(Q, self._X[b:e].T)
+            tile *= -2.0
+            tile += Q_norms[:, np.newaxis]
+            tile += self._X_norms[np.newaxis, b:e]
+            np.maximum(tile, 0.0, out=tile)
+            dist[:, b:e] = np.sqrt(tile)
+        return dist
+
+    def kneighbors(self, Q, n_neighbors, dists_out=None, indices_out=None):
+        """
+        :param Q: query features ([n_queries, n_features])
+        :param n_neighbors: number of neighbors
+        :param dists_out: optional preallocated float32 array ([n_queries, n_neighbors]) to write the distances to,
+                          e.g. a memory-mapped .npy file for full neighbors lists (n_neighbors=n_train)
+        :param indices_out: optional preallocated integer array ([n_queries, n_neighbors]) to write the indices to
+        :return: sorted distances and indices of the nearest training samples ([n_queries, n_neighbors])
+        """
+        num_queries = Q.shape[0]
+        neigh_dist = dists_out   if dists_out   is not None else np.empty((num_queries, n_neighbors), dtype=np.float32)
+        neigh_ind  = indices_out if indices_out is not None else np.empty((num_queries, n_neighbors), dtype=np.int64)
+        for b in range(0, num_queries, self.query_block):
+            e = min(b + self.query_block, num_queries)
+            dist = self.distances(Q[b:e])
+            if n_neighbors < self.n_train:
+                ind = np.argpartition(dist, n_neighbors - 1, axis=1)[:, :n_neighbors]
+            else:
+                ind = np.tile(np.arange(self.n_train), (e - b, 1))
+            rows = np.arange(e - b)[:, np.newaxis]
+            order = np.argsort(dist[rows, ind], axis=1, kind='mergesort')
+            neigh_ind[b:e]  = ind[rows, order]
+            neigh_dist[b:e] = dist[rows, ind[rows, order]]
+        return neigh_dist, neigh_ind
+
+    def rank_table(self, Q, out_prefix=None, ranks_out=None, dists_out=None):
+        """
+        Calculating the ranks and distances of all the training samples for every query.
+        :param Q: query features ([n_queries, n_features])
+        :param out_prefix: optional path prefix. If given, the tables are written to memory-mapped
+                           <out_prefix>_ranks.npy and <out_prefix>_dists.npy files
+        :param ranks_out: optional preallocated int32 array ([n_queries, n_train]) to write the ranks to
+        :param dists_out: optional preallocated float32 array ([n_queries, n_train]) to write the distances to
+        :return: RankTable
+        """
+        num_queries = Q.shape[0]
+        shape = (num_queries, self.n_train)
+        if ranks_out is None:
+            ranks_out = self._allocate(out_prefix, '_ranks.npy', shape, np.int32)
+        if dists_out is None:
+            dists_out = self._allocate(out_prefix, '_dists.npy', shape, np.float32)
+
+        self.log.info('Calculating the ranks of {} training samples for {} queries'.format(self.n_train, num_queries))
+        for b in range(0, num_queries, self.query_block):
+            e = min(b + self.query_block, num_queries)
+            dist  = self.distances(Q[b:e])
+            order = np.argsort(dist, axis=1, kind='mergesort')
+            ranks_out[b:e] = inverse_permutation(order)
+            dists_out[b:e] = dist
+
+        for arr in [ranks_out, dists_out]:
+            if isinstance(arr, np.memmap):
+                arr.flush()
+        return RankTable(ranks_out, dists_out)
+
+    @staticmethod
+    def _allocate(out_prefix, suffix, shape, dtype):
+        if out_prefix is None:
+            return np.empty(shape, dtype=dtype)
+        out_dir = os.path.dirname(os.path.abspath(out_prefix))
+        if not os.path.exists(out_dir):
+            os.makedirs(out_dir)
+        return np.lib.format.open_memmap(out_prefix + suffix, mode='w+', dtype=dtype, shape=shape)
@@ -0,0 +1,237 @@
+'''Scalable K-Means for segment-based active selection: mini-batch updates, warm start and fixed centers'''
+from __future__ import division
+from __future__ import absolute_import
+from __future__ import print_function
+
+import numpy as np
+import scipy.sparse as sp
+from sklearn.utils import check_random_state
+import tensorflow_TB.lib.logger.logger as logger
+
+
+class SegmentKMeans(object):
+    """
+    K-Means with a sklearn-like interface (fit/predict/cluster_centers_/labels_/inertia_), built for re-clustering
+    large unlabeled pools every annotation round:
+    1) A single k-means++ initialization on a random subsample, instead of n_init full runs.
+    2) Mini-batch center updates (Sculley, 2010), or full-batch Lloyd iterations if batch_size is None.
+    3) Warm start: the next fit starts from the centers of the previous fit (if the feature dims did not change).
+    4) Fixed centers that are never updated, e.g. the centers of the labeled pool.
+    Clusters smaller than min_cluster_size are re-seeded inside the largest clusters after the fit.
+    """
+
+    def __init__(self, name, n_clusters, random_state=None, batch_size=1024, max_iter=100, tol=1e-4,
+                 max_no_improvement=10, init_size=None, warm_start=True, min_cluster_size=1, chunk_size=8192):
+        """
+        :param name: name of the clusterer (for logging)
+        :param n_clusters: number of clusters, including the fixed centers
+        :param random_state: None, int or np.random.RandomState
+        :param batch_size: number of samples in every mini-batch. None for full-batch Lloyd iterations
+        :param max_iter: maximal number of passes (epochs) over the data
+        :param tol: tolerance of the centers shift, relative to the mean variance of the data
+        :param max_no_improvement: stopping after this many mini-batches without improvement of the smoothed inertia
+        :param init_size: number of samples for the k-means++ initialization. Default: max(3 * batch_size,
+                          100 * n_clusters)
+        :param warm_start: whether or not to initialize from the centers of the previous fit
+        :param min_cluster_size: minimal number of samples in every (not fixed) cluster
+        :param chunk_size: number of samples to assign to the centers at once
+        """
+        self.name               = name
+        self.log                = logger.get_logger(name)
+        self.n_clusters         = n_clusters
+        self.random_state       = check_random_state(random_state)
+        self.batch_size         = batch_size
+        self.max_iter           = max_iter
+        self.tol                = tol
+        self.max_no_improvement = max_no_improvement
+        self.init_size          = init_size
+        self.warm_start         = warm_start
+        self.min_cluster_size   = min_cluster_size
+        self.chunk_size         = chunk_size
+
+        self.cluster_centers_ = None
+        self.labels_          = None
+        self.inertia_         = None
+        self.n_iter_          = None
+
+    def __str__(self):
+        return self.name
+
+    def fit(self, X, fixed_centers=None, init_centers=None):
+        """
+        :param X: features ([n_samples, n_features])
+        :param fixed_centers: optional centers which are kept as the first clusters ([n_fixed, n_features])
+        :param init_centers: optional initial centers ([n_clusters, n_features]). Overrides the warm start
+        :return: self
+        """
+        X = np.ascontiguousarray(X, dtype=np.float32).reshape((X.shape[0], -1))
+        n_fixed = 0 if fixed_centers is None else fixed_centers.shape[0]
+        if n_fixed >= self.n_clusters:
+            err_str = 'number of fixed centers ({}) must be smaller than n_clusters ({})'.format(n_fixed, self.n_clusters)
+            self.log.error(err_str)
+            raise AssertionError(err_str)
+        if X.shape[0] < self.n_clusters:
+            err_str = 'n_samples={} should be >= n_clusters={}'.format(X.shape[0], self.n_clusters)
+            self.log.error(err_str)
+            raise AssertionError(err_str)
+
+        centers = self._init_centers(X, fixed_centers, init_centers)
+        tol = self.tol * np.mean(np.var(X, axis=0))
+        if self.batch_size is None or self.batch_size >= X.shape[0]:
+            centers, self.n_iter_ = self._lloyd(X, centers, n_fixed, tol)
+        else:
+            centers, self.n_iter_ = self._mini_batch(X, centers, n_fixed, tol)
+
+        labels, dists = self.assign(X, centers)
+        centers, labels, dists = self._reseed_small_clusters(X, centers, labels, dists, n_fixed)
+
+        self.cluster_centers_ = centers
+        self.labels_          = labels
+        self.inertia_         = float(dists.sum())
+        self.log.info('K-Means with {} clusters on {} samples done after {} iterations. inertia={}'
+                      .format(self.n_clusters, X.shape[0], self.n_iter_, self.inertia_))
+        return self
+
+    def predict(self, X):
+        """:return: index of the closest center for every sample"""
+        return self.assign(np.asarray(X, dtype=np.float32).reshape((X.shape[0], -1)), self.cluster_centers_)[0]
+
+    def fit_predict(self, X, fixed_centers=None):
+        return self.fit(X, fixed_centers=fixed_centers).labels_
+
+    def fit_predict_centers(self, X, fixed_centers=None):
+        return self.fit(X, fixed_centers=fixed_centers).cluster_centers_
+
+    def assign(self, X, centers):
+        """
+        Assigning every sample to its closest center, chunk by chunk
+        :return: labels ([n_samples]) and squared distances to the closest centers ([n_samples])
+        """
+        centers = centers.astype(np.float32)
+        centers_norms = np.einsum('ij,ij->i', centers, centers)
+        labels = np.empty(X.shape[0], dtype=np.int32)
+        dists  = np.empty(X.shape[0], dtype=np.float32)
+        for b in range(0, X.shape[0], self.chunk_size):
+            e = min(b + self.chunk_size, X.shape[0])
+            d2 = np.dot(X[b:e], centers.T)
+            d2 *= -2.0
+            d2 += centers_norms[np.newaxis, :]
+            labels[b:e] = d2.argmin(axis=1)
+            dists[b:e] = d2[np.arange(e - b), labels[b:e]] + np.einsum('ij,ij->i', X[b:e], X[b:e])
+        np.maximum(dists, 0.0, out=dists)
+        return labels, dists
+
+    def _init_centers(self, X, fixed_centers, init_centers):
+        n_fixed = 0 if fixed_centers is None else fixed_centers.shape[0]
+        if init_centers is not None:
+            centers = np.array(init_centers, dtype=np.float64)
+        elif self.warm_start and self.cluster_centers_ is not None and self.cluster_centers_.shape[1] == X.shape[1]:
+            self.log.info('warm starting from the previous {} centers'.format(self.cluster_centers_.shape[0]))
+            centers = self.cluster_centers_.astype(np.float64)
+        else:
+            init_size = self.init_size
+            if init_size is None:
+                init_size = max(3 * (self.batch_size or 0), 100 * self.n_clusters)
+            init_size = min(init_size, X.shape[0])
+            subsample = X[self.random_state.choice(X.shape[0], init_size, replace=False)]
+            self.log.info('k-means++ initialization on {} samples'.format(init_size))
+            centers = np.empty((self.n_clusters, X.shape[1]), dtype=np.float64)
+            centers[n_fixed:] = self._kmeans_plusplus(subsample, self.n_clusters - n_fixed, fixed_centers)
+        if n_fixed > 0:
+            centers[:n_fixed] = fixed_centers
+        return centers
+
+    def _kmeans_plusplus(self, X, n_centers, existing=None):
+        """Greedy k-means++ seeding (2 + log(k) candidates per center), with the existing (fixed) centers already
+        chosen"""
+        X = X.astype(np.float64)
+        X_norms = np.einsum('ij,ij->i', X, X)
+
+        def sq_dists(C):
+            return np.maximum(X_norms[np.newaxis, :] + np.einsum('ij,ij->i', C, C)[:, np.newaxis] - 2 * np.dot(C, X.T), 0)
+
+        n_local_trials = 2 + int(np.log(n_centers + (0 if existing is None else existing.shape[0])))
+        centers = np.empty((n_centers, X.shape[1]), dtype=np.float64)
+        start = 0
+        if existing is None or existing.shape[0] == 0:
+            centers[0] = X[self.random_state.randint(X.shape[0])]
+            closest = sq_dists(centers[0:1])[0]
+            start = 1
+        else:
+            closest = sq_dists(np.asarray(existing, dtype=np.float64)).min(axis=0)
+        for c in range(start, n_centers):
+            total = closest.sum()
+            probs = closest / total if total > 0 else None
+            candidates = self.random_state.choice(X.shape[0], n_local_trials, p=probs)
+            candidates_closest = np.minimum(closest[np.newaxis, :], sq_dists(X[candidates]))
+            best = candidates_closest.sum(axis=1).argmin()
+            centers[c] = X[candidates[best]]
+            closest = candidates_closest[best]
+        return centers
+
+    def _cluster_sums(self, X, labels):
+        """:return: sum and number of the samples in every cluster"""
+        one_hot = sp.csr_matrix((np.ones(X.shape[0]), (labels, np.arange(X.shape[0]))),
+                                shape=(self.n_clusters, X.shape[0]))
+        return np.asarray(one_hot.dot(X.astype(np.float64))), np.bincount(labels, minlength=self.n_clusters)
+
+    def _lloyd(self, X, centers, n_fixed, tol):
+        for itr in range(self.max_iter):
+            labels, _ = self.assign(X, centers)
+            sums, counts = self._cluster_sums(X, labels)
+            new_centers = centers.copy()
+            update = counts > 0
+            update[:n_fixed] = False
+            new_centers[update] = sums[update] / counts[update, np.newaxis]
+            shift = np.sum((new_centers - centers) ** 2)
+            centers = new_centers
+            if shift <= tol:
+                return centers, itr + 1
+        return centers, self.max_iter
+
+    def _mini_batch(self, X, centers, n_fixed, tol):
+        n_samples   = X.shape[0]
+        n_steps     = self.max_iter * int(np.ceil(n_samples / self.batch_size))
+        alpha       = min(1.0, 2.0 * self.batch_size / (n_samples + 1))
+        counts      = np.zeros(self.n_clusters, dtype=np.float64)
+        ewa_inertia = None
+        best_inertia, no_improvement = np.inf, 0
+
+        for step in range(n_steps):
+            X_batch = X[self.random_state.randint(0, n_samples, self.batch_size)]
+            labels, dists = self.assign(X_batch, centers)
+            sums, batch_counts = self._cluster_sums(X_batch, labels)
+
+            update = batch_counts > 0
+            update[:n_fixed] = False
+            counts[update] += batch_counts[update]
+            delta = (sums[update] - batch_counts[update, np.newaxis] * centers[update]) / counts[update, np.newaxis]
+            centers[update] += delta
+            shift = np.sum(delta ** 2)
+
+            batch_inertia = dists.sum() / self.batch_size
+            ewa_inertia = batch_inertia if ewa_inertia is None else ewa_inertia * (1 - alpha) + batch_inertia * alpha
+            if ewa_inertia < best_inertia:
+                best_inertia, no_improvement = ewa_inertia, 0
+            else:
+                no_improvement += 1
+            if (tol > 0 and shift <= tol) or no_improvement >= self.max_no_improvement:
+                return centers, step + 1
+        return centers, n_steps
+
+    def _reseed_small_clusters(self, X, centers, labels, dists, n_fixed, max_rounds=10):
+        """Moving the centers of too small clusters to random samples of the largest clusters"""
+        for _ in range(max_rounds):
+            counts = np.bincount(labels, minlength=self.n_clusters)
+            small = [c for c in range(n_fixed, self.n_clusters) if counts[c] < self.min_cluster_size]
+            if not small:
+                break
+            self.log.info('re-seeding {} clusters with less than {} samples'.format(len(small), self.min_cluster_size))
+            for c in small:
+                largest = counts.argmax()
+                centers[c] = X[self.random_state.choice(np.where(labels == largest)[0])]
+                counts[largest] //= 2
+            labels, dists = self.assign(X, centers)
+        else:
+            self.log.warning('some clusters still have less than {} samples'.format(self.min_cluster_size))
+        return centers, labels, dists
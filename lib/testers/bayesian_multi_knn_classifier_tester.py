@@ -4,7 +4,6 @@ from __future__ import print_function
 
 import numpy as np
 from tensorflow_TB.lib.testers.multi_knn_classifier_tester import MultiKNNClassifierTester
-from tensorflow_TB.utils.misc import collect_features
 
 eps = 0.000001
 
@@ -31,10 +30,8 @@ class BayesianMultiKNNClassifierTester(MultiKNNClassifierTester):
         X_train_features = self.apply_pca(X_train_features, fit=True)
         X_test_features = self.apply_pca(X_test_features, fit=False)
 
-        # fitting knn models
-        for k in self.k_list:
-            self.log.info('Fitting KNN model for k={}...'.format(k))
-            self.knn_dict[k].fit(X_train_features, y_train)
+        self.log.info('Fitting KNN model for k={}...'.format(self.k_list))
+        self.multi_knn.fit(X_train_features, y_train)
 
         self.log.info('Predicting test set labels from DNN model...')
         y_pred_dnn = test_dnn_predictions_prob.argmax(axis=1)
@@ -52,18 +49,16 @@ class BayesianMultiKNNClassifierTester(MultiKNNClassifierTester):
         # now iterating over the knn models
         self.log.info('Running Bayesian network for features with DROPOUT_KEEP_PROB={}\n'.
                       format(self.prm.network.system.DROPOUT_KEEP_PROB))
-        total_iterations_cnt = 0
-        while total_iterations_cnt < 20:
-            (tmp_features,) = collect_features(
-                agent=self,
-                dataset_name='test',
-                fetches=[self.model.net[self.tested_layer]],
-                feed_dict={self.model.dropout_keep_prob: self.prm.network.system.DROPOUT_KEEP_PROB})
-            tmp_features = self.apply_pca(tmp_features, fit=False)
+        total_iterations_cnt = 20
+        mc_features = self.collect_mc_dropout_features(
+            dataset_name='test',
+            keep_prob=self.prm.network.system.DROPOUT_KEEP_PROB,
+            num_samples=total_iterations_cnt)
+        # one query per dropout sample, so the neighbors search memory does not grow with total_iterations_cnt
+        for features in mc_features:
+            tmp_pred_proba = self.multi_knn.predict_proba(self.apply_pca(features, fit=False))
             for k in self.k_list:
-                tmp_pred_proba = self.knn_dict[k].predict_proba(tmp_features)
-                self.knn_accumulated_pred_proba[k] += tmp_pred_proba
-            total_iterations_cnt += 1
+                self.knn_accumulated_pred_proba[k] += tmp_pred_proba[k]
 
         for k in self.k_list:
             self.pred_proba[k] = self.knn_accumulated_pred_proba[k] / total_iterations_cnt
@@ -71,13 +66,10 @@ class BayesianMultiKNNClassifierTester(MultiKNNClassifierTester):
         # dumping
         for k in self.k_list:
             self.process(
-                model=self.knn_dict[k],
+                k=k,
                 dataset_name='test',
-                X=self.pred_proba[k],
+                predictions_prob=self.pred_proba[k],
                 y=y_test,
                 dnn_predictions_prob=test_dnn_predictions_prob)
 
         self.summary_writer_test.flush()
-
-    def predict_proba(self, X, model):
-        return X
@@ -6,7 +6,6 @@ import numpy as np
 from tensorflow_TB.lib.testers.knn_classifier_tester import KNNClassifierTester
 import os
 from sklearn.neighbors import KNeighborsClassifier
-from tensorflow_TB.utils.misc import collect_features
 
 class EnsembleTester(KNNClassifierTester):
 
@@ -77,15 +76,12 @@ class EnsembleTester(KNNClassifierTester):
                 self.log.info('loading KNN model parameters for net #{}'.format(i))
                 self.saver.restore(self.plain_sess, self.checkpoint_file_list[i])
                 self.log.info('Predicting KNN model for net #{} using NC dropout'.format(i))
-                for k in xrange(number_of_predictions):
-                    (X_test_features, ) = \
-                        collect_features(
-                            agent=self,
-                            dataset_name='test',
-                            fetches=[self.model.net['embedding_layer']],
-                            feed_dict={self.model.dropout_keep_prob: 0.5})
-                    X_test_features = self.apply_pca(X_test_features, fit=False)
-                    test_knn_predictions_prob_sum += knn_models[i].predict_proba(X_test_features)
+                mc_features = self.collect_mc_dropout_features(
+                    dataset_name='test',
+                    keep_prob=0.5,
+                    num_samples=number_of_predictions)
+                for features in mc_features:  # one query per dropout sample
+                    test_knn_predictions_prob_sum += knn_models[i].predict_proba(self.apply_pca(features, fit=False))
                 test_knn_predictions_prob_ensemble_mat[:, i, :] = test_knn_predictions_prob_sum
             test_knn_predictions_prob_mat = np.average(test_knn_predictions_prob_ensemble_mat, axis=1)  # shape=[self.dataset.test_set_size, self.num_classes]
             y_pred = test_knn_predictions_prob_mat.argmax(axis=1)
@@ -113,13 +109,18 @@ class EnsembleTester(KNNClassifierTester):
         y_test                    = np.empty(shape=[self.dataset.test_set_size , self.ensemble_size], dtype=np.int32)
         test_dnn_predictions_prob = np.empty(shape=[self.dataset.test_set_size , self.ensemble_size, self.num_classes], dtype=np.float32)
 
-        self.log.info("Start loading entire ensemble features from disk")
+        self.log.info("Start loading entire ensemble features")
         for i in xrange(self.ensemble_size):
+            if not self.load_from_disk:
+                self.log.info('loading model parameters for net #{}'.format(i))
+                self.saver.restore(self.plain_sess, self.checkpoint_file_list[i])
             X_train_features_i, \
             X_test_features_i, \
+            _, \
             test_dnn_predictions_prob_i, \
             y_train_i, \
-            y_test_i = self.fetch_dump_data_features(self.test_dir_list[i])
+            y_test_i = self.fetch_dump_data_features(test_dir=self.test_dir_list[i],
+                                                     checkpoint_path=self.checkpoint_file_list[i])
 
             X_train_features[:, i, :]          = X_train_features_i
             y_train[:, i]                      = y_train_i
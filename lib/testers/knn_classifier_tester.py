@@ -7,10 +7,11 @@ import numpy as np
 from tensorflow_TB.lib.testers.tester_base import TesterBase
 from sklearn.decomposition import PCA
 from sklearn.neighbors import KNeighborsClassifier
-from sklearn.svm import LinearSVC, SVC
+from tensorflow_TB.lib.knn import MultiKNeighborsClassifier
+from tensorflow_TB.lib.linear_probe import LinearProbeClassifier
 from sklearn.linear_model import LogisticRegression
 from sklearn.metrics import normalized_mutual_info_score
-from tensorflow_TB.utils.misc import collect_features, calc_mutual_agreement, calc_psame
+from tensorflow_TB.utils.misc import collect_features, mc_dropout, calc_mutual_agreement, calc_psame
 from scipy.stats import entropy
 
 eps = 0.000001
@@ -53,18 +54,20 @@ class KNNClassifierTester(TesterBase):
             n_jobs=self.knn_jobs,
             algorithm='brute')
 
-        self.knn_train = KNeighborsClassifier(
-            n_neighbors=self.knn_neighbors + 1,
+        # leave-one-out knn for the training set
+        self.knn_train = MultiKNeighborsClassifier(
+            name='knn_train',
+            k_list=[self.knn_neighbors],
             weights=self.knn_weights,
             p=int(self.knn_norm[-1]),
             n_jobs=self.knn_jobs,
-            algorithm='brute')
+            batch_size=self.eval_batch_size)
 
-        self.svm = SVC(
-            kernel='linear',
-            probability=True,
-            random_state=self.rand_gen,
-            tol=self.svm_tolerance)
+        self.svm = LinearProbeClassifier(
+            name='svm',
+            loss='hinge',
+            tol=self.svm_tolerance,
+            random_state=self.rand_gen)
 
         self.lr = LogisticRegression(
             penalty=self.knn_norm.lower(),
@@ -72,8 +75,12 @@ class KNNClassifierTester(TesterBase):
             random_state=self.rand_gen,
             n_jobs=self.knn_jobs)
 
-    def fetch_dump_data_features(self, layer_name=None, test_dir=None):
-        """Optionally fetching precomputed train/test features, and labels."""
+    def fetch_dump_data_features(self, layer_name=None, test_dir=None, checkpoint_path=None):
+        """Optionally fetching precomputed train/test features, and labels.
+        :param layer_name: layer to collect. Default: self.tested_layer
+        :param test_dir: dir of the LOAD_FROM_DISK/DUMP_NET .npy files. Default: self.test_dir
+        :param checkpoint_path: the checkpoint restored in the session (feature store key)
+        """
         if layer_name is None:
             layer_name = self.tested_layer
         if test_dir is None:
@@ -100,19 +107,11 @@ class KNNClassifierTester(TesterBase):
                 dataset_name = 'train_eval'
             self.log.info('Collecting {} samples for training from layer: {} from dataset: {}'.format(self.dataset.train_set_size, layer_name, dataset_name))
             (X_train_features, y_train, train_dnn_predictions_prob) = \
-                collect_features(
-                    agent=self,
-                    dataset_name=dataset_name,
-                    fetches=[self.model.net[layer_name], self.model.labels, self.model.predictions_prob],
-                    feed_dict={self.model.dropout_keep_prob: 1.0})
+                self.fetch_features(dataset_name, layer_name, checkpoint_path)
             dataset_name = 'test'
             self.log.info('Collecting {} samples for testing from layer: {} from dataset: {}'.format(self.dataset.test_set_size, layer_name, dataset_name))
             (X_test_features, y_test, test_dnn_predictions_prob) = \
-                collect_features(
-                    agent=self,
-                    dataset_name=dataset_name,
-                    fetches=[self.model.net[layer_name], self.model.labels, self.model.predictions_prob],
-                    feed_dict={self.model.dropout_keep_prob: 1.0})
+                self.fetch_features(dataset_name, layer_name, checkpoint_path)
 
         if self.dump_net:
             self.log.info('Dumping train features into disk:\n{}\n{}\n{}\n{}\n{}'
@@ -126,6 +125,30 @@ class KNNClassifierTester(TesterBase):
 
         return X_train_features, X_test_features, train_dnn_predictions_prob, test_dnn_predictions_prob, y_train, y_test
 
+    def collect_mc_dropout_features(self, dataset_name, keep_prob, num_samples):
+        """Collecting Monte-Carlo dropout samples of the embedding layer.
+        The network runs once to collect the pre-dropout features, and the dropout masks are drawn in numpy.
+        Models without a pre_dropout layer fall back to running the network num_samples times.
+        :param dataset_name: e.g. 'test'
+        :param keep_prob: dropout keep probability
+        :param num_samples: number of stochastic samples
+        :return: generator of num_samples np.ndarray ([dataset_size, embedding_dims]), produced one at a time
+        """
+        if 'pre_dropout' not in self.model.net:
+            self.log.info('model has no pre_dropout layer. Running the network {} times'.format(num_samples))
+            return (collect_features(
+                agent=self,
+                dataset_name=dataset_name,
+                fetches=[self.model.net['embedding_layer']],
+                feed_dict={self.model.dropout_keep_prob: keep_prob})[0] for _ in range(num_samples))
+
+        (pre_dropout_features,) = collect_features(
+            agent=self,
+            dataset_name=dataset_name,
+            fetches=[self.model.net['pre_dropout']])
+        return mc_dropout(pre_dropout_features, keep_prob, num_samples,
+                          normalize=self.model.normalize_embedding, rand_gen=self.rand_gen)
+
     def apply_pca(self, X, fit=False):
         """If pca_reduction is True, apply PCA reduction"""
         if self.pca_reduction:
@@ -135,32 +158,6 @@ class KNNClassifierTester(TesterBase):
             X = self.pca.transform(X)
         return X
 
-    def knn_predict_proba_for_trainset(self, model, X_train_features, y_train):
-        """
-        :param model: knn_train
-        :param X_train_features: Training set features ([n_samples, n_features])
-        :param y_train: training set gt ([n_samples])
-        :return: knn predictions of the training set, using an efficient leave-one-out.
-        """
-        biased_knn_predictions_prob_train = model.predict_proba(X_train_features)
-        knn_predictions_prob_train = np.zeros(biased_knn_predictions_prob_train.shape)
-
-        for i in range(len(X_train_features)):
-            y = int(y_train[i])
-            proba = biased_knn_predictions_prob_train[i]
-            # assert proba[y] >= 1/(self.knn_neighbors + 1), "for i={}: prob[y={}] = {}, but cannot be smaller than {}"\
-            #     .format(i, y, proba[y], 1/(self.knn_neighbors + 1))
-            if proba[y] >= 1/(self.knn_neighbors + 1):
-                proba[y] -= 1/(self.knn_neighbors + 1)
-                proba *= (self.knn_neighbors + 1)/self.knn_neighbors
-            else:
-                self.log.warn("for i={}: prob[y={}] = {}, but cannot be smaller than {}. Just warning."\
-                    .format(i, y, proba[y], 1/(self.knn_neighbors + 1)))
-            assert np.isclose(sum(proba), 1.0), "sum of proba[i={}] is {} instead of 1.0".format(i, sum(proba))
-            knn_predictions_prob_train[i] = proba
-
-        return knn_predictions_prob_train
-
     def test(self):
         X_train_features, \
         X_test_features, \
@@ -361,7 +358,7 @@ class KNNClassifierTester(TesterBase):
             y_pred_lr = y_prob_lr.argmax(axis=1)
             lr_score = np.average(y_train == y_pred_lr)
             self.log.info('Predicting train labels from KNN model...')
-            y_prob_knn = self.knn_predict_proba_for_trainset(self.knn_train, X_train_features, y_train)
+            y_prob_knn = self.knn_train.predict_proba_fit_set_loo()[self.knn_neighbors]
             y_pred_knn = y_prob_knn.argmax(axis=1)
             knn_score = np.average(y_train == y_pred_knn)
 
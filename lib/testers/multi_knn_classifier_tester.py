@@ -4,7 +4,7 @@ from __future__ import print_function
 
 import numpy as np
 from tensorflow_TB.lib.testers.knn_classifier_tester import KNNClassifierTester
-from sklearn.neighbors import KNeighborsClassifier
+from tensorflow_TB.lib.knn import MultiKNeighborsClassifier
 from scipy.stats import entropy
 from tensorflow_TB.utils.misc import calc_psame
 
@@ -28,27 +28,17 @@ class MultiKNNClassifierTester(KNNClassifierTester):
         num_of_samples_in_a_class = int(self.prm.dataset.TRAIN_SET_SIZE / self.prm.network.NUM_CLASSES)
         self.k_list = [k for k in self.k_list if k <= num_of_samples_in_a_class]
 
-        # constructing the knn classifiers:
-        self.knn_dict = {}
-        for k in self.k_list:
-            self.knn_dict[k] = KNeighborsClassifier(
-                n_neighbors=k,
-                weights=self.knn_weights,
-                p=int(self.knn_norm[-1]),
-                n_jobs=self.knn_jobs
-            )
+        # constructing one knn classifier for all the k values. It queries the neighbors only once, for max(k_list)
+        self.multi_knn = MultiKNeighborsClassifier(
+            name='multi_knn',
+            k_list=self.k_list,
+            weights=self.knn_weights,
+            p=int(self.knn_norm[-1]),
+            n_jobs=self.knn_jobs,
+            batch_size=self.eval_batch_size)
 
         self.pre_cstr = 'knn/'
 
-    def predict_proba(self, X, model):
-        """
-        Predict probability of labels for X using the model
-        :param X: input, np.ndarray
-        :param model: scikit-learn model
-        :return: labels probability, np.ndarray
-        """
-        return model.predict_proba(X)
-
     def test(self):
         X_train_features, \
         X_test_features, \
@@ -60,10 +50,8 @@ class MultiKNNClassifierTester(KNNClassifierTester):
         X_train_features = self.apply_pca(X_train_features, fit=True)
         X_test_features = self.apply_pca(X_test_features, fit=False)
 
-        # fitting knn models
-        for k in self.k_list:
-            self.log.info('Fitting KNN model for k={}...'.format(k))
-            self.knn_dict[k].fit(X_train_features, y_train)
+        self.log.info('Fitting KNN model for k={}...'.format(self.k_list))
+        self.multi_knn.fit(X_train_features, y_train)
 
         self.log.info('Predicting test set labels from DNN model...')
         y_pred_dnn = test_dnn_predictions_prob.argmax(axis=1)
@@ -78,31 +66,31 @@ class MultiKNNClassifierTester(KNNClassifierTester):
         self.tb_logger_test.log_scalar('dnn_confidence_avg'   , confidence_avg   , self.global_step)
         self.tb_logger_test.log_scalar('dnn_confidence_median', confidence_median, self.global_step)
 
-        # now iterating over the knn models
+        self.log.info('Predicting {} labels for dataset test using knn model with k={} and norm={}...'
+                      .format(y_test.shape[0], self.k_list, self.knn_norm))
+        pred_proba = self.multi_knn.predict_proba(X_test_features)
+
+        # now iterating over the k values
         for k in self.k_list:
             self.process(
-                model=self.knn_dict[k],
+                k=k,
                 dataset_name='test',
-                X=X_test_features,
+                predictions_prob=pred_proba[k],
                 y=y_test,
                 dnn_predictions_prob=test_dnn_predictions_prob)
 
         self.summary_writer_test.flush()
 
-    def process(self, model, dataset_name, X, y, dnn_predictions_prob):
+    def process(self, k, dataset_name, predictions_prob, y, dnn_predictions_prob):
         """
-        :param model: A fitted model name to predict and save metrics for
+        :param k: number of neighbors that predicted predictions_prob
         :param dataset_name: 'test' or 'train'
-        :param X: dataset, features.
+        :param predictions_prob: knn predictions probabilities on the dataset
         :param y: labels
         :param dnn_predictions_prob: dnn predictions on the dataset
         :return: None. Saves metrics.
         """
         y_pred_dnn = dnn_predictions_prob.argmax(axis=1)
-
-        self.log.info('Predicting {} labels for dataset {} using knn model with k={} and norm=L{}\n {}...'
-                      .format(y.shape[0], dataset_name, model.n_neighbors, model.p, str(model)))
-        predictions_prob = self.predict_proba(X, model)
         y_pred = predictions_prob.argmax(axis=1)
 
         # calculate metrics
@@ -137,7 +125,7 @@ class MultiKNNClassifierTester(KNNClassifierTester):
             suffix = ''
         else:
             suffix = '_trainset'
-        cstr = self.pre_cstr + 'k={}/norm=L{}/'.format(model.n_neighbors, model.p)
+        cstr = self.pre_cstr + 'k={}/norm=L{}/'.format(k, self.multi_knn.p)
 
         self.tb_logger_test.log_scalar(cstr + 'knn_score'             + suffix, score            , self.global_step)
         self.tb_logger_test.log_scalar(cstr + 'knn_psame'             + suffix, psame            , self.global_step)
@@ -26,7 +26,7 @@ class MultiLayerKNNClassifierTester(KNNClassifierTester):
             super(MultiLayerKNNClassifierTester, self).test()
         self.log.info('Tester {} is done'.format(str(self)))
 
-    def fetch_dump_data_features(self, layer_name=None, test_dir=None):
+    def fetch_dump_data_features(self, layer_name=None, test_dir=None, checkpoint_path=None):
         layer_name = self.tested_layer
         self.log.info('Start collecting samples for layer {}'.format(layer_name))
         layer_desc = layer_name
@@ -34,7 +34,7 @@ class MultiLayerKNNClassifierTester(KNNClassifierTester):
             layer_desc = layer_desc + '_relu'
         if self.apply_gap:
             layer_desc = layer_desc + '_gap'
-        return super(MultiLayerKNNClassifierTester, self).fetch_dump_data_features(layer_name=layer_desc)
+        return super(MultiLayerKNNClassifierTester, self).fetch_dump_data_features(layer_name=layer_desc, test_dir=test_dir, checkpoint_path=checkpoint_path)
 
     def print_stats(self):
         '''print basic test parameters'''
@@ -7,6 +7,8 @@ from tensorflow_TB.lib.base.agent import Agent
 import tensorflow as tf
 import os
 from tensorflow_TB.utils.tensorboard_logging import TBLogger
+from tensorflow_TB.lib.feature_store import FeatureStore, file_digest
+from tensorflow_TB.utils.misc import collect_features
 
 class TesterBase(Agent):
     __metaclass__ = ABCMeta
@@ -21,6 +23,11 @@ class TesterBase(Agent):
         self.checkpoint_file = self.prm.test.test_control.CHECKPOINT_FILE
         self.dump_net        = self.prm.test.test_control.DUMP_NET
         self.load_from_disk  = self.prm.test.test_control.LOAD_FROM_DISK
+        self.feature_store_dir = self.prm.test.test_control.FEATURE_STORE_DIR
+
+        self.feature_store = None
+        if self.feature_store_dir is not None:
+            self.feature_store = FeatureStore('FeatureStore', self.feature_store_dir)
 
     @abstractmethod
     def test(self):
@@ -46,7 +53,36 @@ class TesterBase(Agent):
         self.log.info(' CHECKPOINT_FILE: {}'.format(self.checkpoint_file))
         self.log.info(' DUMP_NET: {}'.format(self.dump_net))
         self.log.info(' LOAD_FROM_DISK: {}'.format(self.load_from_disk))
+        self.log.info(' FEATURE_STORE_DIR: {}'.format(self.feature_store_dir))
 
     def finalize_graph(self):
         self.saver.restore(self.plain_sess, os.path.join(self.checkpoint_dir, self.checkpoint_file))
         super(TesterBase, self).finalize_graph()
+
+    def fetch_features(self, dataset_name, layer_name, checkpoint_path=None):
+        """Collecting the layer features, labels and DNN predictions of a dataset split.
+        If the feature store is enabled, the forward pass runs only on a store miss.
+        :param dataset_name: dataset split, e.g. 'train_eval' or 'test'
+        :param layer_name: name of the layer in model.net
+        :param checkpoint_path: the checkpoint restored in the session. Default: CHECKPOINT_DIR/CHECKPOINT_FILE
+        :return: features, labels, predictions_prob
+        """
+        def compute_fn():
+            return collect_features(
+                agent=self,
+                dataset_name=dataset_name,
+                fetches=[self.model.net[layer_name], self.model.labels, self.model.predictions_prob],
+                feed_dict={self.model.dropout_keep_prob: 1.0})
+
+        if self.feature_store is None:
+            return compute_fn()
+
+        if checkpoint_path is None:
+            checkpoint_path = os.path.join(self.checkpoint_dir, self.checkpoint_file)
+        key = self.feature_store.get_key(checkpoint_path, layer_name, dataset_name,
+                                         dataset=self.dataset.dataset_name,
+                                         train_set_size=self.dataset.train_set_size,
+                                         validation_set_size=self.dataset.validation_set_size)
+        if dataset_name != 'test' and self.dataset.train_validation_map_ref is not None:
+            key['train_validation_map'] = file_digest(self.dataset.train_validation_map_ref)
+        return self.feature_store.fetch(key, ['features', 'labels', 'predictions_prob'], compute_fn)
@@ -0,0 +1,98 @@
+'''Vectorized acquisition scores for active learning selection. All the scores operate on whole [N, C] probability
+matrices and return [N] vectors where a higher score means a more informative (uncertain) sample'''
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+
+
+def chunked(score_fn, chunk_size=None):
+    """
+    Wrapping a score function to process its [N, C] inputs chunk by chunk, bounding the temporary memory
+    :param score_fn: function of one or more [N, C] arrays, returning [N] scores
+    :param chunk_size: number of rows in every chunk. None to process all the rows at once
+    :return: function with the same signature
+    """
+    def wrapper(*arrays):
+        if chunk_size is None:
+            return score_fn(*arrays)
+        num_samples = arrays[0].shape[0]
+        score = np.empty(shape=num_samples, dtype=np.float32)
+        for b in range(0, num_samples, chunk_size):
+            e = min(b + chunk_size, num_samples)
+            score[b:e] = score_fn(*[arr[b:e] for arr in arrays])
+        return score
+    return wrapper
+
+
+def assert_same_shape(y_pred_knn, y_pred_dnn, log=None):
+    if y_pred_knn.shape != y_pred_dnn.shape:
+        err_str = 'y_pred_knn.shape != y_pred_dnn.shape ({}!={})'.format(y_pred_knn.shape, y_pred_dnn.shape)
+        if log is not None:
+            log.error(err_str)
+        raise AssertionError(err_str)
+
+
+def least_confidence_score(y_pred):
+    """
+    :param y_pred: probabilities ([N, C])
+    :return: 1 - max probability
+    """
+    return (1 - y_pred.max(axis=1)).astype(np.float32)
+
+
+def margin_score(y_pred):
+    """
+    :param y_pred: probabilities ([N, C])
+    :return: 1 - (difference between the two highest probabilities)
+    """
+    top2 = np.partition(y_pred, y_pred.shape[1] - 2, axis=1)[:, -2:]
+    return (1 - (top2[:, 1] - top2[:, 0])).astype(np.float32)
+
+
+def entropy_score(y_pred, eps=1e-15):
+    """
+    :param y_pred: probabilities ([N, C])
+    :param eps: clipping of the probabilities before the log
+    :return: entropy of every row
+    """
+    return (-np.sum(y_pred * np.log(np.clip(y_pred, eps, 1.0)), axis=1)).astype(np.float32)
+
+
+def max_product_score(y_pred_knn, y_pred_dnn):
+    """
+    Multiplication of the highest DNN probability with the corresponding KNN probability
+    :param y_pred_knn: KNN probabilities ([N, C])
+    :param y_pred_dnn: DNN probabilities ([N, C])
+    :return: 1 - dnn_max * knn[dnn_argmax]
+    """
+    assert_same_shape(y_pred_knn, y_pred_dnn)
+    dnn_max_ind = y_pred_dnn.argmax(axis=1)
+    rows = np.arange(y_pred_dnn.shape[0])
+    return (1 - y_pred_dnn[rows, dnn_max_ind] * y_pred_knn[rows, dnn_max_ind]).astype(np.float32)
+
+
+def correlation_score(y_pred_knn, y_pred_dnn):
+    """
+    :param y_pred_knn: KNN probabilities ([N, C])
+    :param y_pred_dnn: DNN probabilities ([N, C])
+    :return: minus the correlation (inner product) of every two prediction vectors
+    """
+    assert_same_shape(y_pred_knn, y_pred_dnn)
+    return (-np.einsum('ij,ij->i', y_pred_knn, y_pred_dnn)).astype(np.float32)
+
+
+def expected_cross_entropy_score(y_weights, y_pred, eps=1e-15):
+    """
+    Cross entropy of y_pred, averaged over the true classes with weights y_weights:
+    sum_c y_weights[c] * log_loss(one_hot(c), y_pred), with sklearn's log_loss clipping and normalization
+    :param y_weights: class weights, e.g. KNN probabilities ([N, C])
+    :param y_pred: predicted probabilities, e.g. DNN probabilities ([N, C])
+    :param eps: clipping of the predicted probabilities
+    :return: expected cross entropy of every row
+    """
+    assert_same_shape(y_weights, y_pred)
+    y_pred = np.clip(y_pred.astype(np.float64), eps, 1 - eps)
+    y_pred /= y_pred.sum(axis=1, keepdims=True)
+    return (-np.einsum('ij,ij->i', y_weights, np.log(y_pred))).astype(np.float32)
@@ -3,9 +3,15 @@ from __future__ import division
 from __future__ import print_function
 
 from tensorflow_TB.utils.misc import collect_features
+from tensorflow_TB.lib.trainers.active_learning.acquisition_scores import chunked, assert_same_shape, \
+    least_confidence_score, margin_score, entropy_score, max_product_score, expected_cross_entropy_score
+# aliased: correlation_score(agent, ...) below wraps it
+from tensorflow_TB.lib.trainers.active_learning.acquisition_scores import correlation_score as \
+    acquisition_correlation_score
 from sklearn.neighbors import KNeighborsClassifier
 import numpy as np
-import operator
+
+SCORE_CHUNK_SIZE = 10000  # rows of the probability matrices to score at once
 
 def random_sampler(agent):
     """
@@ -186,6 +192,79 @@ def min_corr_following_most_uncertained(agent):
     best_unpool_indices.sort()
     return best_unpool_indices
 
+def most_uncertained_dnn_entropy(agent):
+    """
+    :param agent: An active learning trainer
+    :return: list of indices
+    """
+    return most_uncertained_dnn_by_score(agent, entropy_score)
+
+def most_uncertained_dnn_margin(agent):
+    """
+    :param agent: An active learning trainer
+    :return: list of indices
+    """
+    return most_uncertained_dnn_by_score(agent, margin_score)
+
+def max_expected_cross_entropy(agent):
+    """
+    Selecting the samples with the highest DNN cross entropy, averaged over the classes with the KNN probabilities
+    :param agent: An active learning trainer
+    :return: list of indices
+    """
+    unpool_indices = agent.dataset.get_all_unpool_train_indices()
+    estimated_labels_vec, unpool_predictions_vec = knn_and_dnn_unpool_predictions(agent)
+
+    agent.log.info('Calculating the expected cross entropy scores of the DNN predictions')
+    ce_vec = chunked(expected_cross_entropy_score, SCORE_CHUNK_SIZE)(estimated_labels_vec, unpool_predictions_vec)
+    best_unpool_indices = np.take(unpool_indices, ce_vec.argsort()[-agent.dataset.clusters:])
+    best_unpool_indices.sort()
+    return best_unpool_indices
+
+def most_uncertained_dnn_by_score(agent, score_fn):
+    """
+    :param agent: An active learning trainer
+    :param score_fn: acquisition score of the DNN predictions (see acquisition_scores)
+    :return: list of indices
+    """
+    unpool_indices = agent.dataset.get_all_unpool_train_indices()
+
+    (unpool_predictions_vec, ) = \
+        collect_features(agent=agent,
+                         dataset_name='train_unpool_eval',
+                         fetches=[agent.model.predictions_prob],
+                         feed_dict={agent.model.dropout_keep_prob: 1.0})
+
+    agent.log.info('Calculating the {} scores based on the DNN output'.format(score_fn.__name__))
+    mu_vec = chunked(score_fn, SCORE_CHUNK_SIZE)(unpool_predictions_vec)
+    best_unpool_indices = np.take(unpool_indices, mu_vec.argsort()[-agent.dataset.clusters:])
+    best_unpool_indices.sort()
+    return best_unpool_indices
+
+def knn_and_dnn_unpool_predictions(agent):
+    """
+    :param agent: An active learning trainer
+    :return: KNN (fitted on the pooled train features) and DNN probabilities of the unpooled train samples
+    """
+    pool_features_vec, pool_labels = \
+        collect_features(agent=agent,
+                         dataset_name='train_pool_eval',
+                         fetches=[agent.model.net['embedding_layer'], agent.model.labels],
+                         feed_dict={agent.model.dropout_keep_prob: 1.0})
+
+    unpool_features_vec, unpool_predictions_vec = \
+        collect_features(agent=agent,
+                         dataset_name='train_unpool_eval',
+                         fetches=[agent.model.net['embedding_layer'], agent.model.predictions_prob],
+                         feed_dict={agent.model.dropout_keep_prob: 1.0})
+
+    agent.log.info('building kNN space only for the labeled (pooled) train features')
+    nbrs = KNeighborsClassifier(n_neighbors=30, weights='uniform', p=1)
+    nbrs.fit(pool_features_vec, pool_labels)
+
+    agent.log.info('Calculating the estimated labels probability based on KNN')
+    return nbrs.predict_proba(unpool_features_vec), unpool_predictions_vec
+
 def mul_dnn_max_knn_same(agent, y_pred_knn, y_pred_dnn):
     """
     Calculates the uncertainty score based on the multiplication of the highest DNN probability with the
@@ -195,17 +274,8 @@ def mul_dnn_max_knn_same(agent, y_pred_knn, y_pred_dnn):
     :param y_pred_dnn: np.float32 array of all the predictions of the network
     :return: uncertainty score for every vector
     """
-    if y_pred_knn.shape != y_pred_dnn.shape:
-        err_str = 'y_pred_knn.shape != y_pred_dnn.shape ({}!={})'.format(y_pred_knn.shape, y_pred_dnn.shape)
-        agent.log.error(err_str)
-        raise AssertionError(err_str)
-
-    score = np.empty(shape=y_pred_knn.shape[0], dtype=np.float32)
-    for row in xrange(y_pred_knn.shape[0]):
-        dnn_max_ind, dnn_max_val = max(enumerate(y_pred_dnn[row]), key=operator.itemgetter(1))
-        knn_max_val              = y_pred_knn[row][dnn_max_ind]
-        score[row] = 1 - dnn_max_val * knn_max_val
-    return score
+    assert_same_shape(y_pred_knn, y_pred_dnn, agent.log)
+    return chunked(max_product_score, SCORE_CHUNK_SIZE)(y_pred_knn, y_pred_dnn)
 
 def uncertainty_score(agent, y_pred_dnn):
     """
@@ -214,7 +284,7 @@ def uncertainty_score(agent, y_pred_dnn):
     :param y_pred_dnn: np.float32 array of the DNN probability
     :return: uncertainty score for every vector
     """
-    return 1 - y_pred_dnn.max(axis=1)
+    return least_confidence_score(y_pred_dnn)
 
 def correlation_score(agent, y_pred_knn, y_pred_dnn):
     """
@@ -224,12 +294,5 @@ def correlation_score(agent, y_pred_knn, y_pred_dnn):
     :param y_pred_dnn: np.float32 array of the DNN probability
     :return: correlation for every two prediction vectors
     """
-    if y_pred_knn.shape != y_pred_dnn.shape:
-        err_str = 'y_pred_knn.shape != y_pred_dnn.shape ({}!={})'.format(y_pred_knn.shape, y_pred_dnn.shape)
-        agent.log.error(err_str)
-        raise AssertionError(err_str)
-
-    score = np.empty(shape=y_pred_knn.shape[0], dtype=np.float32)
-    for row in xrange(y_pred_knn.shape[0]):
-        score[row] = -np.correlate(y_pred_knn[row], y_pred_dnn[row])
-    return score
+    assert_same_shape(y_pred_knn, y_pred_dnn, agent.log)
+    return chunked(acquisition_correlation_score, SCORE_CHUNK_SIZE)(y_pred_knn, y_pred_dnn)
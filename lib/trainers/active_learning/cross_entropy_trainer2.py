@@ -3,10 +3,9 @@ from __future__ import division
 from __future__ import print_function
 
 from tensorflow_TB.lib.trainers.active_trainer import ActiveTrainer
-import numpy as np
+from tensorflow_TB.lib.trainers.active_learning.acquisition_scores import expected_cross_entropy_score
 # from sklearn.neighbors import NearestNeighbors
 from sklearn.neighbors import KNeighborsClassifier
-from sklearn.metrics import log_loss
 
 
 class CrossEntropyTrainer2(ActiveTrainer):
@@ -58,16 +57,4 @@ class CrossEntropyTrainer2(ActiveTrainer):
             self.log.error(err_str)
             raise AssertionError(err_str)
 
-        score = np.empty(shape=y_pred_knn.shape[0], dtype=np.float32)
-        cls_mat = np.eye(self.num_classes, dtype=np.int32)
-
-        for row in xrange(y_pred_knn.shape[0]):
-            loss = 0.0
-            y_pred = y_pred_dnn[row].reshape((1,-1))
-            for cls in xrange(self.num_classes):
-                cls_weight = y_pred_knn[row, cls]
-                cls_true   = cls_mat[cls].reshape([1,-1])
-                loss      += cls_weight * log_loss(cls_true, y_pred)
-            score[row] = loss
-
-        return score
+        return expected_cross_entropy_score(y_pred_knn, y_pred_dnn)
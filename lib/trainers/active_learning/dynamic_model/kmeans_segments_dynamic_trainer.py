@@ -3,11 +3,10 @@ from __future__ import division
 from __future__ import print_function
 
 import numpy as np
-from sklearn.cluster import KMeans
-from sklearn.metrics import log_loss
 from sklearn.neighbors import KNeighborsClassifier
 
 from lib.trainers.dynamic_model_trainer import DynamicModelTrainer
+from lib.trainers.active_learning.acquisition_scores import expected_cross_entropy_score
 
 
 class KMeansSegmentsDynamicTrainer(DynamicModelTrainer):
@@ -32,10 +31,7 @@ class KMeansSegmentsDynamicTrainer(DynamicModelTrainer):
         nbrs.fit(labeled_features_vec, labels)
 
         self.log.info('performing K-Means for the unlabeled train features. K=100')
-        KM = KMeans(n_clusters=100,
-                    n_init=10,
-                    random_state=self.rand_gen,
-                    n_jobs=10)
+        KM = self.get_segment_kmeans(n_clusters=100, min_cluster_size=10)
         KM.fit(unlabeled_features_vec)
 
         self.log.info('for each center, find 10 new most uncertained samples')
@@ -85,16 +81,4 @@ class KMeansSegmentsDynamicTrainer(DynamicModelTrainer):
             self.log.error(err_str)
             raise AssertionError(err_str)
 
-        score = np.empty(shape=y_pred_knn.shape[0], dtype=np.float32)
-        cls_mat = np.eye(self.num_classes, dtype=np.int32)
-
-        for row in xrange(y_pred_knn.shape[0]):
-            loss = 0.0
-            y_pred = y_pred_dnn[row].reshape((1,-1))
-            for cls in xrange(self.num_classes):
-                cls_weight = y_pred_knn[row, cls]
-                cls_true   = cls_mat[cls].reshape([1,-1])
-                loss      += cls_weight * log_loss(cls_true, y_pred)
-            score[row] = loss
-
-        return score
+        return expected_cross_entropy_score(y_pred_knn, y_pred_dnn)
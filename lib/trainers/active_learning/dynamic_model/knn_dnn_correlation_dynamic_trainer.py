@@ -2,10 +2,10 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
-import numpy as np
 from sklearn.neighbors import KNeighborsClassifier
 
 from lib.trainers.dynamic_model_trainer import DynamicModelTrainer
+from lib.trainers.active_learning.acquisition_scores import correlation_score
 
 
 class KnnDnnCorrelationDynamicTrainer(DynamicModelTrainer):
@@ -53,8 +53,4 @@ class KnnDnnCorrelationDynamicTrainer(DynamicModelTrainer):
             self.log.error(err_str)
             raise AssertionError(err_str)
 
-        score = np.empty(shape=y_pred_knn.shape[0], dtype=np.float32)
-        for row in xrange(y_pred_knn.shape[0]):
-            score[row] = -np.correlate(y_pred_knn[row], y_pred_dnn[row])
-
-        return score
+        return correlation_score(y_pred_knn, y_pred_dnn)
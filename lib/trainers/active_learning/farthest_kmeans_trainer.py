@@ -6,7 +6,6 @@ from __future__ import division
 from __future__ import print_function
 
 from tensorflow_TB.lib.trainers.active_trainer import ActiveTrainer
-from sklearn.cluster import KMeans
 import numpy as np
 
 
@@ -24,10 +23,7 @@ class FarthestKMeansTrainer(ActiveTrainer):
         unlabeled_vec_dict = dict(zip(range(unlabeled_features_vec.shape[0]), self.dataset.train_dataset.available_samples))
 
         self.log.info('performing K-Means for the labeled train features. K=100')
-        KM = KMeans(n_clusters=100,
-                    n_init=10,
-                    random_state=self.rand_gen,
-                    n_jobs=10)
+        KM = self.get_segment_kmeans(n_clusters=100)
         KM.fit(labeled_features_vec)
 
         self.log.info('for each center, find new farthest samples')
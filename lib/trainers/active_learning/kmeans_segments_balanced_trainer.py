@@ -9,9 +9,8 @@ from __future__ import division
 from __future__ import print_function
 
 from tensorflow_TB.lib.trainers.active_trainer import ActiveTrainer
-from sklearn.cluster import KMeans
+from tensorflow_TB.lib.trainers.active_learning.acquisition_scores import expected_cross_entropy_score
 from sklearn.neighbors import KNeighborsClassifier
-from sklearn.metrics import log_loss
 import numpy as np
 
 
@@ -37,10 +36,7 @@ class KMeansSegmentsBalancedTrainer(ActiveTrainer):
         nbrs.fit(labeled_features_vec, labels)
 
         self.log.info('performing K-Means for the unlabeled train features. K=100')
-        KM = KMeans(n_clusters=100,
-                    n_init=10,
-                    random_state=self.rand_gen,
-                    n_jobs=10)
+        KM = self.get_segment_kmeans(n_clusters=100)
         KM.fit(unlabeled_features_vec)
 
         self.log.info('for each center, find new uncertained samples')
@@ -122,16 +118,4 @@ class KMeansSegmentsBalancedTrainer(ActiveTrainer):
             self.log.error(err_str)
             raise AssertionError(err_str)
 
-        score = np.empty(shape=y_pred_knn.shape[0], dtype=np.float32)
-        cls_mat = np.eye(self.num_classes, dtype=np.int32)
-
-        for row in xrange(y_pred_knn.shape[0]):
-            loss = 0.0
-            y_pred = y_pred_dnn[row].reshape((1,-1))
-            for cls in xrange(self.num_classes):
-                cls_weight = y_pred_knn[row, cls]
-                cls_true   = cls_mat[cls].reshape([1,-1])
-                loss      += cls_weight * log_loss(cls_true, y_pred)
-            score[row] = loss
-
-        return score
+        return expected_cross_entropy_score(y_pred_knn, y_pred_dnn)
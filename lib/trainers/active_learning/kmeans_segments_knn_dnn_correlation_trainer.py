@@ -8,7 +8,7 @@ from __future__ import division
 from __future__ import print_function
 
 from tensorflow_TB.lib.trainers.active_trainer import ActiveTrainer
-from sklearn.cluster import KMeans
+from tensorflow_TB.lib.trainers.active_learning.acquisition_scores import correlation_score
 from sklearn.neighbors import KNeighborsClassifier
 import numpy as np
 
@@ -35,10 +35,7 @@ class KMeansSegmentsKnnDnnCorrelationTrainer(ActiveTrainer):
         nbrs.fit(labeled_features_vec, labels)
 
         self.log.info('performing K-Means for the unlabeled train features. K=100')
-        KM = KMeans(n_clusters=100,
-                    n_init=10,
-                    random_state=self.rand_gen,
-                    n_jobs=10)
+        KM = self.get_segment_kmeans(n_clusters=100)
         KM.fit(unlabeled_features_vec)
 
         self.log.info('for each center, find new uncertained samples')
@@ -120,8 +117,4 @@ class KMeansSegmentsKnnDnnCorrelationTrainer(ActiveTrainer):
             self.log.error(err_str)
             raise AssertionError(err_str)
 
-        score = np.empty(shape=y_pred_knn.shape[0], dtype=np.float32)
-        for row in xrange(y_pred_knn.shape[0]):
-            score[row] = -np.correlate(y_pred_knn[row], y_pred_dnn[row])
-
-        return score
+        return correlation_score(y_pred_knn, y_pred_dnn)
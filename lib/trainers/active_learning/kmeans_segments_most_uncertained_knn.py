@@ -3,7 +3,6 @@ from __future__ import division
 from __future__ import print_function
 
 from tensorflow_TB.lib.trainers.active_trainer import ActiveTrainer
-from sklearn.cluster import KMeans
 from sklearn.neighbors import KNeighborsClassifier
 from sklearn.metrics import log_loss
 import numpy as np
@@ -31,10 +30,7 @@ class KMeansSegmentsMostUncertainedKNNTrainer(ActiveTrainer):
         nbrs.fit(labeled_features_vec, labels)
 
         self.log.info('performing K-Means for the unlabeled train features. K=100')
-        KM = KMeans(n_clusters=100,
-                    n_init=10,
-                    random_state=self.rand_gen,
-                    n_jobs=10)
+        KM = self.get_segment_kmeans(n_clusters=100, min_cluster_size=10)
         KM.fit(unlabeled_features_vec)
 
         self.log.info('for each center, find 10 new most uncertained samples')
@@ -3,7 +3,7 @@ from __future__ import division
 from __future__ import print_function
 
 from tensorflow_TB.lib.trainers.active_trainer import ActiveTrainer
-import numpy as np
+from tensorflow_TB.lib.trainers.active_learning.acquisition_scores import correlation_score
 from sklearn.neighbors import KNeighborsClassifier
 
 class KnnDnnCorrelationTrainer(ActiveTrainer):
@@ -51,8 +51,4 @@ class KnnDnnCorrelationTrainer(ActiveTrainer):
             self.log.error(err_str)
             raise AssertionError(err_str)
 
-        score = np.empty(shape=y_pred_knn.shape[0], dtype=np.float32)
-        for row in xrange(y_pred_knn.shape[0]):
-            score[row] = -np.correlate(y_pred_knn[row], y_pred_dnn[row])
-
-        return score
+        return correlation_score(y_pred_knn, y_pred_dnn)
@@ -3,8 +3,8 @@ from __future__ import division
 from __future__ import print_function
 
 from tensorflow_TB.lib.trainers.classification_trainer import ClassificationTrainer
+from tensorflow_TB.lib.segment_kmeans import SegmentKMeans
 from sklearn.decomposition import PCA
-import tensorflow as tf
 
 class ActiveTrainer(ClassificationTrainer):
     """Implementing active trainer
@@ -28,7 +28,7 @@ class ActiveTrainer(ClassificationTrainer):
         self.steps_for_new_annotations = self.steps_for_new_annotations or []
         self.select_new_samples = self.Factories.get_active_selection_fn()
 
-        self._finalized_once = False
+        self.segment_kmeans = {}  # n_clusters -> SegmentKMeans, warm started between annotation rounds
 
     def train(self):
         while not self.sess.should_stop():
@@ -62,27 +62,9 @@ class ActiveTrainer(ClassificationTrainer):
         self.validation_retention.reset_memory()
 
     def update_graph(self):
-        """Resetting the graph and starting a new graph to update the dataset operations on the graph"""
-        tf.reset_default_graph()
-        train_validation_map_ref = self.dataset.train_validation_map_ref
-
-        self.model   = self.Factories.get_model()
-        self.dataset = self.Factories.get_dataset()
-        self.dataset.train_validation_map_ref = train_validation_map_ref
-        self.build()
-        self.log.info('Done restoring graph for global_step ({})'.format(self.global_step))
-
-    def finalize_graph(self):
-        """overwrite the global step on the graph"""
-        if self._finalized_once:
-            self.log.info('overwriting graph\'s value: global_step={}'.format(self.global_step))
-            self.plain_sess.run(self.model.assign_ops['global_step_ow'],
-                                feed_dict={self.model.global_step_ph: self.global_step})
-            self.dataset.set_handles(self.plain_sess)
-        else:
-            # restoring global_step
-            super(ActiveTrainer, self).finalize_graph()
-            self._finalized_once = True
+        """Updating the pool datasets on the graph in place with the new pool indices"""
+        self.dataset.refresh_pool(self.plain_sess)
+        self.log.info('Done updating the pool datasets for global_step ({})'.format(self.global_step))
 
     def print_stats(self):
         super(ActiveTrainer, self).print_stats()
@@ -111,6 +93,20 @@ class ActiveTrainer(ClassificationTrainer):
             raise AssertionError(err_str)
         return ret
 
+    def get_segment_kmeans(self, n_clusters, min_cluster_size=1):
+        """
+        :param n_clusters: number of clusters
+        :param min_cluster_size: minimal number of samples in every cluster
+        :return: mini-batch K-Means which is warm started from the centers of the previous annotation round
+        """
+        if n_clusters not in self.segment_kmeans:
+            self.segment_kmeans[n_clusters] = SegmentKMeans(
+                name='segment_kmeans_{}'.format(n_clusters),
+                n_clusters=n_clusters,
+                random_state=self.rand_gen)
+        self.segment_kmeans[n_clusters].min_cluster_size = min_cluster_size
+        return self.segment_kmeans[n_clusters]
+
     def init_weights(self):
         self.log.info('Start initializing weights in global step={}'.format(self.global_step))
         self.plain_sess.run(self.model.init_op)
@@ -123,8 +119,5 @@ class ActiveTrainer(ClassificationTrainer):
 
     def train_step(self):
         '''Implementing one training step'''
-        _, images, labels = self.dataset.get_mini_batch('train_pool', self.plain_sess)
         _ , self.global_step = self.sess.run([self.model.train_op, self.model.global_step],
-                                              feed_dict={self.model.images: images,
-                                                         self.model.labels: labels,
-                                                         self.model.is_training: True})
+                                              feed_dict=self.get_train_feed_dict('train_pool'))
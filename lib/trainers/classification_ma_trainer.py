@@ -37,11 +37,8 @@ class ClassificationMATrainer(ClassificationTrainer):
 
     def train_step(self):
         '''Implementing one training step'''
-        _ , images, labels = self.dataset.get_mini_batch(self.dnn_train_handle, self.plain_sess)
         _ , self.global_step = self.sess.run([self.model.train_op, self.model.global_step],
-                                              feed_dict={self.model.images: images,
-                                                         self.model.labels: labels,
-                                                         self.model.is_training: True})
+                                              feed_dict=self.get_train_feed_dict(self.dnn_train_handle))
 
     def test_step(self):
         '''Implementing one test step.'''
@@ -16,11 +16,24 @@ class ClassificationTrainer(TrainerBase):
 
     def train_step(self):
         '''Implementing one training step'''
-        _ , images, labels = self.dataset.get_mini_batch('train', self.plain_sess)
         _ , self.global_step = self.sess.run([self.model.train_op, self.model.global_step],
-                                              feed_dict={self.model.images: images,
-                                                         self.model.labels: labels,
-                                                         self.model.is_training: True})
+                                              feed_dict=self.get_train_feed_dict('train'))
+
+    def get_train_feed_dict(self, dataset_name):
+        """
+        Get the feed_dict for one training step on a dataset.
+        If graph_input is True the model pulls the minibatch from the iterator within the same session call,
+        therefore only the iterator handle is fed. Otherwise, the minibatch is fetched to numpy and fed back.
+        :param dataset_name: the name of the dataset, e.g. 'train', 'train_pool'
+        :return: feed_dict for the train_op
+        """
+        if self.graph_input:
+            return {self.dataset.handle: self.dataset.get_handle(dataset_name),
+                    self.model.is_training: True}
+        _ , images, labels = self.dataset.get_mini_batch(dataset_name, self.plain_sess)
+        return {self.model.images: images,
+                self.model.labels: labels,
+                self.model.is_training: True}
 
     def eval_step(self):
         '''Implementing one evaluation step.'''
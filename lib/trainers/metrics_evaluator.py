@@ -0,0 +1,326 @@
+'''Embedding metrics (KNN, SVM, LR) of ClassificationMetricsTrainer. The metrics are evaluated either in process, or in a
+background evaluator process that consumes embedding snapshots while the training continues.
+
+The background evaluator is started by MetricsEvaluatorProcess and runs:
+python -m tensorflow_TB.lib.trainers.metrics_evaluator <snapshot_dir>
+'''
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import sys
+import json
+import glob
+import time
+import logging
+import subprocess
+import numpy as np
+from sklearn.neighbors import KNeighborsClassifier
+from tensorflow_TB.lib.linear_probe import LinearProbeClassifier
+from sklearn.linear_model import LogisticRegression
+from sklearn.decomposition import PCA
+from scipy.stats import entropy
+from tensorflow_TB.lib.knn import MultiKNeighborsClassifier
+from tensorflow_TB.utils.misc import calc_mutual_agreement, calc_psame
+import tensorflow_TB.lib.logger.logger as logger
+
+eps = 0.000001
+
+CONFIG_FILE   = 'config.json'
+STOP_FILE     = 'STOP'
+SNAPSHOT_GLOB = 'step_*.npz'
+
+
+class MetricsEvaluator(object):
+    """Fitting KNN/SVM/LR models on the train embeddings and logging their test (and train) metrics to TBLogger"""
+
+    def __init__(self, name, tb_logger, rand_gen, pca_reduction, pca_embedding_dims, knn_neighbors, knn_norm,
+                 knn_weights, knn_jobs, svm_tolerance, collect_knn, collect_svm, collect_lr, eval_trainset,
+                 eval_batch_size):
+        """
+        :param name: name of the evaluator (for logging)
+        :param tb_logger: TBLogger of the test summaries
+        :param rand_gen: np.random.RandomState for the SVM, LR and PCA models
+        The rest of the parameters are the test_control/train_control parameters of ClassificationMetricsTrainer
+        """
+        self.name               = name
+        self.log                = logger.get_logger(name)
+        self.tb_logger          = tb_logger
+        self.pca_reduction      = pca_reduction
+        self.pca_embedding_dims = pca_embedding_dims
+        self.knn_neighbors      = knn_neighbors
+        self.collect_knn        = collect_knn
+        self.collect_svm        = collect_svm
+        self.collect_lr         = collect_lr
+        self.eval_trainset      = eval_trainset
+
+        self.knn = KNeighborsClassifier(
+            n_neighbors=knn_neighbors,
+            weights=knn_weights,
+            p=int(knn_norm[-1]),
+            n_jobs=knn_jobs)
+
+        # leave-one-out knn for the training set
+        self.knn_train = MultiKNeighborsClassifier(
+            name='knn_train',
+            k_list=[knn_neighbors],
+            weights=knn_weights,
+            p=int(knn_norm[-1]),
+            n_jobs=knn_jobs,
+            batch_size=eval_batch_size)
+
+        self.svm = LinearProbeClassifier(
+            name='svm',
+            loss='hinge',
+            tol=svm_tolerance,
+            random_state=rand_gen)
+
+        self.lr = LogisticRegression(
+            penalty=knn_norm.lower(),
+            dual=False,
+            random_state=rand_gen,
+            n_jobs=knn_jobs)
+
+        self.pca = PCA(n_components=pca_embedding_dims, random_state=rand_gen)
+
+    def __str__(self):
+        return self.name
+
+    def collected_models(self):
+        return [model_name for model_name, collect in [('knn', self.collect_knn), ('svm', self.collect_svm),
+                                                       ('lr', self.collect_lr)] if collect]
+
+    def apply_pca(self, X, fit=False):
+        """If pca_reduction is True, apply PCA reduction"""
+        if self.pca_reduction:
+            self.log.info('Reducing features_vec from {} dims to {} dims using PCA'.format(X.shape[1], self.pca_embedding_dims))
+            if fit:
+                self.pca.fit(X)
+            X = self.pca.transform(X)
+        return X
+
+    def process(self, model_name, dataset_name, X, y, dnn_predictions_prob, global_step):
+        """
+        :param model_name: A fitted model name to predict and save metrics for
+        :param dataset_name: 'test' or 'train'
+        :param X: dataset, features.
+        :param y: labels
+        :param dnn_predictions_prob: dnn predictions on the dataset
+        :param global_step: the training step of the embeddings
+        :return: None. Saves metrics.
+        """
+
+        if model_name == 'knn':
+            if dataset_name == 'test':
+                model = self.knn
+            else:
+                model = self.knn_train
+        elif model_name == 'svm':
+            model = self.svm
+        elif model_name == 'lr':
+            model = self.lr
+        else:
+            err_str = 'unknown model_name: {}'.format(model_name)
+            self.log.error(err_str)
+            raise AssertionError(err_str)
+
+        y_pred_dnn = dnn_predictions_prob.argmax(axis=1)
+
+        self.log.info('Predicting {} labels for dataset {} using model\n {}...'.format(y.shape[0], dataset_name, str(model)))
+        if model_name == 'knn' and dataset_name == 'train':
+            predictions_prob = model.predict_proba_fit_set_loo()[self.knn_neighbors]
+        else:
+            predictions_prob = model.predict_proba(X)
+        y_pred = predictions_prob.argmax(axis=1)
+
+        # calculate metrics
+        self.log.info('Calculate {} set scores for model_name {}...'.format(dataset_name, model_name))
+        score = np.average(y == y_pred)
+
+        self.log.info('Calculate ma/md and psame scores...')
+        ma_score, md_score = calc_mutual_agreement(y_pred_dnn, y_pred, y)
+        psame = calc_psame(y_pred_dnn, y_pred)
+
+        self.log.info('Calculate confidence scores...')
+        confidence = predictions_prob.max(axis=1)
+        confidence_avg    = np.average(confidence)
+        confidence_median = np.median(confidence)
+
+        self.log.info('Calculate KL divergences...')
+        np.place(predictions_prob, predictions_prob == 0.0, [eps])
+        kl_div  = entropy(dnn_predictions_prob, predictions_prob)
+        kl_div2 = entropy(predictions_prob, dnn_predictions_prob)
+        kl_div_avg  = np.average(kl_div)
+        kl_div2_avg = np.average(kl_div2)
+
+        if dataset_name == 'test':
+            suffix = ''
+        else:
+            suffix = '_trainset'
+        self.tb_logger.log_scalar(model_name + '_score'            + suffix, score            , global_step)
+        self.tb_logger.log_scalar(model_name + '_ma_score'         + suffix, ma_score         , global_step)
+        self.tb_logger.log_scalar(model_name + '_md_score'         + suffix, md_score         , global_step)
+        self.tb_logger.log_scalar(model_name + '_psame'            + suffix, psame            , global_step)
+        self.tb_logger.log_scalar(model_name + '_confidence_avg'   + suffix, confidence_avg   , global_step)
+        self.tb_logger.log_scalar(model_name + '_confidence_median'+ suffix, confidence_median, global_step)
+        self.tb_logger.log_scalar(model_name + '_kl_div_avg'       + suffix, kl_div_avg       , global_step)
+        self.tb_logger.log_scalar(model_name + '_kl_div2_avg'      + suffix, kl_div2_avg      , global_step)
+
+    def evaluate(self, global_step, X_train_features, y_train, train_dnn_predictions_prob,
+                 X_test_features, y_test, test_dnn_predictions_prob):
+        """
+        Fitting the models on the train embeddings and logging the metrics of the test (and train) set.
+        The DNN probabilities are expected without zeros (for the KL divergences)
+        :return: None
+        """
+        X_train_features = self.apply_pca(X_train_features, fit=True)
+        X_test_features  = self.apply_pca(X_test_features , fit=False)
+
+        # fittings
+        if self.collect_knn:
+            self.log.info('Fitting KNN model...')
+            self.knn.fit(X_train_features, y_train)
+        if self.collect_svm:
+            self.log.info('Fitting SVM model (SVM tol={})...'.format(self.svm.tol))
+            self.svm.fit(X_train_features, y_train)
+        if self.collect_lr:
+            self.log.info('Fitting Logistic Regression model...')
+            self.lr.fit(X_train_features, y_train)
+
+        for model_name in self.collected_models():
+            self.process(model_name=model_name,
+                         dataset_name='test',
+                         X=X_test_features,
+                         y=y_test,
+                         dnn_predictions_prob=test_dnn_predictions_prob,
+                         global_step=global_step)
+
+        if self.eval_trainset:
+            if self.collect_knn:
+                self.log.info('Fitting KNN model for training set...')
+                self.knn_train.fit(X_train_features, y_train)
+
+            for model_name in self.collected_models():
+                self.process(model_name=model_name,
+                             dataset_name='train',
+                             X=X_train_features,
+                             y=y_train,
+                             dnn_predictions_prob=train_dnn_predictions_prob,
+                             global_step=global_step)
+
+
+class MetricsEvaluatorProcess(object):
+    """
+    Client of a background evaluator process. Every submit() writes an embeddings snapshot to snapshot_dir, which the
+    evaluator evaluates (in global_step order), logs to the test summaries and deletes.
+    """
+
+    def __init__(self, name, snapshot_dir, config, max_pending=2, poll_secs=5):
+        """
+        :param name: name of the client (for logging)
+        :param snapshot_dir: directory of the snapshots, the evaluator config and its log
+        :param config: dictionary of the MetricsEvaluator parameters (except name, tb_logger and rand_gen), with the
+                       additional 'test_dir' (summaries dir) and 'seed' (for rand_gen) keys. The pid of this process
+                       is added as 'parent_pid', so the evaluator exits if the trainer dies without calling close()
+        :param max_pending: submit() waits while this many snapshots are not evaluated yet, bounding the disk usage
+        :param poll_secs: seconds between polling the pending snapshots
+        """
+        self.name         = name
+        self.log          = logger.get_logger(name)
+        self.snapshot_dir = snapshot_dir
+        self.max_pending  = max_pending
+        self.poll_secs    = poll_secs
+
+        if not os.path.exists(self.snapshot_dir):
+            os.makedirs(self.snapshot_dir)
+        if os.path.isfile(os.path.join(self.snapshot_dir, STOP_FILE)):
+            os.remove(os.path.join(self.snapshot_dir, STOP_FILE))
+        config = dict(config, parent_pid=os.getpid())
+        with open(os.path.join(self.snapshot_dir, CONFIG_FILE), 'w') as f:
+            json.dump(config, f, sort_keys=True, indent=2)
+
+        # the evaluator only runs sklearn/numpy. It must not grab the training GPUs
+        env = os.environ.copy()
+        env['CUDA_VISIBLE_DEVICES'] = ''
+        self.log_file = open(os.path.join(self.snapshot_dir, 'evaluator.log'), 'a')
+        self.process = subprocess.Popen([sys.executable, '-m', 'tensorflow_TB.lib.trainers.metrics_evaluator',
+                                         self.snapshot_dir], env=env, stdout=self.log_file, stderr=subprocess.STDOUT)
+        self.log.info('started metrics evaluator process (pid={}) on {}'.format(self.process.pid, self.snapshot_dir))
+
+    def __str__(self):
+        return self.name
+
+    def pending(self):
+        return glob.glob(os.path.join(self.snapshot_dir, SNAPSHOT_GLOB))
+
+    def submit(self, global_step, **arrays):
+        """
+        :param global_step: the training step of the embeddings
+        :param arrays: the np.ndarray arguments of MetricsEvaluator.evaluate()
+        :return: None
+        """
+        if self.process.poll() is not None:
+            err_str = 'metrics evaluator process exited with code {}. See {}' \
+                .format(self.process.returncode, self.log_file.name)
+            self.log.error(err_str)
+            raise AssertionError(err_str)
+        while len(self.pending()) >= self.max_pending and self.process.poll() is None:
+            self.log.warning('metrics evaluator is behind ({} pending snapshots). Waiting...'.format(len(self.pending())))
+            time.sleep(self.poll_secs)
+
+        path = os.path.join(self.snapshot_dir, 'step_{:012d}.npz'.format(global_step))
+        with open(path + '.tmp', 'wb') as f:  # np.savez appends .npz to file names
+            np.savez(f, **arrays)
+        os.rename(path + '.tmp', path)
+
+    def close(self, wait=True):
+        """Asking the evaluator to stop after all the pending snapshots are evaluated"""
+        open(os.path.join(self.snapshot_dir, STOP_FILE), 'w').close()
+        if wait:
+            self.log.info('waiting for the metrics evaluator to finish {} pending snapshots'.format(len(self.pending())))
+            self.process.wait()
+        self.log_file.close()
+
+
+def main(snapshot_dir, poll_secs=5):
+    import tensorflow as tf
+    from tensorflow_TB.utils.tensorboard_logging import TBLogger
+
+    logging.basicConfig(level=logging.INFO)
+    with open(os.path.join(snapshot_dir, CONFIG_FILE)) as f:
+        config = json.load(f)
+
+    # a separate event file in the test summaries dir, so the metrics show under the same tags as the trainer's
+    summary_writer = tf.summary.FileWriter(config.pop('test_dir'), filename_suffix='.metrics_evaluator')
+    parent_pid = config.pop('parent_pid')
+    evaluator = MetricsEvaluator(name='metrics_evaluator',
+                                 tb_logger=TBLogger(summary_writer),
+                                 rand_gen=np.random.RandomState(config.pop('seed')),
+                                 **config)
+
+    while True:
+        snapshots = sorted(glob.glob(os.path.join(snapshot_dir, SNAPSHOT_GLOB)))
+        if not snapshots:
+            if os.path.isfile(os.path.join(snapshot_dir, STOP_FILE)):
+                break
+            # an orphan is re-parented, so a different parent pid means the trainer died without calling close()
+            if os.getppid() != parent_pid:
+                evaluator.log.warning('the trainer process (pid={}) is gone. Exiting'.format(parent_pid))
+                break
+            time.sleep(poll_secs)
+            continue
+        for path in snapshots:
+            global_step = int(os.path.basename(path)[len('step_'):-len('.npz')])
+            evaluator.log.info('evaluating the metrics of global_step={}'.format(global_step))
+            with np.load(path) as data:
+                arrays = {key: data[key] for key in data.files}
+            evaluator.evaluate(global_step, **arrays)
+            summary_writer.flush()
+            os.remove(path)
+
+    summary_writer.close()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1])
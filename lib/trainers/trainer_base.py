@@ -31,6 +31,7 @@ class TrainerBase(Agent):
         self.logger_steps          = self.prm.train.train_control.LOGGER_STEPS
         self.eval_steps            = self.prm.train.train_control.EVAL_STEPS
         self.test_steps            = self.prm.train.train_control.TEST_STEPS
+        self.graph_input           = self.prm.train.train_control.GRAPH_INPUT
 
         self.skip_first_evaluation = self.prm.train.train_control.SKIP_FIRST_EVALUATION
         if self.last_step is None:
@@ -47,6 +48,15 @@ class TrainerBase(Agent):
             self._activate_eval = True
             self._activate_test = True
 
+    def build_model_and_dataset(self):
+        """If graph_input is set, the dataset is built first and its iterator is wired to the model inputs"""
+        if self.graph_input:
+            self.dataset.build()
+            self.model.set_input_minibatch(self.dataset.next_minibatch)
+            self.model.build_graph()
+        else:
+            super(TrainerBase, self).build_model_and_dataset()
+
     def load_pretrained_from_ref(self):
         pass
 
@@ -142,6 +152,7 @@ class TrainerBase(Agent):
         self.log.info(' EVAL_STEPS: {}'.format(self.eval_steps))
         self.log.info(' TEST_STEPS: {}'.format(self.test_steps))
         self.log.info(' SKIP_FIRST_EVALUATION: {}'.format(self.skip_first_evaluation))
+        self.log.info(' GRAPH_INPUT: {}'.format(self.graph_input))
         self.log.info(' DEBUG_MODE: {}'.format(self.debug_mode))
         self.train_retention.print_stats()
         self.validation_retention.print_stats()
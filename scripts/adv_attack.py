@@ -32,6 +32,7 @@ from tensorflow_TB.lib.datasets.influence_feeder_val_test import MyFeederValTest
 import pickle
 from cleverhans.utils import random_targets
 from cleverhans.evaluation import batch_eval
+from tensorflow_TB.utils.work_queue import Manifest, shard, file_lock
 
 FLAGS = flags.FLAGS
 
@@ -39,6 +40,10 @@ flags.DEFINE_integer('batch_size', 100, 'Size of training batches')
 flags.DEFINE_string('dataset', 'cifar10', 'datasset: cifar10/100 or svhn')
 flags.DEFINE_string('set', 'val', 'val or test set to evaluate')
 flags.DEFINE_string('attack', 'cw_nnif', 'adversarial attack: deepfool, jsma, cw, cw_nnif')
+flags.DEFINE_bool('prepare', False, 'only calculate the attack inputs (targets, predictions, helpful/harmful embeddings)')
+flags.DEFINE_integer('shard', -1, 'index of this worker shard (see adv_attack_scheduler.py). -1 for no sharding')
+flags.DEFINE_integer('num_shards', 1, 'total number of worker shards')
+flags.DEFINE_integer('chunk_size', 500, 'number of samples in every resumable chunk of the attack')
 
 flags.DEFINE_string('mode', 'null', 'to bypass pycharm bug')
 flags.DEFINE_string('port', 'null', 'to bypass pycharm bug')
@@ -130,6 +135,12 @@ if TARGETED:
 if not os.path.exists(attack_dir):
     os.makedirs(attack_dir)
 
+helpful_npy_path = os.path.join(attack_dir, '{}_most_helpful.npy'.format(FLAGS.set))
+harmful_npy_path = os.path.join(attack_dir, '{}_most_harmful.npy'.format(FLAGS.set))
+if FLAGS.shard != -1 and not FLAGS.prepare and not os.path.exists(helpful_npy_path):
+    # the attack inputs below are random/expensive. They must be calculated once, before the workers start
+    raise AssertionError('{} does not exist. Run with --prepare first'.format(helpful_npy_path))
+
 mini_train_inds = None
 if USE_TRAIN_MINI:
     print('loading train mini indices from {}'.format(os.path.join(model_dir, 'train_mini_indices.npy')))
@@ -276,9 +287,6 @@ for i, set_ind in enumerate(feeder.test_inds):
 sub_relevant_indices = [ind for ind in info_tmp[FLAGS.set]]
 relevant_indices     = [info_tmp[FLAGS.set][ind]['global_index'] for ind in sub_relevant_indices]
 
-helpful_npy_path = os.path.join(attack_dir, '{}_most_helpful.npy'.format(FLAGS.set))
-harmful_npy_path = os.path.join(attack_dir, '{}_most_harmful.npy'.format(FLAGS.set))
-
 if not os.path.exists(helpful_npy_path):
     # loading the embedding vectors of all the val's/test's most harmful/helpful training examples
     most_helpful_list = []
@@ -350,8 +358,23 @@ else:
 # most_helpful = np.tile(most_helpful, [100, 1, 1])
 # most_harmful = np.tile(most_harmful, [100, 1, 1])
 
+if FLAGS.prepare:
+    print('attack inputs are ready in {}'.format(attack_dir))
+    exit(0)
+
+ADV_OUTPUTS      = ['X_{}_adv', 'x_{}_preds_adv', 'x_{}_features_adv']
+adv_output_paths = [os.path.join(attack_dir, name.format(FLAGS.set) + '.npy') for name in ADV_OUTPUTS]
+shards_dir       = os.path.join(attack_dir, '{}_shards'.format(FLAGS.set))
+manifest         = Manifest(os.path.join(attack_dir, '{}_attack_manifest.json'.format(FLAGS.set)))
+
+def save_atomic(path, arr):
+    tmp_path = '{}.tmp.{}'.format(path, os.getpid())
+    with open(tmp_path, 'wb') as f:  # np.save appends .npy to file names
+        np.save(f, arr)
+    os.rename(tmp_path, path)
+
 # initialize adversarial examples if necessary
-if not os.path.exists(os.path.join(attack_dir, 'X_{}_adv.npy'.format(FLAGS.set))):
+if not os.path.exists(adv_output_paths[0]):
     y_adv     = tf.placeholder(tf.float32, shape=(None, nb_classes), name='y_adv')
     m_help_ph = tf.placeholder(tf.float32, shape=(None,) + most_helpful.shape[1:])
     m_harm_ph = tf.placeholder(tf.float32, shape=(None,) + most_harmful.shape[1:])
@@ -381,13 +404,47 @@ if not os.path.exists(os.path.join(attack_dir, 'X_{}_adv.npy'.format(FLAGS.set))
     tf_outputs   = [adv_x, preds_adv, embeddings_adv]
     if FLAGS.set == 'val':
         numpy_inputs = [X_val, y_val, y_val_targets, most_helpful, most_harmful]
+        y_set_sparse = y_val_sparse
     elif FLAGS.set == 'test':
         numpy_inputs = [X_test, y_test, y_test_targets, most_helpful, most_harmful]
-
-    X_set_adv, x_set_preds_adv, x_set_features_adv = batch_eval(sess, tf_inputs, tf_outputs, numpy_inputs, FLAGS.batch_size)
-    x_set_preds_adv = x_set_preds_adv.astype(np.int32)
-    np.save(os.path.join(attack_dir, 'X_{}_adv.npy'.format(FLAGS.set))         , X_set_adv)
-    np.save(os.path.join(attack_dir, 'x_{}_preds_adv.npy'.format(FLAGS.set))   , x_set_preds_adv)
-    np.save(os.path.join(attack_dir, 'x_{}_features_adv.npy'.format(FLAGS.set)), x_set_features_adv)
+        y_set_sparse = y_test_sparse
+
+    # the index range is split to chunks, which are the units of work of the shards. Every finished chunk is saved
+    # to shards_dir and marked in the manifest, so a crashed run resumes from the unfinished chunks
+    set_size = numpy_inputs[0].shape[0]
+    chunks   = ['{}_{}'.format(b, min(b + FLAGS.chunk_size, set_size)) for b in range(0, set_size, FLAGS.chunk_size)]
+    if not os.path.exists(shards_dir):
+        os.makedirs(shards_dir)
+    my_chunks = chunks if FLAGS.shard == -1 else shard(chunks, FLAGS.shard, FLAGS.num_shards)
+
+    for chunk in manifest.pending(my_chunks):
+        b, e = [int(v) for v in chunk.split('_')]
+        print('attacking {} samples {}-{}'.format(FLAGS.set, b, e))
+        manifest.mark(chunk, 'running', shard=FLAGS.shard)
+        chunk_outputs = batch_eval(sess, tf_inputs, tf_outputs, [arr[b:e] for arr in numpy_inputs], FLAGS.batch_size)
+        chunk_outputs[1] = chunk_outputs[1].astype(np.int32)
+        for name, arr in zip(ADV_OUTPUTS, chunk_outputs):
+            save_atomic(os.path.join(shards_dir, '{}.{}.npy'.format(name.format(FLAGS.set), chunk)), arr)
+        # the do_eval accuracy of the chunk, merged below
+        manifest.mark(chunk, 'done', shard=FLAGS.shard, num_samples=e - b,
+                      num_correct=int(np.sum(chunk_outputs[1] == y_set_sparse[b:e])))
+
+    # the last worker to finish merges all the chunks into the monolithic outputs
+    state = manifest.load()
+    not_done = [chunk for chunk in chunks if state.get(chunk, {}).get('status') != 'done']
+    if not_done:
+        print('{} chunks are not done yet by other shards. Leaving the merge to them'.format(len(not_done)))
+    else:
+        with file_lock(adv_output_paths[0] + '.lock'):
+            if not os.path.exists(adv_output_paths[0]):
+                # the X_<set>_adv.npy file marks completion, so it is written last
+                for name, path in reversed(list(zip(ADV_OUTPUTS, adv_output_paths))):
+                    save_atomic(path, np.concatenate(
+                        [np.load(os.path.join(shards_dir, '{}.{}.npy'.format(name.format(FLAGS.set), chunk)))
+                         for chunk in chunks]))
+                print('merged {} chunks into {}'.format(len(chunks), adv_output_paths[0]))
+        acc = sum(state[chunk]['num_correct'] for chunk in chunks) / sum(state[chunk]['num_samples'] for chunk in chunks)
+        setattr(report, 'adv_' + FLAGS.set, acc)
+        print('Test accuracy on adversarial examples: %0.4f' % acc)
 else:
-    print('{} already exists'.format(os.path.join(attack_dir, 'X_{}_adv.npy'.format(FLAGS.set))))
+    print('{} already exists'.format(adv_output_paths[0]))
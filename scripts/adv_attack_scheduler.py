@@ -0,0 +1,47 @@
+"""Running adv_attack.py sharded over a local pool of worker processes.
+A single prepare process first calculates the shared attack inputs (targets, predictions, helpful/harmful
+embeddings). Then every worker attacks its chunks of the val/test set. Progress is tracked in
+<attack_dir>/<set>_attack_manifest.json, so re-running this script after a crash resumes only the unfinished chunks.
+The last worker to finish merges the chunks into X_<set>_adv.npy, x_<set>_preds_adv.npy and x_<set>_features_adv.npy
+
+Example:
+python tensorflow_TB/scripts/adv_attack_scheduler.py --dataset cifar10 --set test --attack cw_nnif \
+    --num_workers 8 --gpus 0,1,2,3
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import sys
+import argparse
+from tensorflow_TB.utils.work_queue import run_sharded
+
+parser = argparse.ArgumentParser(description='Sharded adversarial examples generation')
+parser.add_argument('--dataset', default='cifar10', type=str, help='dataset: cifar10/100 or svhn')
+parser.add_argument('--set', default='val', type=str, help='val or test set to attack')
+parser.add_argument('--attack', default='cw_nnif', type=str, help='adversarial attack: deepfool, jsma, cw, cw_nnif')
+parser.add_argument('--batch_size', default=100, type=int, help='attack batch size')
+parser.add_argument('--chunk_size', default=500, type=int, help='number of samples in every resumable chunk')
+parser.add_argument('--num_workers', default=4, type=int, help='number of worker processes (shards)')
+parser.add_argument('--gpus', default='', type=str, help='comma separated GPU ids, assigned to the workers round robin')
+parser.add_argument('--retries', default=2, type=int, help='number of times to re-run a crashed worker')
+args = parser.parse_args()
+
+script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'adv_attack.py')
+gpus   = [gpu for gpu in args.gpus.split(',') if gpu != '']
+
+for phase, num_shards in [('prepare', 1), ('attack', args.num_workers)]:
+
+    def cmd_fn(shard_index):
+        return '{} {} --dataset {} --set {} --attack {} --batch_size {} --chunk_size {} --prepare={} --shard {} ' \
+               '--num_shards {}'.format(sys.executable, script, args.dataset, args.set, args.attack, args.batch_size,
+                                        args.chunk_size, phase == 'prepare',
+                                        -1 if phase == 'prepare' else shard_index, num_shards)
+
+    print('start running phase {} with {} workers'.format(phase, num_shards))
+    failed = run_sharded(cmd_fn, num_shards, gpus=gpus, retries=args.retries)
+    if failed:
+        print('phase {} failed for shards {}. Re-run this script to resume'.format(phase, failed))
+        sys.exit(1)
+    print('phase {} is done'.format(phase))
@@ -0,0 +1,251 @@
+"""Generating the adversarial examples of many attacks in one run.
+The dataset, graph and checkpoint are loaded once and the clean val/test predictions are calculated once. Every batch
+of the val/test sets is then attacked by all the attacks. Each attack writes its outputs (X_<set>_adv.npy,
+x_<set>_preds_adv.npy, x_<set>_features_adv.npy) and info.pkl to its own attack dir, exactly as adv_evaluate.py does.
+The attacks progress in resumable chunks (see --chunk_size), so re-running after a crash only attacks the unfinished
+chunks. Attacks whose X_val_adv.npy already exists, and sets whose outputs already exist, are skipped.
+
+The attacks are named as their attack dirs: <attack> or <attack>_targeted, for attack in deepfool, jsma, cw, fgsm,
+pgd, ead. cw_nnif needs the helpful/harmful embeddings of every sample. Use adv_attack.py for it.
+
+Example:
+python tensorflow_TB/scripts/adv_attack_suite.py --dataset cifar10 --attacks deepfool,jsma_targeted,cw_targeted
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import logging
+import numpy as np
+import tensorflow as tf
+import os
+import pickle
+
+from cleverhans.attacks import FastGradientMethod, DeepFool, SaliencyMapMethod, CarliniWagnerL2, MadryEtAl, ElasticNetMethod
+from tensorflow.python.platform import flags
+from tensorflow_TB.lib.models.darkon_replica_model import DarkonReplica
+from cleverhans.utils import set_log_level
+from cleverhans.utils import random_targets
+from cleverhans.evaluation import batch_eval
+from tensorflow_TB.lib.datasets.influence_feeder_val_test import MyFeederValTest
+from tensorflow_TB.utils.collector import batch_ranges
+from tensorflow_TB.utils.work_queue import Manifest
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_integer('batch_size', 125, 'Size of the attacked batches')
+flags.DEFINE_string('dataset', 'cifar10', 'datasset: cifar10/100 or svhn')
+flags.DEFINE_string('attacks', 'deepfool,jsma_targeted,cw_targeted,fgsm_targeted,pgd_targeted,ead_targeted',
+                    'comma separated attacks: deepfool, jsma, cw, fgsm, pgd, ead, with an optional _targeted suffix')
+flags.DEFINE_integer('chunk_size', 500, 'number of samples in every resumable chunk of the attacks')
+
+flags.DEFINE_string('mode', 'null', 'to bypass pycharm bug')
+flags.DEFINE_string('port', 'null', 'to bypass pycharm bug')
+
+if FLAGS.dataset == 'cifar10':
+    ARCH_NAME = 'model1'
+    CHECKPOINT_NAME = 'cifar10/log_080419_b_125_wd_0.0004_mom_lr_0.1_f_0.9_p_3_c_2_val_size_1000'
+elif FLAGS.dataset == 'cifar100':
+    ARCH_NAME = 'model_cifar_100'
+    CHECKPOINT_NAME = 'cifar100/log_300419_b_125_wd_0.0004_mom_lr_0.1_f_0.9_p_3_c_2_val_size_1000_ls_0.01'
+elif FLAGS.dataset == 'svhn':
+    ARCH_NAME = 'model_svhn'
+    CHECKPOINT_NAME = 'svhn_mini/log_300519_b_125_wd_0.0004_mom_lr_0.1_f_0.9_p_3_c_2_val_size_1000_exp1'
+else:
+    raise AssertionError('dataset {} not supported'.format(FLAGS.dataset))
+
+ATTACK_CLASSES = {
+    'deepfool': DeepFool,
+    'jsma'    : SaliencyMapMethod,
+    'cw'      : CarliniWagnerL2,
+    'fgsm'    : FastGradientMethod,
+    'pgd'     : MadryEtAl,
+    'ead'     : ElasticNetMethod,
+}
+# X_val_adv.npy marks a finished attack for adv_evaluate.py and the other readers, so the val set goes last
+SETS        = ['test', 'val']
+ADV_OUTPUTS = ['X_{}_adv', 'x_{}_preds_adv', 'x_{}_features_adv']
+
+def get_attack_params(attack, batch_size):
+    """:return: the cleverhans generate() parameters of the attack, as in adv_evaluate.py"""
+    params = {
+        'deepfool': {},
+        'jsma'    : {'theta': 1.0, 'gamma': 0.1},
+        'cw'      : {'batch_size': batch_size, 'confidence': 0.8, 'learning_rate': 0.01, 'initial_const': 0.1},
+        'fgsm'    : {'eps': 0.1},
+        'pgd'     : {'eps': 0.02, 'eps_iter': 0.002, 'ord': np.inf},
+        'ead'     : {'batch_size': batch_size, 'confidence': 0.8, 'learning_rate': 0.01, 'initial_const': 0.1,
+                     'decision_rule': 'L1'},
+    }[attack]
+    params.update({'clip_min': 0.0, 'clip_max': 1.0})
+    return params
+
+def save_atomic(path, arr):
+    tmp_path = '{}.tmp.{}'.format(path, os.getpid())
+    with open(tmp_path, 'wb') as f:  # np.save appends .npy to file names
+        np.save(f, arr)
+    os.rename(tmp_path, path)
+
+# Set TF random seed to improve reproducibility
+superseed = 15101985
+rand_gen = np.random.RandomState(superseed)
+tf.set_random_seed(superseed)
+
+# Set logging level to see debug information
+set_log_level(logging.DEBUG)
+
+# Create TF session
+config_args = dict(allow_soft_placement=True)
+sess = tf.Session(config=tf.ConfigProto(**config_args))
+
+model_dir   = os.path.join('/data/gilad/logs/influence', CHECKPOINT_NAME)
+val_indices = np.load(os.path.join(model_dir, 'val_indices.npy'))
+feeder = MyFeederValTest(dataset=FLAGS.dataset, rand_gen=rand_gen, as_one_hot=True, val_inds=val_indices,
+                         test_val_set=True)
+
+X_sets, y_sets, y_sets_sparse = {}, {}, {}
+X_sets['val'], y_sets['val'] = feeder.val_indices(range(feeder.get_val_size()))
+X_sets['test'], y_sets['test'] = feeder.test_data, feeder.test_label  # getting the real test set
+set_inds = {'val': feeder.val_inds, 'test': feeder.test_inds}
+for set_name in SETS:
+    y_sets_sparse[set_name] = y_sets[set_name].argmax(axis=-1).astype(np.int32)
+
+# the attacks to run
+attacks = []
+for attack_name in FLAGS.attacks.split(','):
+    attack = attack_name[:-len('_targeted')] if attack_name.endswith('_targeted') else attack_name
+    if attack not in ATTACK_CLASSES:
+        raise AssertionError('Attack {} is not supported'.format(attack_name))
+    attack_dir = os.path.join(model_dir, attack_name)
+    if os.path.exists(os.path.join(attack_dir, 'X_val_adv.npy')):
+        print('{} already exists. Skipping attack {}'.format(os.path.join(attack_dir, 'X_val_adv.npy'), attack_name))
+        continue
+    if not os.path.exists(attack_dir):
+        os.makedirs(attack_dir)
+    attacks.append({'name': attack_name, 'attack': attack, 'dir': attack_dir,
+                    'targeted': attack_name.endswith('_targeted')})
+if not attacks:
+    print('all the attacks are done')
+    exit(0)
+
+# Use Image Parameters
+img_rows, img_cols, nchannels = X_sets['test'].shape[1:4]
+nb_classes = y_sets['test'].shape[1]
+
+# Define input TF placeholder
+x     = tf.placeholder(tf.float32, shape=(None, img_rows, img_cols, nchannels), name='x')
+y     = tf.placeholder(tf.float32, shape=(None, nb_classes), name='y')
+y_adv = tf.placeholder(tf.float32, shape=(None, nb_classes), name='y_adv')
+
+model = DarkonReplica(scope=ARCH_NAME, nb_classes=feeder.num_classes, n=5, input_shape=[32, 32, 3])
+preds      = model.get_predicted_class(x)
+embeddings = model.get_embeddings(x)
+
+# loading the checkpoint, before the attacks add their own variables to the graph
+saver = tf.train.Saver()
+checkpoint_path = os.path.join(model_dir, 'best_model.ckpt')
+saver.restore(sess, checkpoint_path)
+
+# building the graphs of all the attacks
+for a in attacks:
+    attack_params = get_attack_params(a['attack'], FLAGS.batch_size)
+    if a['targeted']:
+        attack_params.update({'y_target': y_adv})
+    adv_x        = ATTACK_CLASSES[a['attack']](model, sess=sess).generate(x, **attack_params)
+    a['outputs'] = [adv_x, model.get_predicted_class(adv_x), model.get_embeddings(adv_x)]
+
+# clean predictions, shared by all the attacks
+clean_preds = {}
+for set_name in SETS:
+    preds_file = os.path.join(model_dir, 'x_{}_preds.npy'.format(set_name))
+    if not os.path.isfile(preds_file):
+        x_set_preds, x_set_features = batch_eval(sess, [x, y], [preds, embeddings],
+                                                 [X_sets[set_name], y_sets[set_name]], FLAGS.batch_size)
+        x_set_preds = x_set_preds.astype(np.int32)
+        np.save(preds_file, x_set_preds)
+        np.save(os.path.join(model_dir, 'x_{}_features.npy'.format(set_name)), x_set_features)
+    clean_preds[set_name] = np.load(preds_file)
+    print('{} set acc: {}'.format(set_name, np.mean(y_sets_sparse[set_name] == clean_preds[set_name])))
+
+# the adversarial targets of every targeted attack dir
+for a in [a for a in attacks if a['targeted']]:
+    a['targets'] = {}
+    if not os.path.isfile(os.path.join(a['dir'], 'y_val_targets.npy')):
+        for set_name in SETS:
+            a['targets'][set_name] = random_targets(y_sets_sparse[set_name], feeder.num_classes)
+            assert (a['targets'][set_name].argmax(axis=1) != y_sets_sparse[set_name]).all()
+            np.save(os.path.join(a['dir'], 'y_{}_targets.npy'.format(set_name)), a['targets'][set_name])
+    else:
+        for set_name in SETS:
+            a['targets'][set_name] = np.load(os.path.join(a['dir'], 'y_{}_targets.npy'.format(set_name)))
+
+# attack: every batch is fed once to all the attacks. The sets are split to chunks. Every finished chunk is saved to
+# <attack_dir>/<set>_shards/ and marked in the attack manifest, so a crashed run resumes from the unfinished chunks of
+# every attack
+for set_name in SETS:
+    set_size = X_sets[set_name].shape[0]
+    chunks   = ['{}_{}'.format(b, min(b + FLAGS.chunk_size, set_size)) for b in range(0, set_size, FLAGS.chunk_size)]
+    set_attacks = [a for a in attacks if not os.path.exists(os.path.join(a['dir'], 'X_{}_adv.npy'.format(set_name)))]
+    for a in set_attacks:
+        a['manifest']   = Manifest(os.path.join(a['dir'], '{}_attack_manifest.json'.format(set_name)))
+        a['shards_dir'] = os.path.join(a['dir'], '{}_shards'.format(set_name))
+        if not os.path.exists(a['shards_dir']):
+            os.makedirs(a['shards_dir'])
+
+    for chunk in chunks:
+        chunk_attacks = [a for a in set_attacks if a['manifest'].status(chunk) != 'done']
+        if not chunk_attacks:
+            continue
+        b_chunk, e_chunk = [int(v) for v in chunk.split('_')]
+        outputs = {a['name']: [[] for _ in ADV_OUTPUTS] for a in chunk_attacks}
+        for b, e in batch_ranges(e_chunk - b_chunk, FLAGS.batch_size):
+            b, e = b + b_chunk, e + b_chunk
+            print('attacking {} samples {}-{} with {} attacks'.format(set_name, b, e, len(chunk_attacks)))
+            feed_dict = {x: X_sets[set_name][b:e], y: y_sets[set_name][b:e]}
+            for a in chunk_attacks:
+                if a['targeted']:
+                    feed_dict[y_adv] = a['targets'][set_name][b:e]
+                for output_list, arr in zip(outputs[a['name']], sess.run(a['outputs'], feed_dict=feed_dict)):
+                    output_list.append(arr)
+        for a in chunk_attacks:
+            chunk_outputs = [np.concatenate(output_list) for output_list in outputs[a['name']]]
+            chunk_outputs[1] = chunk_outputs[1].astype(np.int32)
+            for name, arr in zip(ADV_OUTPUTS, chunk_outputs):
+                save_atomic(os.path.join(a['shards_dir'], '{}.{}.npy'.format(name.format(set_name), chunk)), arr)
+            a['manifest'].mark(chunk, 'done', num_samples=e_chunk - b_chunk)
+
+    # merging the chunks of every attack into the monolithic outputs. X_<set>_adv.npy marks completion, so it is
+    # written last
+    for a in set_attacks:
+        for name in reversed(ADV_OUTPUTS):
+            save_atomic(os.path.join(a['dir'], name.format(set_name) + '.npy'), np.concatenate(
+                [np.load(os.path.join(a['shards_dir'], '{}.{}.npy'.format(name.format(set_name), chunk)))
+                 for chunk in chunks]))
+        print('merged {} chunks of attack {} into {}'.format(len(chunks), a['name'],
+                                                           os.path.join(a['dir'], 'X_{}_adv.npy'.format(set_name))))
+
+# saving the info.pkl of every attack
+for a in attacks:
+    # what are the indices of the set which the network succeeded classifying correctly,
+    # but the adversarial attack changed to a different class?
+    info = {}
+    for set_name in SETS:
+        preds_adv = np.load(os.path.join(a['dir'], 'x_{}_preds_adv.npy'.format(set_name)))
+        info[set_name] = {}
+        for i, set_ind in enumerate(set_inds[set_name]):
+            info[set_name][i] = {}
+            info[set_name][i]['global_index'] = set_ind
+            info[set_name][i]['net_succ']     = clean_preds[set_name][i] == y_sets_sparse[set_name][i]
+            info[set_name][i]['attack_succ']  = clean_preds[set_name][i] != preds_adv[i]
+
+        net_succ_indices             = [ind for ind in info[set_name] if info[set_name][ind]['net_succ']]
+        net_succ_attack_succ_indices = [ind for ind in net_succ_indices if info[set_name][ind]['attack_succ']]
+        print('adversarial ({}) {} set acc: {}, attack rate: {}'.format(
+            a['name'], set_name, np.mean(y_sets_sparse[set_name] == preds_adv),
+            len(net_succ_attack_succ_indices) / len(net_succ_indices)))
+
+    info_file = os.path.join(a['dir'], 'info.pkl')
+    print('saving info as pickle to {}'.format(info_file))
+    with open(info_file, 'wb') as handle:
+        pickle.dump(info, handle, protocol=pickle.HIGHEST_PROTOCOL)
@@ -25,9 +25,11 @@ from tensorflow_TB.lib.models.darkon_replica_model import DarkonReplica
 from cleverhans.utils import AccuracyReport, set_log_level
 from cleverhans.utils_tf import model_eval
 from tensorflow_TB.utils.misc import one_hot
-from sklearn.neighbors import NearestNeighbors
+from tensorflow_TB.utils.work_queue import Manifest, shard, file_lock
+from tensorflow_TB.lib.nn_index import BlockedNNIndex, RankTable
 import matplotlib.pyplot as plt
 from tensorflow_TB.lib.datasets.influence_feeder_val_test import MyFeederValTest
+from tensorflow_TB.lib.batched_influence import BatchedInfluence
 import pickle
 from cleverhans.utils import random_targets
 from cleverhans.evaluation import batch_eval
@@ -45,6 +47,12 @@ flags.DEFINE_string('cases', 'adv', 'can be rither real, pred, or adv')
 flags.DEFINE_integer('b', -1, 'beginning index')
 flags.DEFINE_integer('e', -1, 'ending index')
 flags.DEFINE_bool('backward', False, 'going from the last to to first')
+flags.DEFINE_integer('shard', -1, 'index of this worker shard (see adv_evaluate_scheduler.py). -1 for no sharding')
+flags.DEFINE_integer('num_shards', 1, 'total number of worker shards')
+flags.DEFINE_integer('influence_batch', 8, 'number of test points to calculate the influence scores for together')
+flags.DEFINE_bool('grad_cache', False, 'whether or not to cache the per-sample training gradients once per checkpoint')
+flags.DEFINE_integer('grad_projection_dim', -1, 'random projection dim of the cached gradients. -1 for no projection')
+flags.DEFINE_float('grad_cache_max_gb', 16.0, 'refuse to build a training gradients cache larger than this (GB)')
 flags.DEFINE_bool('overwrite_A', False, 'whether or not to overwrite the A calculation')
 flags.DEFINE_bool('overwrite_C', False, 'whether or not to overwrite the C calculation')
 
@@ -61,6 +69,8 @@ else:
     USE_TRAIN_MINI = True
 
 assert FLAGS.cases in ['all', 'real', 'pred', 'adv']
+assert not FLAGS.grad_cache or FLAGS.influence_batch > 1, \
+    '--grad_cache is only used by the batched influence calculation. Set --influence_batch > 1'
 if FLAGS.cases == 'all':
     ALLOWED_CASES = ['real', 'pred', 'adv']
 else:
@@ -427,7 +437,7 @@ else:
     assert info == info_old
 
 # start the knn observation
-knn = NearestNeighbors(n_neighbors=feeder.get_train_size(), p=2, n_jobs=20)
+knn = BlockedNNIndex(name='knn')
 knn.fit(x_train_features)
 if test_val_set:
     print('predicting knn for all val set')
@@ -437,10 +447,27 @@ else:
     print('predicting knn for all test set')
     features     = x_test_features
     features_adv = x_test_features_adv
-print('predicting knn dist/indices for normal image')
-all_neighbor_dists    , all_neighbor_indices     = knn.kneighbors(features, return_distance=True)
-print('predicting knn dist/indices for adv image')
-all_neighbor_dists_adv, all_neighbor_indices_adv = knn.kneighbors(features_adv, return_distance=True)
+# rank tables (memory-mapped): rank/distance of every training sample for every image.
+# The tables cover the full set and are shared by all the shards: the first worker to take the lock (normally in the
+# prepare phase) builds them, and every worker opens them read-only
+nn_index_dir = os.path.join(attack_dir, 'nn_index', FLAGS.set)
+if not os.path.exists(nn_index_dir):
+    os.makedirs(nn_index_dir)
+
+def shared_rank_table(features, name):
+    out_prefix = os.path.join(nn_index_dir, name)
+    with file_lock(out_prefix + '.lock'):
+        if not os.path.isfile(out_prefix + '_dists.npy') or \
+                np.load(out_prefix + '_dists.npy', mmap_mode='r').shape != (features.shape[0], knn.n_train):
+            print('predicting knn dist/ranks for {} image'.format(name))
+            tmp_prefix = out_prefix + '.tmp.{}'.format(os.getpid())
+            knn.rank_table(features, out_prefix=tmp_prefix)
+            os.rename(tmp_prefix + '_ranks.npy', out_prefix + '_ranks.npy')
+            os.rename(tmp_prefix + '_dists.npy', out_prefix + '_dists.npy')  # last: marks complete tables
+    return RankTable.load(out_prefix)
+
+knn_table     = shared_rank_table(features    , 'normal')
+knn_table_adv = shared_rank_table(features_adv, 'adv')
 
 # setting pred feeder
 pred_feeder = MyFeederValTest(dataset=FLAGS.dataset, rand_gen=rand_gen, as_one_hot=True,
@@ -467,39 +494,59 @@ feeder.reset()
 pred_feeder.reset()
 adv_feeder.reset()
 
-inspector = darkon.Influence(
+testset_batch_size = 100
+train_batch_size = 200
+train_iterations = 25 if USE_TRAIN_MINI else 245  # 5k(25x200) or 49k(245x200)
+approx_params = {
+    'scale': 200,
+    'num_repeats': 5,
+    'recursion_depth': 5 if USE_TRAIN_MINI else 49,  # 5k(5x5x200) or 49k(5x49x200)
+    'recursion_batch_size': 200
+}
+
+# the training gradients cache is shared by all the cases (same training set and train loss)
+grad_cache_kwargs = {}
+if FLAGS.grad_cache:
+    num_params = sum(int(np.prod(v.get_shape().as_list())) for v in tf.trainable_variables())
+    cache_dim  = FLAGS.grad_projection_dim if FLAGS.grad_projection_dim != -1 else num_params
+    cache_gb   = train_batch_size * train_iterations * cache_dim * 4 / 2 ** 30  # float32
+    print('training gradients cache: {} samples x {} dims ({:.2f} GB)'
+          .format(train_batch_size * train_iterations, cache_dim, cache_gb))
+    assert cache_gb <= FLAGS.grad_cache_max_gb, \
+        'the training gradients cache needs {:.2f} GB (> --grad_cache_max_gb={}). Set --grad_projection_dim' \
+        .format(cache_gb, FLAGS.grad_cache_max_gb)
+    grad_cache_kwargs = {'grad_cache_dir': os.path.join(workspace_dir, 'train_grads'),
+                         'grad_projection_dim': FLAGS.grad_projection_dim if FLAGS.grad_projection_dim != -1 else None}
+
+inspector = BatchedInfluence(
     workspace=os.path.join(workspace_dir, 'real'),
     feeder=feeder,
     loss_op_train=full_loss.fprop(x=x, y=y),
     loss_op_test=loss.fprop(x=x, y=y),
     x_placeholder=x,
-    y_placeholder=y)
+    y_placeholder=y,
+    max_test_batch=FLAGS.influence_batch,
+    **grad_cache_kwargs)
 
-inspector_pred = darkon.Influence(
+inspector_pred = BatchedInfluence(
     workspace=os.path.join(workspace_dir, 'pred'),
     feeder=pred_feeder,
     loss_op_train=full_loss.fprop(x=x, y=y),
     loss_op_test=loss.fprop(x=x, y=y),
     x_placeholder=x,
-    y_placeholder=y)
+    y_placeholder=y,
+    max_test_batch=FLAGS.influence_batch,
+    **grad_cache_kwargs)
 
-inspector_adv = darkon.Influence(
+inspector_adv = BatchedInfluence(
     workspace=os.path.join(workspace_dir, 'adv', FLAGS.attack),
     feeder=adv_feeder,
     loss_op_train=full_loss.fprop(x=x, y=y),
     loss_op_test=loss.fprop(x=x, y=y),
     x_placeholder=x,
-    y_placeholder=y)
-
-testset_batch_size = 100
-train_batch_size = 200
-train_iterations = 25 if USE_TRAIN_MINI else 245  # 5k(25x200) or 49k(245x200)
-approx_params = {
-    'scale': 200,
-    'num_repeats': 5,
-    'recursion_depth': 5 if USE_TRAIN_MINI else 49,  # 5k(5x5x200) or 49k(5x49x200)
-    'recursion_batch_size': 200
-}
+    y_placeholder=y,
+    max_test_batch=FLAGS.influence_batch,
+    **grad_cache_kwargs)
 
 # sub_relevant_indices = [ind for ind in info[FLAGS.set] if info[FLAGS.set][ind]['net_succ'] and info[FLAGS.set][ind]['attack_succ']]
 # sub_relevant_indices = [ind for ind in info[FLAGS.set] if not info[FLAGS.set][ind]['attack_succ']]
@@ -515,25 +562,61 @@ if FLAGS.backward:
     sub_relevant_indices = sub_relevant_indices[::-1]
     relevant_indices     = relevant_indices[::-1]
 
+if FLAGS.shard != -1:
+    sub_relevant_indices = shard(sub_relevant_indices, FLAGS.shard, FLAGS.num_shards)
+    relevant_indices     = shard(relevant_indices    , FLAGS.shard, FLAGS.num_shards)
+
+# completion of every (index, case), shared by all the workers. key: the index dir relative to model_dir/<set>
+manifest = Manifest(os.path.join(model_dir, FLAGS.set, 'influence_manifest.json'))
+
+def get_case_dir(global_index, case):
+    """The dir of the influence outputs of a test index, for a specific case"""
+    dir = os.path.join(model_dir, FLAGS.set, FLAGS.set + '_index_{}'.format(global_index), case)
+    if case == 'adv':
+        dir = os.path.join(dir, FLAGS.attack)
+    return dir
+
+if not FLAGS.prepare and FLAGS.influence_batch > 1:
+    # calculating the missing influence scores in batches of test points: the inverse-HVPs of every batch are solved
+    # together and the training set gradients are swept once per batch
+    for case, insp in [('real', inspector), ('pred', inspector_pred), ('adv', inspector_adv)]:
+        if case not in ALLOWED_CASES:
+            continue
+        pending = []
+        for sub_index, global_index in zip(sub_relevant_indices, relevant_indices):
+            if case == 'pred' and info[FLAGS.set][sub_index]['net_succ']:
+                continue
+            dir = get_case_dir(global_index, case)
+            if os.path.isfile(os.path.join(dir, 'scores.npy')) or \
+                    (not FLAGS.overwrite_C and os.path.exists(os.path.join(dir, 'summary.txt'))):
+                continue
+            pending.append((sub_index, dir))
+
+        for b in range(0, len(pending), FLAGS.influence_batch):
+            batch = pending[b:b + FLAGS.influence_batch]
+            print('calculating {} influence scores for {} indices {}'.format(case, FLAGS.set, [ind for ind, _ in batch]))
+            batch_scores = insp.upweighting_influence_multi(
+                sess=sess,
+                test_indices=[ind for ind, _ in batch],
+                test_batch_size=testset_batch_size,
+                approx_params=approx_params,
+                train_batch_size=train_batch_size,
+                train_iterations=train_iterations)
+            for (_, dir), scores in zip(batch, batch_scores):
+                if not os.path.exists(dir):
+                    os.makedirs(dir)
+                np.save(os.path.join(dir, 'scores.npy'), scores)
+
 # calculate knn_ranks
 def find_ranks(sub_index, sorted_influence_indices, adversarial=False):
     print('Finding ranks for sub_index={} (adversarial={})'.format(sub_index, adversarial))
     if adversarial:
-        ni = all_neighbor_indices_adv
-        nd = all_neighbor_dists_adv
+        table = knn_table_adv
     else:
-        ni = all_neighbor_indices
-        nd = all_neighbor_dists
+        table = knn_table
 
-    ranks = -1 * np.ones(len(sorted_influence_indices), dtype=np.int32)
-    dists = -1 * np.ones(len(sorted_influence_indices), dtype=np.float32)
-    for target_idx in range(ranks.shape[0]):
-        idx = sorted_influence_indices[target_idx]
-        loc_in_knn = np.where(ni[sub_index] == idx)[0][0]
-        knn_dist = nd[sub_index, loc_in_knn]
-        ranks[target_idx] = loc_in_knn
-        dists[target_idx] = knn_dist
-    return ranks, dists
+    ranks, dists = table.lookup(sub_index, sorted_influence_indices)
+    return ranks.astype(np.int32), dists.astype(np.float32)
 
 
 for i in tqdm(range(len(sub_relevant_indices))):
@@ -574,25 +657,30 @@ for i in tqdm(range(len(sub_relevant_indices))):
         if case == 'real':
             insp = inspector
             feed = feeder
-            ni   = all_neighbor_indices
-            nd   = all_neighbor_dists
+            table = knn_table
         elif case == 'pred':
             insp = inspector_pred
             feed = pred_feeder
-            ni   = all_neighbor_indices
-            nd   = all_neighbor_dists
+            table = knn_table
         elif case == 'adv':
             insp = inspector_adv
             feed = adv_feeder
-            ni   = all_neighbor_indices_adv
-            nd   = all_neighbor_dists_adv
+            table = knn_table_adv
         else:
             raise AssertionError('only real and adv are accepted.')
 
         if case not in ALLOWED_CASES:
             continue
 
+        manifest_key = os.path.join(FLAGS.set + '_index_{}'.format(global_index), case)
+        if case == 'adv':
+            manifest_key = os.path.join(manifest_key, FLAGS.attack)
+        status = manifest.status(manifest_key)
+
         if FLAGS.prepare:
+            if not FLAGS.overwrite_A and status in ['prepared', 'done']:
+                print('influence _prepare for {} was already done. Leaving it'.format(manifest_key))
+                continue
             try:
                 insp._prepare(
                     sess=sess,
@@ -610,17 +698,19 @@ for i in tqdm(range(len(sub_relevant_indices))):
                     approx_params=approx_params,
                     force_refresh=True
                 )
+            manifest.mark(manifest_key, 'prepared')
         else:
             # creating the relevant index folders
-            dir = os.path.join(model_dir, FLAGS.set, FLAGS.set + '_index_{}'.format(global_index), case)
-            if case == 'adv':
-                dir = os.path.join(dir, FLAGS.attack)
+            dir = get_case_dir(global_index, case)
             if not os.path.exists(dir):
                 os.makedirs(dir)
 
-            if not FLAGS.overwrite_C and os.path.exists(os.path.join(dir, 'summary.txt')):
+            if not FLAGS.overwrite_C and (status == 'done' or os.path.exists(os.path.join(dir, 'summary.txt'))):
                 print('calcaulation for global index {} was already done. Leaving it'.format(global_index))
+                if status != 'done':
+                    manifest.mark(manifest_key, 'done')
                 continue
+            manifest.mark(manifest_key, 'running', shard=FLAGS.shard)
 
             if os.path.isfile(os.path.join(dir, 'scores.npy')):
                 print('loading scores from {}'.format(os.path.join(dir, 'scores.npy')))
@@ -643,13 +733,14 @@ for i in tqdm(range(len(sub_relevant_indices))):
             sorted_indices = np.argsort(scores)
             harmful = sorted_indices[:50]
             helpful = sorted_indices[-50:][::-1]
+            nearest = table.nearest(sub_index, 50)
 
             # have some figures
             cnt_harmful_in_knn = 0
             print('\nHarmful:')
             for idx in harmful:
                 print('[{}] {}'.format(feed.get_global_index('train', idx), scores[idx]))
-                if idx in ni[sub_index, 0:50]:
+                if idx in nearest:
                     cnt_harmful_in_knn += 1
             harmful_summary_str = '{}: {} out of {} harmful images are in the {}-NN\n'.format(case, cnt_harmful_in_knn, len(harmful), 50)
             print(harmful_summary_str)
@@ -658,7 +749,7 @@ for i in tqdm(range(len(sub_relevant_indices))):
             print('\nHelpful:')
             for idx in helpful:
                 print('[{}] {}'.format(feed.get_global_index('train', idx), scores[idx]))
-                if idx in ni[sub_index, 0:50]:
+                if idx in nearest:
                     cnt_helpful_in_knn += 1
             helpful_summary_str = '{}: {} out of {} helpful images are in the {}-NN\n'.format(case, cnt_helpful_in_knn, len(helpful), 50)
             print(helpful_summary_str)
@@ -667,7 +758,7 @@ for i in tqdm(range(len(sub_relevant_indices))):
             target_idx = 0
             for j in range(5):
                 for k in range(10):
-                    idx = ni[sub_index, target_idx]
+                    idx = nearest[target_idx]
                     axes1[j][k].set_axis_off()
                     axes1[j][k].imshow(X_train[idx])
                     label_str = _classes[y_train_sparse[idx]]
@@ -693,7 +784,7 @@ for i in tqdm(range(len(sub_relevant_indices))):
                     axes1[j][k].set_axis_off()
                     axes1[j][k].imshow(X_train[idx])
                     label_str = _classes[y_train_sparse[idx]]
-                    loc_in_knn = np.where(ni[sub_index] == idx)[0][0]
+                    loc_in_knn = table.ranks[sub_index, idx]
                     axes1[j][k].set_title('[{}]: {} #nn:{}'.format(feed.get_global_index('train', idx), label_str, loc_in_knn))
                     target_idx += 1
             plt.savefig(os.path.join(dir, 'helpful.png'), dpi=350)
@@ -707,7 +798,7 @@ for i in tqdm(range(len(sub_relevant_indices))):
                     axes1[j][k].set_axis_off()
                     axes1[j][k].imshow(X_train[idx])
                     label_str = _classes[y_train_sparse[idx]]
-                    loc_in_knn = np.where(ni[sub_index] == idx)[0][0]
+                    loc_in_knn = table.ranks[sub_index, idx]
                     axes1[j][k].set_title('[{}]: {} #nn:{}'.format(feed.get_global_index('train', idx), label_str, loc_in_knn))
                     target_idx += 1
             plt.savefig(os.path.join(dir, 'harmful.png'), dpi=350)
@@ -722,3 +813,4 @@ for i in tqdm(range(len(sub_relevant_indices))):
                 f.write('label ({} -> {}). pred: {}. {} \nhelpful/harmful_rank mean: {}/{}\nhelpful/harmful_dist mean: {}/{}' \
                         .format(_classes[real_label], _classes[adv_label], _classes[pred_label], case,
                                 helpful_ranks.mean(), harmful_ranks.mean(), helpful_dists.mean(), harmful_dists.mean()))
+            manifest.mark(manifest_key, 'done')
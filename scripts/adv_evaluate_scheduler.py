@@ -0,0 +1,48 @@
+"""Running adv_evaluate.py (influence scores) sharded over a local pool of worker processes.
+Progress is tracked in <model_dir>/<set>/influence_manifest.json, so re-running this script after a crash resumes
+only the unfinished (index, case) pairs.
+
+Example:
+python tensorflow_TB/scripts/adv_evaluate_scheduler.py --dataset cifar10 --set val --attack cw --targeted \
+    --cases all --num_workers 8 --gpus 0,1,2,3
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import sys
+import argparse
+from tensorflow_TB.utils.work_queue import run_sharded
+
+parser = argparse.ArgumentParser(description='Sharded influence scores calculation')
+parser.add_argument('--dataset', default='cifar10', type=str, help='dataset: cifar10/100 or svhn')
+parser.add_argument('--set', default='val', type=str, help='val or test set to evaluate')
+parser.add_argument('--attack', default='deepfool', type=str, help='adversarial attack: deepfool, jsma, cw, cw_nnif')
+parser.add_argument('--targeted', action='store_true', help='whether or not the adversarial attack is targeted')
+parser.add_argument('--cases', default='all', type=str, help='real, pred, adv or all')
+parser.add_argument('--num_workers', default=4, type=int, help='number of worker processes (shards)')
+parser.add_argument('--gpus', default='', type=str, help='comma separated GPU ids, assigned to the workers round robin')
+parser.add_argument('--phases', default='score', type=str,
+                    help='comma separated phases: prepare (inverse-HVP only) and/or score. '
+                         'score alone also prepares, reusing any inverse-HVP already in the workspace')
+parser.add_argument('--retries', default=2, type=int, help='number of times to re-run a crashed worker')
+args = parser.parse_args()
+
+script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'adv_evaluate.py')
+gpus   = [gpu for gpu in args.gpus.split(',') if gpu != '']
+
+for phase in args.phases.split(','):
+    assert phase in ['prepare', 'score'], 'phase {} is not supported'.format(phase)
+
+    def cmd_fn(shard_index):
+        return '{} {} --dataset {} --set {} --attack {} --targeted={} --cases {} --prepare={} --shard {} --num_shards {}' \
+            .format(sys.executable, script, args.dataset, args.set, args.attack, args.targeted, args.cases,
+                    phase == 'prepare', shard_index, args.num_workers)
+
+    print('start running phase {} with {} workers'.format(phase, args.num_workers))
+    failed = run_sharded(cmd_fn, args.num_workers, gpus=gpus, retries=args.retries)
+    if failed:
+        print('phase {} failed for shards {}. Re-run this script to resume'.format(phase, failed))
+        sys.exit(1)
+    print('phase {} is done'.format(phase))
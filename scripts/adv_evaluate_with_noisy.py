@@ -25,7 +25,7 @@ from tensorflow_TB.lib.models.darkon_replica_model import DarkonReplica
 from cleverhans.utils import AccuracyReport, set_log_level
 from cleverhans.utils_tf import model_eval
 from tensorflow_TB.utils.misc import one_hot
-from sklearn.neighbors import NearestNeighbors
+from tensorflow_TB.lib.nn_index import BlockedNNIndex
 import matplotlib.pyplot as plt
 from tensorflow_TB.lib.datasets.influence_feeder_val_test import MyFeederValTest
 from tensorflow_TB.utils.misc import np_evaluate
@@ -421,7 +421,7 @@ else:
     assert info == info_old
 
 # start the knn observation
-knn = NearestNeighbors(n_neighbors=feeder.get_train_size(), p=2, n_jobs=20)
+knn = BlockedNNIndex(name='knn')
 knn.fit(x_train_features)
 if test_val_set:
     print('predicting knn for all val set')
@@ -431,10 +431,12 @@ else:
     print('predicting knn for all test set')
     features     = x_test_features
     features_adv = x_test_features_adv
-print('predicting knn dist/indices for normal image')
-all_neighbor_dists    , all_neighbor_indices     = knn.kneighbors(features, return_distance=True)
-print('predicting knn dist/indices for adv image')
-all_neighbor_dists_adv, all_neighbor_indices_adv = knn.kneighbors(features_adv, return_distance=True)
+# rank tables (memory-mapped): rank/distance of every training sample for every image
+nn_index_dir = os.path.join(attack_dir, 'nn_index_with_noisy', FLAGS.set)
+print('predicting knn dist/ranks for normal image')
+knn_table     = knn.rank_table(features    , out_prefix=os.path.join(nn_index_dir, 'normal'))
+print('predicting knn dist/ranks for adv image')
+knn_table_adv = knn.rank_table(features_adv, out_prefix=os.path.join(nn_index_dir, 'adv'))
 
 # setting pred feeder
 pred_feeder = MyFeederValTest(dataset=FLAGS.dataset, rand_gen=rand_gen, as_one_hot=True,
@@ -513,21 +515,12 @@ if FLAGS.backward:
 def find_ranks(sub_index, sorted_influence_indices, adversarial=False):
     print('Finding ranks for sub_index={} (adversarial={})'.format(sub_index, adversarial))
     if adversarial:
-        ni = all_neighbor_indices_adv
-        nd = all_neighbor_dists_adv
+        table = knn_table_adv
     else:
-        ni = all_neighbor_indices
-        nd = all_neighbor_dists
+        table = knn_table
 
-    ranks = -1 * np.ones(len(sorted_influence_indices), dtype=np.int32)
-    dists = -1 * np.ones(len(sorted_influence_indices), dtype=np.float32)
-    for target_idx in range(ranks.shape[0]):
-        idx = sorted_influence_indices[target_idx]
-        loc_in_knn = np.where(ni[sub_index] == idx)[0][0]
-        knn_dist = nd[sub_index, loc_in_knn]
-        ranks[target_idx] = loc_in_knn
-        dists[target_idx] = knn_dist
-    return ranks, dists
+    ranks, dists = table.lookup(sub_index, sorted_influence_indices)
+    return ranks.astype(np.int32), dists.astype(np.float32)
 
 
 for i in tqdm(range(len(sub_relevant_indices))):
@@ -568,18 +561,15 @@ for i in tqdm(range(len(sub_relevant_indices))):
         if case == 'real':
             insp = inspector
             feed = feeder
-            ni   = all_neighbor_indices
-            nd   = all_neighbor_dists
+            table = knn_table
         elif case == 'pred':
             insp = inspector_pred
             feed = pred_feeder
-            ni   = all_neighbor_indices
-            nd   = all_neighbor_dists
+            table = knn_table
         elif case == 'adv':
             insp = inspector_adv
             feed = adv_feeder
-            ni   = all_neighbor_indices_adv
-            nd   = all_neighbor_dists_adv
+            table = knn_table_adv
         else:
             raise AssertionError('only real and adv are accepted.')
 
@@ -637,13 +627,14 @@ for i in tqdm(range(len(sub_relevant_indices))):
             sorted_indices = np.argsort(scores)
             harmful = sorted_indices[:50]
             helpful = sorted_indices[-50:][::-1]
+            nearest = table.nearest(sub_index, 50)
 
             # have some figures
             cnt_harmful_in_knn = 0
             print('\nHarmful:')
             for idx in harmful:
                 print('[{}] {}'.format(feed.get_global_index('train', idx), scores[idx]))
-                if idx in ni[sub_index, 0:50]:
+                if idx in nearest:
                     cnt_harmful_in_knn += 1
             harmful_summary_str = '{}: {} out of {} harmful images are in the {}-NN\n'.format(case, cnt_harmful_in_knn, len(harmful), 50)
             print(harmful_summary_str)
@@ -652,7 +643,7 @@ for i in tqdm(range(len(sub_relevant_indices))):
             print('\nHelpful:')
             for idx in helpful:
                 print('[{}] {}'.format(feed.get_global_index('train', idx), scores[idx]))
-                if idx in ni[sub_index, 0:50]:
+                if idx in nearest:
                     cnt_helpful_in_knn += 1
             helpful_summary_str = '{}: {} out of {} helpful images are in the {}-NN\n'.format(case, cnt_helpful_in_knn, len(helpful), 50)
             print(helpful_summary_str)
@@ -661,7 +652,7 @@ for i in tqdm(range(len(sub_relevant_indices))):
             target_idx = 0
             for j in range(5):
                 for k in range(10):
-                    idx = ni[sub_index, target_idx]
+                    idx = nearest[target_idx]
                     axes1[j][k].set_axis_off()
                     axes1[j][k].imshow(X_train[idx])
                     label_str = _classes[y_train_sparse[idx]]
@@ -687,7 +678,7 @@ for i in tqdm(range(len(sub_relevant_indices))):
                     axes1[j][k].set_axis_off()
                     axes1[j][k].imshow(X_train[idx])
                     label_str = _classes[y_train_sparse[idx]]
-                    loc_in_knn = np.where(ni[sub_index] == idx)[0][0]
+                    loc_in_knn = table.ranks[sub_index, idx]
                     axes1[j][k].set_title('[{}]: {} #nn:{}'.format(feed.get_global_index('train', idx), label_str, loc_in_knn))
                     target_idx += 1
             plt.savefig(os.path.join(dir, 'helpful.png'), dpi=350)
@@ -701,7 +692,7 @@ for i in tqdm(range(len(sub_relevant_indices))):
                     axes1[j][k].set_axis_off()
                     axes1[j][k].imshow(X_train[idx])
                     label_str = _classes[y_train_sparse[idx]]
-                    loc_in_knn = np.where(ni[sub_index] == idx)[0][0]
+                    loc_in_knn = table.ranks[sub_index, idx]
                     axes1[j][k].set_title('[{}]: {} #nn:{}'.format(feed.get_global_index('train', idx), label_str, loc_in_knn))
                     target_idx += 1
             plt.savefig(os.path.join(dir, 'harmful.png'), dpi=350)
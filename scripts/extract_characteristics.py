@@ -25,18 +25,23 @@ from tensorflow_TB.lib.models.darkon_replica_model import DarkonReplica
 from cleverhans.utils import AccuracyReport, set_log_level
 from cleverhans.utils_tf import model_eval
 from tensorflow_TB.utils.misc import one_hot
-from sklearn.neighbors import KNeighborsClassifier
 import matplotlib.pyplot as plt
 from tensorflow_TB.lib.datasets.influence_feeder_val_test import MyFeederValTest
 from tensorflow_TB.utils.misc import np_evaluate
+from tensorflow_TB.utils.collector import global_average_pool, batch_ranges, prefetch
+from multiprocessing.pool import ThreadPool
 import pickle
 from cleverhans.utils import random_targets
 from cleverhans.evaluation import batch_eval
 from tqdm import tqdm
-import sklearn.covariance
-from sklearn.neighbors import NearestNeighbors
+from tensorflow_TB.lib.nn_index import BlockedNNIndex
+from tensorflow_TB.lib.datasets.dataset_cache import cache_key
+from tensorflow_TB.lib.feature_store import file_digest
+from tensorflow_TB.lib.dknn import DkNN
+from tensorflow_TB.lib.lid import mle_lid_layers
+from tensorflow_TB.lib.mahalanobis import class_statistics, save_class_statistics, load_class_statistics, \
+    gaussian_score_tensors, mean_loss_scale, preprocess_inputs
 
-from lid_adversarial_subspace_detection.util import mle_batch
 
 # tf.enable_eager_execution()
 # TODO(gilad): change placeholders (0.001) with correct values with random is ready.
@@ -70,6 +75,7 @@ flags.DEFINE_bool('only_last', False, 'Using just the last layer, the embedding
 
 # FOR LID/DkNN
 flags.DEFINE_integer('k_nearest', -1, 'number of nearest neighbors to use for LID/DkNN detection')
+flags.DEFINE_integer('num_threads', 4, 'number of threads estimating the LIDs of the layers concurrently')
 
 # FOR MAHANABOLIS
 flags.DEFINE_float('magnitude', -1, 'magnitude for mahalanobis detection')
@@ -412,258 +418,128 @@ def merge_and_generate_labels(X_pos, X_neg):
 
     return X, y
 
-def get_lids_random_batch(X_test, X_test_noisy, X_test_adv, k=FLAGS.k_nearest, batch_size=100):
+def get_lids_random_batch(X_test, X_test_noisy, X_test_adv, k_vec, batch_size=100):
     """
     :param X_test: normal images
     :param X_test_noisy: noisy images
     :param X_test_adv: advserial images
-    :param k: the number of nearest neighbours for LID estimation
+    :param k_vec: list of the number of nearest neighbours for LID estimation
     :param batch_size: default 100
-    :return: lids: LID of normal images of shape (num_examples, lid_dim)
+    :return: dictionary mapping every k to (lids, lids_noisy, lids_adv), where
+            lids: LID of normal images of shape (num_examples, lid_dim)
             lids_adv: LID of advs images of shape (num_examples, lid_dim)
     """
 
     lid_dim = len(model.net)
     print("Number of layers to estimate: ", lid_dim)
-
-    def estimate(i_batch):
-        start = i_batch * batch_size
-        end = np.minimum(len(X_test), (i_batch + 1) * batch_size)
-        n_feed = end - start
-        lid_batch       = np.zeros(shape=(n_feed, lid_dim))
-        lid_batch_adv   = np.zeros(shape=(n_feed, lid_dim))
-        lid_batch_noisy = np.zeros(shape=(n_feed, lid_dim))
-
-        X_act       = batch_eval(sess, [x], model.net.values(), [X_test[start:end]]      , batch_size)
-        X_adv_act   = batch_eval(sess, [x], model.net.values(), [X_test_adv[start:end]]  , batch_size)
-        X_noisy_act = batch_eval(sess, [x], model.net.values(), [X_test_noisy[start:end]], batch_size)
-
-        for i in range(len(model.net)):
-            X_act[i]       = np.asarray(X_act[i]      , dtype=np.float32).reshape((n_feed, -1))
-            X_adv_act[i]   = np.asarray(X_adv_act[i]  , dtype=np.float32).reshape((n_feed, -1))
-            X_noisy_act[i] = np.asarray(X_noisy_act[i], dtype=np.float32).reshape((n_feed, -1))
-
-            # random clean samples
-            # Maximum likelihood estimation of local intrinsic dimensionality (LID)
-            lid_batch[:, i]       = mle_batch(X_act[i], X_act[i]      , k=k)
-            lid_batch_adv[:, i]   = mle_batch(X_act[i], X_adv_act[i]  , k=k)
-            lid_batch_noisy[:, i] = mle_batch(X_act[i], X_noisy_act[i], k=k)
-
-        return lid_batch, lid_batch_noisy, lid_batch_adv
-
-    lids = []
-    lids_adv = []
-    lids_noisy = []
+    k_vec = list(k_vec)
+    lids       = np.zeros(shape=(len(k_vec), len(X_test), lid_dim), dtype=np.float32)
+    lids_adv   = np.zeros(shape=(len(k_vec), len(X_test), lid_dim), dtype=np.float32)
+    lids_noisy = np.zeros(shape=(len(k_vec), len(X_test), lid_dim), dtype=np.float32)
+
+    def activations():
+        for start, end in batch_ranges(len(X_test), batch_size):
+            # a single forward pass of all the layers for the normal, adversarial and noisy images of the batch
+            X_batch = np.concatenate((X_test[start:end], X_test_adv[start:end], X_test_noisy[start:end]))
+            yield start, end, sess.run(list(model.net.values()), feed_dict={x: X_batch})
+
+    # the next forward pass runs in the background while the LIDs of the current batch are estimated
+    pool = ThreadPool(FLAGS.num_threads)
     n_batches = int(np.ceil(X_test.shape[0] / float(batch_size)))
-    for i_batch in tqdm(range(n_batches)):
-        lid_batch, lid_batch_noisy, lid_batch_adv = estimate(i_batch)
-        lids.extend(lid_batch)
-        lids_adv.extend(lid_batch_adv)
-        lids_noisy.extend(lid_batch_noisy)
-
-    lids       = np.asarray(lids, dtype=np.float32)
-    lids_noisy = np.asarray(lids_noisy, dtype=np.float32)
-    lids_adv   = np.asarray(lids_adv, dtype=np.float32)
-
-    return lids, lids_noisy, lids_adv
-
-def get_lid(X, X_noisy, X_adv, k, batch_size=100):
-    print('Extract local intrinsic dimensionality: k = %s' % k)
-    lids_normal, lids_noisy, lids_adv = get_lids_random_batch(X, X_noisy, X_adv, k, batch_size)
-    print("lids_normal:", lids_normal.shape)
-    print("lids_noisy:", lids_noisy.shape)
-    print("lids_adv:", lids_adv.shape)
-
-    lids_pos = lids_adv
-    if FLAGS.with_noise:
-        lids_neg = np.concatenate((lids_normal, lids_noisy))
-    else:
-        lids_neg = lids_normal
-    artifacts, labels = merge_and_generate_labels(lids_pos, lids_neg)
+    for start, end, X_act in tqdm(prefetch(activations()), total=n_batches):
+        n_feed = end - start
+        # Maximum likelihood estimation of local intrinsic dimensionality (LID), with the clean samples as reference
+        lid_batch = mle_lid_layers(X_act, n_feed, k_vec, pool)
+        lids[:, start:end]       = lid_batch[:, :n_feed]
+        lids_adv[:, start:end]   = lid_batch[:, n_feed:2 * n_feed]
+        lids_noisy[:, start:end] = lid_batch[:, 2 * n_feed:]
+    pool.close()
+
+    return {k: (lids[i], lids_noisy[i], lids_adv[i]) for i, k in enumerate(k_vec)}
+
+def get_lid(X, X_noisy, X_adv, k_vec, batch_size=100):
+    print('Extract local intrinsic dimensionality: k = %s' % list(k_vec))
+    all_lids = get_lids_random_batch(X, X_noisy, X_adv, k_vec, batch_size)
+
+    characteristics = {}
+    for k in k_vec:
+        lids_normal, lids_noisy, lids_adv = all_lids[k]
+        lids_pos = lids_adv
+        if FLAGS.with_noise:
+            lids_neg = np.concatenate((lids_normal, lids_noisy))
+        else:
+            lids_neg = lids_normal
+        characteristics[k] = merge_and_generate_labels(lids_pos, lids_neg)
 
-    return artifacts, labels
+    return characteristics
 
-def get_mahalanobis(X, X_noisy, X_adv, magnitude, sample_mean, precision, set):
-    first_pass = True
-    for layer in model.net.keys():
+def get_mahalanobis(X, X_noisy, X_adv, magnitude_vec, sample_mean, precision, set):
+    """Calculating the Mahalanobis characteristics of a set for all the magnitudes. The input gradients of every layer
+    are calculated once, in a single pass over the normal, noisy and adversarial inputs together, and reused by all the
+    magnitudes.
+    :return: dictionary mapping every magnitude to (characteristics, labels)
+    """
+    sets   = [X, X_adv, X_noisy] if FLAGS.with_noise else [X, X_adv]
+    X_all  = np.concatenate(sets)
+    # the gradients of the original per set batch mean loss
+    grad_scale = np.concatenate([mean_loss_scale(len(X_set), FLAGS.batch_size) for X_set in sets])
+
+    scores = {magnitude: [] for magnitude in magnitude_vec}
+    for layer_index, layer in enumerate(model.net.keys()):
         print('Calculating Mahalanobis characteristics for set {}, {}'.format(set, layer))
-        with tf.name_scope('{}_gaussian_{}'.format(set, layer)):
-            gaussian_score, grads = get_mahanabolis_tensors(sample_mean, precision, feeder.num_classes, layer)
-
-            # val
-            M_in = get_Mahalanobis_score_adv(X, gaussian_score, grads, magnitude, FLAGS.rgb_scale)
-            M_in = np.asarray(M_in, dtype=np.float32)
-
-            M_out = get_Mahalanobis_score_adv(X_adv, gaussian_score, grads, magnitude, FLAGS.rgb_scale)
-            M_out = np.asarray(M_out, dtype=np.float32)
-
-            if FLAGS.with_noise:
-                M_noisy = get_Mahalanobis_score_adv(X_noisy, gaussian_score, grads, magnitude, FLAGS.rgb_scale)
-                M_noisy = np.asarray(M_noisy, dtype=np.float32)
-            else:  # just a placeholder with zeros
-                M_noisy = np.zeros_like(M_in)
-
-            if first_pass:
-                Mahalanobis_in    = M_in.reshape((M_in.shape[0], -1))
-                Mahalanobis_out   = M_out.reshape((M_out.shape[0], -1))
-                Mahalanobis_noisy = M_noisy.reshape((M_noisy.shape[0], -1))
-                first_pass = False
-            else:
-                Mahalanobis_in    = np.concatenate((Mahalanobis_in, M_in.reshape((M_in.shape[0], -1))), axis=1)
-                Mahalanobis_out   = np.concatenate((Mahalanobis_out, M_out.reshape((M_out.shape[0], -1))), axis=1)
-                Mahalanobis_noisy = np.concatenate((Mahalanobis_noisy, M_noisy.reshape((M_noisy.shape[0], -1))), axis=1)
-
-    if FLAGS.with_noise:
-        Mahalanobis_neg = np.concatenate((Mahalanobis_in, Mahalanobis_noisy))
-    else:
-        Mahalanobis_neg = Mahalanobis_in
-    Mahalanobis_pos = Mahalanobis_out
-    characteristics, labels = merge_and_generate_labels(Mahalanobis_pos, Mahalanobis_neg)
+        with tf.name_scope('gaussian_{}'.format(layer)):
+            if layer not in mahalanobis_tensors:
+                mahalanobis_tensors[layer] = gaussian_score_tensors(model.net[layer], x, sample_mean[layer_index],
+                                                                    precision[layer_index])
+        gaussian_score, grads = mahalanobis_tensors[layer]
+
+        gradients = batch_eval(sess, [x], [grads], [X_all], FLAGS.batch_size)[0]
+        gradients *= grad_scale[:, np.newaxis, np.newaxis, np.newaxis]
+        for magnitude in magnitude_vec:
+            temp_inputs = preprocess_inputs(X_all, gradients, magnitude, FLAGS.rgb_scale)
+            noise_gaussian_score = batch_eval(sess, [x], [gaussian_score], [temp_inputs], FLAGS.batch_size)[0]
+            scores[magnitude].append(np.max(noise_gaussian_score, axis=1).astype(np.float32))
+        del gradients
+
+    characteristics = {}
+    for magnitude in magnitude_vec:
+        Mahalanobis = np.stack(scores[magnitude], axis=1)  # [N_all, num_layers]
+        Mahalanobis_in  = Mahalanobis[:len(X)]
+        Mahalanobis_out = Mahalanobis[len(X):len(X) + len(X_adv)]
+        if FLAGS.with_noise:
+            Mahalanobis_noisy = Mahalanobis[len(X) + len(X_adv):]
+            Mahalanobis_neg   = np.concatenate((Mahalanobis_in, Mahalanobis_noisy))
+        else:
+            Mahalanobis_neg = Mahalanobis_in
+        Mahalanobis_pos = Mahalanobis_out
+        characteristics[magnitude] = merge_and_generate_labels(Mahalanobis_pos, Mahalanobis_neg)
 
-    return characteristics, labels
+    return characteristics
 
 def sample_estimator(num_classes, X, Y):
-    num_output           = len(model.net)
-    feature_list         = np.zeros(num_output, dtype=np.int32)   # indicates the number of features in every layer
-    num_sample_per_class = np.zeros(num_classes)  # how many samples are per class
-    for i, key in enumerate(model.net):
-        feature_list[i] = model.net[key].shape[-1].value
-    assert (feature_list > 0).all()
-
-    list_features = []  # list_features[<layer>][<label>] is a list that holds the features in a specific layer of a specific label
-                        # is it basically list_features[<num_of_layer>][<num_of_label>] = List
-    for i in range(num_output):
-        temp_list = []
-        for j in range(num_classes):
-            temp_list.append([])
-        list_features.append(temp_list)
-
-    out_features = batch_eval(sess, [x], model.net.values(), [X], FLAGS.batch_size)
-    for i in range(num_output):
-        if len(out_features[i].shape) == 4:
-            out_features[i] = np.asarray(out_features[i], dtype=np.float32).reshape((X.shape[0], -1, out_features[i].shape[-1]))
-            out_features[i] = np.mean(out_features[i], axis=1)
-        elif len(out_features[i].shape) == 2:
-            pass  # leave as is
-        else:
-            raise AssertionError('Expecting size of 2 or 4 but got {} for i={}'.format(len(out_features[i].shape), i))
-
-    for i in range(X.shape[0]):
-        label = Y[i]
-        for layer in range(num_output):
-            list_features_temp = out_features[layer][i].reshape(1, -1)
-            list_features[layer][label].extend(list_features_temp)
-        num_sample_per_class[label] += 1
-
-    # stacking everything
-    for layer in range(num_output):
-        for label in range(num_classes):
-            list_features[layer][label] = np.stack(list_features[layer][label])
-
-    sample_class_mean = []
-    for layer in range(num_output):
-        num_feature = feature_list[layer]
-        temp_list = np.zeros((num_classes, num_feature))
-        for i in range(num_classes):
-            temp_list[i] = np.mean(list_features[layer][i], axis=0)
-        sample_class_mean.append(temp_list)
-
-    precision = []
-    group_lasso = sklearn.covariance.EmpiricalCovariance(assume_centered=False)
-    for layer in range(num_output):
-        D = 0
-        for i in range(num_classes):
-            if i == 0:
-                D = list_features[layer][i] - sample_class_mean[layer][i]
-            else:
-                D = np.concatenate((D, list_features[layer][i] - sample_class_mean[layer][i]), 0)
-
-        # find inverse
-        group_lasso.fit(D)
-        temp_precision = group_lasso.precision_
-        precision.append(temp_precision)
-
+    """Calculating the class means and the tied precision of every layer in model.net.
+    The statistics are saved to model_dir and reused by the next runs with the same training set and checkpoint"""
+    layers = list(model.net.keys())
+    stats_key = cache_key(FLAGS.dataset, feeder.train_inds, file_digest(checkpoint_path + '.index'))
+    stats_file = os.path.join(model_dir, 'mahalanobis_class_stats_{}{}.npz'.format(stats_key, '_only_last' if FLAGS.only_last else ''))
+    sample_class_mean, precision = load_class_statistics(stats_file, layers)
+    if sample_class_mean is not None:
+        print('Loaded the class statistics from {}'.format(stats_file))
+        return sample_class_mean, precision
+
+    sample_class_mean, precision = [], []
+    for layer_features in collect_layers_gap(X):
+        layer_mean, layer_precision = class_statistics(layer_features, Y, num_classes)
+        sample_class_mean.append(layer_mean)
+        precision.append(layer_precision)
+
+    save_class_statistics(stats_file, layers, sample_class_mean, precision)
     return sample_class_mean, precision
 
-def get_Mahalanobis_score_adv(test_data, gaussian_score, grads, magnitude, scale):
-    grad_file = os.path.join(characteristics_dir, 'gradients_{}.npy'.format(set))
-    # if os.path.exists(grad_file):
-    #     print('loading gradients from {}'.format(grad_file))
-    #     gradients = np.load(grad_file)
-    # else:
-    gradients = batch_eval(sess, [x], grads, [test_data], FLAGS.batch_size)[0]
-    # print('Saving gradients to {}'.format(grad_file))
-    # np.save(grad_file, gradients)
-
-    gradients = gradients.clip(min=0)
-    gradients = (gradients - 0.5) * 2
-
-    # scale hyper params given from the official deep_Mahalanobis_detector repo:
-    RED_SCALE   = 0.2023 * scale
-    GREEN_SCALE = 0.1994 * scale
-    BLUE_SCALE  = 0.2010 * scale
-
-    gradients_scaled = np.zeros_like(gradients)
-    gradients_scaled[:, :, :, 0] = gradients[:, :, :, 0] / RED_SCALE
-    gradients_scaled[:, :, :, 1] = gradients[:, :, :, 1] / GREEN_SCALE
-    gradients_scaled[:, :, :, 2] = gradients[:, :, :, 2] / BLUE_SCALE
-
-    tempInputs = test_data - magnitude * gradients_scaled
-    noise_gaussian_score = batch_eval(sess, [x], [gaussian_score], [tempInputs], FLAGS.batch_size)[0]
-
-    Mahalanobis = np.max(noise_gaussian_score, axis=1)
-
-    return Mahalanobis
-
-def get_mahanabolis_tensors(sample_mean, precision, num_classes, layer):
-    # here we calculate the input gradients for -pure_tau. Meaning d(-pure_tau)/dx.
-    # First, how do we calculate pure_tau? This is a computation on a batch.
-    layer_index = int(layer[5:])
-
-    with tf.name_scope('Mahanabolis_grad_calc_'.format(layer)):
-        if FLAGS.only_last:
-            precision_mat      = tf.convert_to_tensor(precision[0]  , dtype=tf.float32)
-            sample_mean_tensor = tf.convert_to_tensor(sample_mean[0], dtype=tf.float32)
-        else:
-            precision_mat      = tf.convert_to_tensor(precision[layer_index]    , dtype=tf.float32)
-            sample_mean_tensor = tf.convert_to_tensor(sample_mean[layer_index]  , dtype=tf.float32)
-
-        out_features       = model.net[layer]
-        if len(out_features.shape) == 4:
-            num_spatial = num_of_spatial_activations[layer]
-            out_features = tf.reshape(out_features, [-1, num_spatial, out_features.shape[-1].value])
-            out_features = tf.reduce_mean(out_features, axis=1)
-        elif len(out_features.shape) == 2:
-            pass  # leave as is
-        else:
-            raise AssertionError('Expecting size of 2 or 4 but got {} for {}'.format(len(out_features.shape), layer))
-
-        for i in range(num_classes):
-            batch_sample_mean = sample_mean_tensor[i]
-            zero_f = out_features - batch_sample_mean
-            zero_f_T = tf.transpose(zero_f)
-            term_gau = -0.5 * tf.matmul(tf.matmul(zero_f, precision_mat), zero_f_T)
-            term_gau = tf.diag_part(term_gau)
-            if i == 0:
-                gaussian_score = tf.reshape(term_gau, (-1, 1))
-            else:
-                gaussian_score_tmp = tf.reshape(term_gau, (-1, 1))
-                gaussian_score = tf.concat([gaussian_score, gaussian_score_tmp], axis=1)
-
-        # Input_processing
-        sample_pred = tf.argmax(gaussian_score, axis=1)
-        batch_sample_mean = tf.gather(sample_mean_tensor, axis=0, indices=sample_pred)
-        zero_f = out_features - tf.identity(batch_sample_mean)
-        zero_f_T = tf.transpose(zero_f)
-        pure_gau = -0.5 * tf.matmul(tf.matmul(zero_f, tf.identity(precision_mat)), zero_f_T)  # 100x100
-        pure_gau = tf.diag_part(pure_gau)  # 100
-        gau_loss = tf.reduce_mean(-pure_gau)
-        grads = tf.gradients(gau_loss, x)
-
-    return gaussian_score, grads
-
-def find_ranks(sub_index, sorted_influence_indices, adversarial=False):
-
+def find_ranks(sub_index, helpful_indices, harmful_indices, adversarial=False):
+    """Batched lookup of the mean knn rank and distance of the helpful and harmful training indices, in all layers
+    :return: np.ndarray of shape [num_output, 4]: helpful ranks, helpful dists, harmful ranks, harmful dists
+    """
     if adversarial:
         ni = all_adv_ranks
         nd = all_adv_dists
@@ -671,23 +547,15 @@ def find_ranks(sub_index, sorted_influence_indices, adversarial=False):
         ni = all_normal_ranks
         nd = all_normal_dists
 
-    num_output = len(model.net)
-    ranks = -1 * np.ones((num_output, len(sorted_influence_indices)), dtype=np.int32)
-    dists = -1 * np.ones((num_output, len(sorted_influence_indices)), dtype=np.float32)
-
-    # print('Finding ranks for sub_index={} (adversarial={})'.format(sub_index, adversarial))
-    for target_idx in range(len(sorted_influence_indices)):  # for only some indices (say, 0:50 only)
-        idx = sorted_influence_indices[target_idx]  # selecting training sample index
-        for layer_index in range(num_output):
-            loc_in_knn = np.where(ni[sub_index, layer_index] == idx)[0][0]
-            knn_dist   = nd[sub_index, layer_index, loc_in_knn]
-            ranks[layer_index, target_idx] = loc_in_knn
-            dists[layer_index, target_idx] = knn_dist
+    # ni[sub_index, layer_index, idx] is the rank of training index idx (inverse permutation), for all the layers
+    target_indices = np.stack([helpful_indices, harmful_indices])  # [2, max_indices]
+    ranks = np.asarray(ni[sub_index])[:, target_indices]           # [num_output, 2, max_indices]
+    dists = np.asarray(nd[sub_index])[:, target_indices]
 
-    ranks_mean = np.mean(ranks, axis=1)
-    dists_mean = np.mean(dists, axis=1)
+    ranks_mean = np.mean(ranks, axis=2)
+    dists_mean = np.mean(dists, axis=2)
 
-    return ranks_mean, dists_mean
+    return np.stack([ranks_mean[:, 0], dists_mean[:, 0], ranks_mean[:, 1], dists_mean[:, 1]], axis=1)
 
 def get_nnif(X, subset, max_indices):
     """Returns the knn rank of every testing sample"""
@@ -720,14 +588,12 @@ def get_nnif(X, subset, max_indices):
         # collect pred scores:
         scores = np.load(os.path.join(index_dir, 'real', 'scores.npy'))
         sorted_indices = np.argsort(scores)
-        ranks[i, :, 0], ranks[i, :, 1] = find_ranks(i, sorted_indices[-max_indices:][::-1], adversarial=False)
-        ranks[i, :, 2], ranks[i, :, 3] = find_ranks(i, sorted_indices[:max_indices], adversarial=False)
+        ranks[i] = find_ranks(i, sorted_indices[-max_indices:][::-1], sorted_indices[:max_indices], adversarial=False)
 
         # collect adv scores:
         scores = np.load(os.path.join(index_dir, 'adv', FLAGS.attack, 'scores.npy'))
         sorted_indices = np.argsort(scores)
-        ranks_adv[i, :, 0], ranks_adv[i, :, 1] = find_ranks(i, sorted_indices[-max_indices:][::-1], adversarial=True)
-        ranks_adv[i, :, 2], ranks_adv[i, :, 3] = find_ranks(i, sorted_indices[:max_indices], adversarial=True)
+        ranks_adv[i] = find_ranks(i, sorted_indices[-max_indices:][::-1], sorted_indices[:max_indices], adversarial=True)
 
     print("{} ranks_normal: ".format(subset), ranks.shape)
     print("{} ranks_adv: ".format(subset), ranks_adv.shape)
@@ -736,170 +602,49 @@ def get_nnif(X, subset, max_indices):
 
     return ranks, ranks_adv
 
-# def get_calibration(X_cal, y_cal, X_train, y_train_sparse, k, num_classes):  # used for all layers. not relevant
-#     """
-#     :param X_cal: Calibration set
-#     :param y_cal: Calibration labels
-#     :param X_train: Training set
-#     :param y_train_sparse: training labels
-#     :param k: Num of nearest neighbors of DkNN defense
-#     :param num_classes: Number of classes in dataset
-#     :return: Both the calibration vector (calbiration_vec) and the knn dictionary (knn[<layer>(str)])
-#     """
-#     knn = {}
-#     num_output = len(model.net)
-#     knn_pred_cnt = np.zeros((X_cal.shape[0], num_output, num_classes))
-#
-#     # train_features = batch_eval(sess, [x], model.net.values(), [X_train], FLAGS.batch_size)
-#     # cal_features   = batch_eval(sess, [x], model.net.values(), [X_cal]  , FLAGS.batch_size)
-#
-#     train_features = batch_eval(sess, [x], model.net.values(), [X_train], FLAGS.batch_size)
-#     cal_features   = batch_eval(sess, [x], model.net.values(), [X_cal]  , FLAGS.batch_size)
-#
-#     for layer_index in range(num_output):
-#         layer = 'layer{}'.format(layer_index)
-#         if len(train_features[layer_index].shape) == 4:
-#             train_features[layer_index] = np.asarray(train_features[layer_index], dtype=np.float32).reshape((X_train.shape[0], -1, train_features[layer_index].shape[-1]))
-#             cal_features[layer_index]   = np.asarray(cal_features[layer_index]  , dtype=np.float32).reshape((X_cal.shape[0]  , -1, cal_features[layer_index].shape[-1]))
-#             train_features[layer_index] = np.mean(train_features[layer_index], axis=1)
-#             cal_features[layer_index]   = np.mean(cal_features[layer_index]  , axis=1)
-#         elif len(train_features[layer_index].shape) == 2:
-#             pass  # leave as is
-#         else:
-#             raise AssertionError('Expecting size of 2 or 4 but got {} for {}'.format(len(train_features[layer_index].shape), layer))
-#
-#         knn[layer] = KNeighborsClassifier(n_neighbors=k, p=2, n_jobs=20)
-#         knn[layer].fit(train_features[layer_index], y_train_sparse)
-#         knn_predict_prob = knn[layer].predict_proba(cal_features[layer_index])
-#         knn_pred_cnt[:, layer_index] = np.asarray(knn_predict_prob * k, dtype=np.int32)
-#
-#     # building the calibration vector
-#     calbiration_vec = np.zeros(X_cal.shape[0])
-#     for i in range(X_cal.shape[0]):
-#         label = y_cal[i]
-#         for layer_index in range(num_output):
-#             # how many wrong predictions do we have for the true label?
-#             calbiration_vec[i] += k - knn_pred_cnt[i, layer_index, label]
-#
-#     return calbiration_vec, knn
-
-def get_calibration(x_cal_features, y_cal, k):
-    knn = KNeighborsClassifier(n_neighbors=k, p=2, n_jobs=20)
-    knn.fit(x_train_features, y_train_sparse)
-
-    knn_predict_prob = knn.predict_proba(x_cal_features)
-    knn_pred_cnt = np.asarray(knn_predict_prob * k, dtype=np.int32)
-
-    # how many wrong predictions do we have for the true label?
-    calibration_vec = np.zeros(x_cal_features.shape[0])
-    for i in range(x_cal_features.shape[0]):
-        label = y_cal[i]
-        calibration_vec[i] = k - knn_pred_cnt[i, label]
-
-    return calibration_vec
-
-# def get_dknn_nonconformity(X, calbiration_vec, knn, num_classes, set):  # used for all layers. not relevant
-#     """
-#     :param X: data
-#     :param y: labels
-#     :param calbiration_vec: calibration vector
-#     :param knn: knn dict. knn[<layer>(str)]
-#     :param num_classes: number of classes
-#     :return: empirical p-value characteristics
-#     """
-#     k = knn['layer0'].n_neighbors
-#     num_output = len(model.net)
-#     knn_pred_cnt = np.zeros((X.shape[0], num_output, num_classes))
-#     empirical_p  = np.zeros((X.shape[0], num_classes))
-#
-#     out_features = batch_eval(sess, [x], model.net.values(), [X], FLAGS.batch_size)
-#
-#     # reshaping
-#     for layer_index in range(num_output):
-#         layer = 'layer{}'.format(layer_index)
-#         print('Calculating DkNN characteristics for set {}, layer{}'.format(set, layer))
-#         if len(out_features[layer_index].shape) == 4:
-#             out_features[layer_index] = np.asarray(out_features[layer_index], dtype=np.float32).reshape((X.shape[0], -1, out_features[layer_index].shape[-1]))
-#             out_features[layer_index] = np.mean(out_features[layer_index], axis=1)
-#         elif len(out_features[layer_index].shape) == 2:
-#             pass  # leave as is
-#         else:
-#             raise AssertionError('Expecting size of 2 or 4 but got {} for {}'.format(len(out_features[layer_index].shape), layer))
-#
-#         knn_predict_prob = knn[layer].predict_proba(out_features[layer_index])
-#         knn_pred_cnt[:, layer_index] = np.asarray(knn_predict_prob * k, dtype=np.int32)
-#
-#     print('now iterating over all the {} set'.format(set))
-#     for i in range(X.shape[0]):  # for every sample
-#         for j in range(num_classes):  # for every class
-#             nonconformity = 0
-#             for layer_index in range(num_output):
-#                 nonconformity += k - knn_pred_cnt[i, layer_index, j]
-#             num_of_greater_calib_values = np.sum(calbiration_vec >= nonconformity)
-#             empirical_p[i, j] = num_of_greater_calib_values / len(calbiration_vec)
-#
-#     return empirical_p
-
-def get_dknn_nonconformity(features, calibration_vec, k):
-    knn = KNeighborsClassifier(n_neighbors=k, p=2, n_jobs=20)
-    knn.fit(x_train_features, y_train_sparse)
-
-    knn_predict_prob = knn.predict_proba(features)
-    knn_pred_cnt = np.asarray(knn_predict_prob * k, dtype=np.int32)
-
-    # how many wrong predictions do we have for each label?
-    nonconformity = k - knn_pred_cnt
-
-    # get pj for every class
-    empirical_p = np.zeros_like(nonconformity, dtype=np.float32)
-    for i in range(len(nonconformity)):  # for every sample
-        for j in range(feeder.num_classes):  # for every class
-            num_of_greater_calib_values = np.sum(calibration_vec >= nonconformity[i, j])
-            empirical_p[i, j] = num_of_greater_calib_values / len(calibration_vec)
-
-    return empirical_p
+def collect_layers_gap(X):
+    """Streaming the activations of all the layers in model.net for X, global average pooling the 4-D layers on the
+    fly. Never holds the full [N, H, W, C] activations in memory"""
+    for layer in model.net.keys():
+        if len(model.net[layer].shape) not in [2, 4]:
+            raise AssertionError('Expecting size of 2 or 4 but got {} for {}'.format(len(model.net[layer].shape), layer))
+    return list(np_evaluate(sess, model.net.values(), X, None, x, y, FLAGS.batch_size,
+                            reducers=[global_average_pool] * len(model.net)))
 
 def get_knn_layers(X, y):
     knn = {}
 
-    train_features = batch_eval(sess, [x], model.net.values(), [X], FLAGS.batch_size)
+    train_features = collect_layers_gap(X)
     print('Fitting knn models on all layers: {}'.format(model.net.keys()))
     for layer_index, layer in enumerate(model.net.keys()):
-        if len(train_features[layer_index].shape) == 4:
-            train_features[layer_index] = np.asarray(train_features[layer_index], dtype=np.float32).reshape((X.shape[0], -1, train_features[layer_index].shape[-1]))
-            train_features[layer_index] = np.mean(train_features[layer_index], axis=1)
-        elif len(train_features[layer_index].shape) == 2:
-            pass  # leave as is
-        else:
-            raise AssertionError('Expecting size of 2 or 4 but got {} for {}'.format(len(train_features[layer_index].shape), layer))
-
-        knn[layer] = NearestNeighbors(n_neighbors=X.shape[0], p=2, n_jobs=20, algorithm='brute')
-        knn[layer].fit(train_features[layer_index], y)
+        knn[layer] = BlockedNNIndex(name='knn_{}'.format(layer))
+        knn[layer].fit(train_features[layer_index])
 
     del train_features
     return knn
 
-def calc_all_ranks_and_dists(X, subset, knn):
+def calc_all_ranks_and_dists(X, subset, knn, name):
+    """Calculating the knn rank and distance of every training sample, for every sample in X and every layer.
+    all_neighbor_ranks[i, layer_index, j] is the position of training sample j in the neighbors list of X[i].
+    The tables are memory-mapped to <characteristics_dir>/nn_index/<subset>_<name>_{ranks,dists}.npy"""
     num_output = len(model.net.keys())
-    n_neighbors = knn[knn.keys()[0]].n_neighbors
-    all_neighbor_ranks = -1 * np.ones((len(X), num_output, n_neighbors), dtype=np.int32)
-    all_neighbor_dists = -1 * np.ones((len(X), num_output, n_neighbors), dtype=np.float32)
-
-    features = batch_eval(sess, [x], model.net.values(), [X], FLAGS.batch_size)
+    n_train = knn[knn.keys()[0]].n_train
+    out_prefix = os.path.join(characteristics_dir, 'nn_index', '{}_{}'.format(subset, name))
+    if not os.path.exists(os.path.dirname(out_prefix)):
+        os.makedirs(os.path.dirname(out_prefix))
+    all_neighbor_ranks = np.lib.format.open_memmap(out_prefix + '_ranks.npy', mode='w+', dtype=np.int32, shape=(len(X), num_output, n_train))
+    all_neighbor_dists = np.lib.format.open_memmap(out_prefix + '_dists.npy', mode='w+', dtype=np.float32, shape=(len(X), num_output, n_train))
+
+    features = collect_layers_gap(X)
     for layer_index, layer in enumerate(model.net.keys()):
         print('Calculating ranks and distances for subset {} for layer {}'.format(subset, layer))
-        if len(features[layer_index].shape) == 4:
-            features[layer_index] = np.asarray(features[layer_index], dtype=np.float32).reshape((X.shape[0], -1, features[layer_index].shape[-1]))
-            features[layer_index] = np.mean(features[layer_index], axis=1)
-        elif len(features[layer_index].shape) == 2:
-            pass  # leave as is
-        else:
-            raise AssertionError('Expecting size of 2 or 4 but got {} for {}'.format(len(features[layer_index].shape), layer))
-
-        all_neighbor_dists[:, layer_index], all_neighbor_ranks[:, layer_index] = \
-            knn[layer].kneighbors(features[layer_index], return_distance=True)
+        knn[layer].rank_table(features[layer_index],
+                              ranks_out=all_neighbor_ranks[:, layer_index],
+                              dists_out=all_neighbor_dists[:, layer_index])
 
     del features
+    all_neighbor_ranks.flush()
+    all_neighbor_dists.flush()
     return all_neighbor_ranks, all_neighbor_dists
 
 def append_suffix(f, with_noisy=True):
@@ -920,10 +665,18 @@ if FLAGS.characteristics == 'lid':
     else:
         k_vec = [FLAGS.k_nearest]
 
+    # all the k values share the activations and the sorted distances of every batch
+    print('Extracting LID characteristics for k={}'.format(list(k_vec)))
+    val_characteristics = get_lid(X_val, X_val_noisy, X_val_adv, k_vec, 100)
+    end_val = time.time()
+    print('total feature extraction time for val: {} sec'.format(end_val - start))
+    test_characteristics = get_lid(X_test, X_test_noisy, X_test_adv, k_vec, 100)
+    end_test = time.time()
+    print('total feature extraction time for test: {} sec'.format(end_test - end_val))
+
     for k in tqdm(k_vec):
-        print('Extracting LID characteristics for k={}'.format(k))
         # for val set
-        characteristics, label = get_lid(X_val, X_val_noisy, X_val_adv, k, 100)
+        characteristics, label = val_characteristics[k]
         print("LID train: [characteristic shape: ", characteristics.shape, ", label shape: ", label.shape)
 
         file_name = 'k_{}_batch_{}_{}'.format(k, 100, 'train')
@@ -931,18 +684,14 @@ if FLAGS.characteristics == 'lid':
         file_name = os.path.join(characteristics_dir, file_name)
         data = np.concatenate((characteristics, label), axis=1)
         np.save(file_name, data)
-        end_val = time.time()
-        print('total feature extraction time for val: {} sec'.format(end_val - start))
 
         # for test set
-        characteristics, labels = get_lid(X_test, X_test_noisy, X_test_adv, k, 100)
+        characteristics, labels = test_characteristics[k]
         file_name = 'k_{}_batch_{}_{}'.format(k, 100, 'test')
         file_name = append_suffix(file_name)
         file_name = os.path.join(characteristics_dir, file_name)
         data = np.concatenate((characteristics, labels), axis=1)
         np.save(file_name, data)
-        end_test = time.time()
-        print('total feature extraction time for test: {} sec'.format(end_test - end_val))
 
 if FLAGS.characteristics == 'nnif':
     # assert FLAGS.only_last is True
@@ -965,8 +714,8 @@ if FLAGS.characteristics == 'nnif':
         knn_small_trainset = get_knn_layers(X_train_mini, y_train_mini_sparse)
 
         # val
-        all_normal_ranks, all_normal_dists = calc_all_ranks_and_dists(X_val, 'val', knn_large_trainset)
-        all_adv_ranks   , all_adv_dists    = calc_all_ranks_and_dists(X_val_adv, 'val', knn_large_trainset)
+        all_normal_ranks, all_normal_dists = calc_all_ranks_and_dists(X_val, 'val', knn_large_trainset, 'normal')
+        all_adv_ranks   , all_adv_dists    = calc_all_ranks_and_dists(X_val_adv, 'val', knn_large_trainset, 'adv')
         ranks, ranks_adv = get_nnif(X_val, 'val', max_indices)
         ranks     = ranks[:, :, sel_column]
         ranks_adv = ranks_adv[:, :, sel_column]
@@ -981,8 +730,8 @@ if FLAGS.characteristics == 'nnif':
         print('total feature extraction time for val: {} sec'.format(end_val - start))
 
         # test
-        all_normal_ranks, all_normal_dists = calc_all_ranks_and_dists(X_test, 'test', knn_small_trainset)
-        all_adv_ranks   , all_adv_dists    = calc_all_ranks_and_dists(X_test_adv, 'test', knn_small_trainset)
+        all_normal_ranks, all_normal_dists = calc_all_ranks_and_dists(X_test, 'test', knn_small_trainset, 'normal')
+        all_adv_ranks   , all_adv_dists    = calc_all_ranks_and_dists(X_test_adv, 'test', knn_small_trainset, 'adv')
         ranks, ranks_adv = get_nnif(X_test, 'test', max_indices)
         ranks[:, :, 0] *= (49/5)
         ranks[:, :, 2] *= (49/5)
@@ -1005,39 +754,40 @@ if FLAGS.characteristics == 'mahalanobis':
     print('get sample mean and covariance of the training set...')
     sample_mean, precision = sample_estimator(feeder.num_classes, X_train, y_train_sparse)
     print('Done calculating: sample_mean, precision.')
+    mahalanobis_tensors = {}  # layer -> (gaussian_score, grads), built once for all the sets
 
     if FLAGS.magnitude == -1:
         magnitude_vec = np.array([0.00001, 0.00002, 0.00005, 0.00008, 0.0001, 0.0002, 0.0005, 0.001, 0.002, 0.005, 0.008, 0.01])
     else:
         magnitude_vec = [FLAGS.magnitude]
 
-    for magnitude in tqdm(magnitude_vec):
-        print('Extracting Mahalanobis characteristics for magnitude={}'.format(magnitude))
+    print('Extracting Mahalanobis characteristics for magnitudes={}'.format(list(magnitude_vec)))
+    val_characteristics = get_mahalanobis(X_val, X_val_noisy, X_val_adv, magnitude_vec, sample_mean, precision, 'train')
+    end_val = time.time()
+    print('total feature extraction time for val: {} sec'.format(end_val - start))
+    test_characteristics = get_mahalanobis(X_test, X_test_noisy, X_test_adv, magnitude_vec, sample_mean, precision, 'test')
+    end_test = time.time()
+    print('total feature extraction time for test: {} sec'.format(end_test - end_val))
 
+    for magnitude in tqdm(magnitude_vec):
         # for val set
-        characteristics, label = get_mahalanobis(X_val, X_val_noisy, X_val_adv, magnitude, sample_mean, precision, 'train')
+        characteristics, label = val_characteristics[magnitude]
         print("Mahalanobis train: [characteristic shape: ", characteristics.shape, ", label shape: ", label.shape)
         file_name = 'magnitude_{}_scale_{}_{}'.format(magnitude, FLAGS.rgb_scale, 'train')
         file_name = append_suffix(file_name)
         file_name = os.path.join(characteristics_dir, file_name)
         data = np.concatenate((characteristics, label), axis=1)
         np.save(file_name, data)
-        end_val = time.time()
-        print('total feature extraction time for val: {} sec'.format(end_val - start))
 
         # for test set
-        characteristics, labels = get_mahalanobis(X_test, X_test_noisy, X_test_adv, magnitude, sample_mean, precision, 'test')
+        characteristics, labels = test_characteristics[magnitude]
         file_name = 'magnitude_{}_scale_{}_{}'.format(magnitude, FLAGS.rgb_scale, 'test')
         file_name = append_suffix(file_name)
         file_name = os.path.join(characteristics_dir, file_name)
         data = np.concatenate((characteristics, labels), axis=1)
         np.save(file_name, data)
-        end_test = time.time()
-        print('total feature extraction time for test: {} sec'.format(end_test - end_val))
 
 if FLAGS.characteristics == 'dknn':
-    assert FLAGS.only_last is True
-
     if FLAGS.k_nearest == -1:
         if FLAGS.dataset == 'cifar10':
             k_vec = np.arange(4000, 5600, 100)
@@ -1048,53 +798,70 @@ if FLAGS.characteristics == 'dknn':
     else:
         k_vec = [FLAGS.k_nearest]
 
-    for k in tqdm(k_vec):
-        print('Extracting DkNN characteristics for k={}'.format(k))
-        # divide the validation set for calibration and alphas
-        calibration_size = int(X_val.shape[0]/3)
-
-        X_cal          = X_val[:calibration_size]
-        x_cal_features = x_val_features[:calibration_size]
-        y_cal          = y_val_sparse[:calibration_size]
-
-        print("Calculating the calibration matrix...")
-        calibration_vec = get_calibration(x_cal_features, y_cal, k)
-        print("Done calculating the calibration matrix.")
-
-        X_val2              = X_val[calibration_size:]
-        y_val2              = y_val_sparse[calibration_size:]
-        x_val2_features     = x_val_features[calibration_size:]
-
-        X_val2_adv          = X_val_adv[calibration_size:]
-        y_val2_adv          = x_val_preds_adv[calibration_size:]
-        x_val2_features_adv = x_val_features_adv[calibration_size:]
+    # the features of the DkNN layers: only the embedding, or the (global average pooled) activations of all the layers
+    if FLAGS.only_last:
+        train_layers    = x_train_features
+        val_layers      = x_val_features
+        val_adv_layers  = x_val_features_adv
+        test_layers     = x_test_features
+        test_adv_layers = x_test_features_adv
+        file_suffix     = ''
+    else:
+        train_layers    = collect_layers_gap(X_train)
+        val_layers      = collect_layers_gap(X_val)
+        val_adv_layers  = collect_layers_gap(X_val_adv)
+        test_layers     = collect_layers_gap(X_test)
+        test_adv_layers = collect_layers_gap(X_test_adv)
+        file_suffix     = '_all_layers'
+
+    # divide the validation set for calibration and alphas
+    calibration_size = int(X_val.shape[0]/3)
+    y_cal            = y_val_sparse[:calibration_size]
+
+    def split_val(layers):
+        """:return: the calibration part and the rest of the per-layer validation features"""
+        if FLAGS.only_last:
+            return layers[:calibration_size], layers[calibration_size:]
+        return [l[:calibration_size] for l in layers], [l[calibration_size:] for l in layers]
+
+    x_cal_layers, val2_layers = split_val(val_layers)
+    _, val2_adv_layers        = split_val(val_adv_layers)
+
+    # all the k values share one fit and one neighbors query per set
+    print('Fitting DkNN for k={}'.format(list(k_vec)))
+    dknn = DkNN('dknn', k_vec, n_jobs=20, batch_size=1000)
+    dknn.fit(train_layers, y_train_sparse)
+    print("Calculating the calibration matrix...")
+    dknn.calibrate(x_cal_layers, y_cal)
+    print("Done calculating the calibration matrix.")
+
+    val_normal_characteristics  = dknn.p_values(val2_layers)
+    val_adv_characteristics     = dknn.p_values(val2_adv_layers)
+    end_val = time.time()
+    print('total feature extraction time for val: {} sec'.format(end_val - start))
+    test_normal_characteristics = dknn.p_values(test_layers)
+    test_adv_characteristics    = dknn.p_values(test_adv_layers)
+    end_test = time.time()
+    print('total feature extraction time for test: {} sec'.format(end_test - end_val))
 
+    for k in tqdm(k_vec):
+        print('Saving DkNN characteristics for k={}'.format(k))
         # set training set
-        val_normal_characteristics = get_dknn_nonconformity(x_val2_features, calibration_vec, k)
-        val_adv_characteristics    = get_dknn_nonconformity(x_val2_features_adv, calibration_vec, k)
-
-        dknn_neg = val_normal_characteristics
-        dknn_pos = val_adv_characteristics
+        dknn_neg = val_normal_characteristics[k]
+        dknn_pos = val_adv_characteristics[k]
         characteristics, labels = merge_and_generate_labels(dknn_pos, dknn_neg)
 
         print("DKNN train: [characteristic shape: ", characteristics.shape, ", label shape: ", labels.shape)
-        file_name = os.path.join(characteristics_dir, 'k_{}_train_noisy_{}.npy'.format(k, FLAGS.with_noise))
+        file_name = os.path.join(characteristics_dir, 'k_{}_train_noisy_{}{}.npy'.format(k, FLAGS.with_noise, file_suffix))
         data = np.concatenate((characteristics, labels), axis=1)
         np.save(file_name, data)
-        end_val = time.time()
-        print('total feature extraction time for val: {} sec'.format(end_val - start))
 
         # set testing set
-        test_normal_characteristics = get_dknn_nonconformity(x_test_features, calibration_vec, k)
-        test_adv_characteristics    = get_dknn_nonconformity(x_test_features_adv, calibration_vec, k)
-
-        dknn_neg = test_normal_characteristics
-        dknn_pos = test_adv_characteristics
+        dknn_neg = test_normal_characteristics[k]
+        dknn_pos = test_adv_characteristics[k]
         characteristics, labels = merge_and_generate_labels(dknn_pos, dknn_neg)
 
         print("DKNN test: [characteristic shape: ", characteristics.shape, ", label shape: ", labels.shape)
-        file_name = os.path.join(characteristics_dir, 'k_{}_test_noisy_{}.npy'.format(k, FLAGS.with_noise))
+        file_name = os.path.join(characteristics_dir, 'k_{}_test_noisy_{}{}.npy'.format(k, FLAGS.with_noise, file_suffix))
         data = np.concatenate((characteristics, labels), axis=1)
         np.save(file_name, data)
-        end_test = time.time()
-        print('total feature extraction time for test: {} sec'.format(end_test - end_val))
@@ -0,0 +1,41 @@
+"""Running a queue of experiment commands concurrently, in CPU/GPU resource slots (see utils/work_queue.run_queue).
+The jobs file has one shell command per line (empty lines and lines starting with # are ignored). Every slot is
+pinned to its own CPUs and its jobs are limited to them: OMP/MKL/OpenBLAS threads, and {threads} in the command,
+e.g. --KNN_JOBS {threads}. {gpu} and {slot} are replaced as well.
+The jobs state is kept in <jobs file>.state.json, so re-running this script skips the finished jobs.
+
+Example:
+python tensorflow_TB/scripts/job_queue.py --jobs sweep.txt --num_slots 8 --cpus_per_slot 5 --gpus 0,1,2,3
+with sweep.txt lines like:
+python scripts/test_automated.py --ROOT_DIR /data/logs/exp1 --KNN_JOBS {threads} -c examples/test/test_multi_knn.ini
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import sys
+import argparse
+from tensorflow_TB.utils.work_queue import Manifest, run_queue
+
+parser = argparse.ArgumentParser(description='Local experiments queue with resource slots')
+parser.add_argument('--jobs', type=str, required=True, help='file with one shell command per line')
+parser.add_argument('--state', default='', type=str, help='jobs state file. Default: <jobs>.state.json')
+parser.add_argument('--num_slots', default=4, type=int, help='number of jobs to run concurrently')
+parser.add_argument('--cpus_per_slot', default=0, type=int, help='CPUs of every slot. 0 to split all the CPUs evenly')
+parser.add_argument('--gpus', default='', type=str, help='comma separated GPU ids, assigned to the slots round robin')
+parser.add_argument('--retries', default=1, type=int, help='number of times to re-run a failed job')
+args = parser.parse_args()
+
+with open(args.jobs, 'r') as f:
+    cmds = [line.strip() for line in f]
+cmds = [cmd for i, cmd in enumerate(cmds) if cmd and not cmd.startswith('#') and cmd not in cmds[:i]]
+# the command itself is the job name, so editing a line of the jobs file makes it a new job
+jobs = [(cmd, cmd) for cmd in cmds]
+gpus = [gpu for gpu in args.gpus.split(',') if gpu != '']
+
+manifest = Manifest(args.state or args.jobs + '.state.json')
+failed = run_queue(jobs, manifest, args.num_slots, cpus_per_slot=args.cpus_per_slot, gpus=gpus, retries=args.retries)
+if failed:
+    print('{} jobs failed. Re-run this script to retry them:\n{}'.format(len(failed), '\n'.join(failed)))
+    sys.exit(1)
+print('all {} jobs are done'.format(len(jobs)))
@@ -0,0 +1,217 @@
+'''Streaming collection of DNN fetches (activations, predictions, etc.), with per-fetch reducers and optional
+memory-mapped outputs'''
+from __future__ import division
+from __future__ import absolute_import
+from __future__ import print_function
+
+import os
+import threading
+import numpy as np
+try:
+    import queue
+except ImportError:  # python 2
+    import Queue as queue
+
+# dataset name -> (dataset size attribute, eval iterator attribute). None means the iterator is never initialized
+DATASET_ITERATORS = {
+    'train'            : ('train_set_size'     , None),
+    'train_pool'       : ('pool_size'          , None),
+    'train_eval'       : ('train_set_size'     , 'train_eval_iterator'),
+    'train_pool_eval'  : ('pool_size'          , 'train_pool_eval_iterator'),
+    'train_unpool_eval': ('unpool_size'        , 'train_unpool_eval_iterator'),
+    'train_random_eval': ('train_set_size'     , 'train_random_eval_iterator'),
+    'validation'       : ('validation_set_size', 'validation_iterator'),
+    'test'             : ('test_set_size'      , 'test_iterator'),
+}
+
+
+def init_dataset_iterator(dataset, dataset_name, sess, log):
+    """
+    Initializing the eval iterator of dataset_name (if it has one)
+    :param dataset: dataset wrapper
+    :param dataset_name: e.g. 'train_eval', 'validation', 'test'
+    :param sess: tf.Session
+    :param log: logger
+    :return: number of samples in dataset_name
+    """
+    if dataset_name not in DATASET_ITERATORS:
+        err_str = 'dataset_name={} is not supported'.format(dataset_name)
+        log.error(err_str)
+        raise AssertionError(err_str)
+
+    size_attr, iterator_attr = DATASET_ITERATORS[dataset_name]
+    if iterator_attr is not None:
+        sess.run(getattr(dataset, iterator_attr).initializer)
+    return getattr(dataset, size_attr)
+
+
+def batch_ranges(num_samples, batch_size):
+    """Generating the (begin, end) indices of all the batches"""
+    for b in range(0, num_samples, batch_size):
+        yield b, min(b + batch_size, num_samples)
+
+
+def prefetch(generator, buffer_size=1):
+    """
+    Running a generator in a background thread, so the next items are produced while the current one is consumed.
+    If the consumer stops early (an exception or leaving the loop), the producer is stopped before the next item and
+    joined, so it never runs on (e.g. a shared dataset iterator) after prefetch returns
+    :param generator: any iterable
+    :param buffer_size: number of items to produce ahead
+    :return: generator of the same items
+    """
+    q        = queue.Queue(maxsize=buffer_size)
+    sentinel = object()
+    errors   = []
+    stop     = threading.Event()
+
+    def producer():
+        iterator = iter(generator)
+        try:
+            while not stop.is_set():
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    break
+                q.put(item)
+        except Exception as e:
+            errors.append(e)
+        q.put(sentinel)
+
+    thread = threading.Thread(target=producer)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            item = q.get()
+            if item is sentinel:
+                break
+            yield item
+    finally:
+        stop.set()
+        # draining, so a producer blocked on put() wakes up, sees the stop event and exits
+        while thread.is_alive():
+            try:
+                q.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        thread.join()
+    if errors:
+        raise errors[0]
+
+
+def dataset_batches(agent, dataset_name):
+    """
+    Streaming the eval batches of a dataset split, as fed to the model
+    :param agent: agent with a session (plain_sess), batch size (eval_batch_size), logger (log), dataset and model
+    :param dataset_name: e.g. 'train_eval', 'validation', 'test'
+    :return: number of samples, generator of (b, e, feed_dict) with the images/labels/is_training feeds
+    """
+    model = agent.model
+    sess  = agent.plain_sess
+    num_samples = init_dataset_iterator(agent.dataset, dataset_name, sess, agent.log)
+
+    def generator():
+        for b, e in batch_ranges(num_samples, agent.eval_batch_size):
+            _, images, labels = agent.dataset.get_mini_batch(dataset_name, sess)
+            yield b, e, {model.images: images,
+                         model.labels: labels,
+                         model.is_training: False}
+
+    return num_samples, generator()
+
+
+def numpy_batches(num_samples, batch_size, placeholders_and_sets):
+    """
+    Streaming batches of numpy arrays
+    :param num_samples: number of samples in every set
+    :param batch_size: batch size
+    :param placeholders_and_sets: list of (tf.placeholder, np.ndarray) to feed
+    :return: generator of (b, e, feed_dict)
+    """
+    for b, e in batch_ranges(num_samples, batch_size):
+        yield b, e, {ph: arr[b:e] for ph, arr in placeholders_and_sets}
+
+
+def global_average_pool(x):
+    """Reducing [N, H, W, C] activations to [N, C]. Other ranks are returned as is"""
+    if x.ndim == 4:
+        return x.mean(axis=(1, 2))
+    return x
+
+
+def pca_reducer(pca):
+    """
+    :param pca: fitted sklearn PCA (or any object with transform)
+    :return: reducer projecting (flattened) activations with pca
+    """
+    def reducer(x):
+        return pca.transform(x.reshape((x.shape[0], -1)))
+    return reducer
+
+
+def top_k_reducer(k):
+    """
+    :param k: number of values to keep
+    :return: reducer keeping the k largest (flattened) activations of every sample, in descending order
+    """
+    def reducer(x):
+        x = x.reshape((x.shape[0], -1))
+        top = np.partition(x, x.shape[1] - k, axis=1)[:, -k:]
+        return -np.sort(-top, axis=1)
+    return reducer
+
+
+def stream_collect(sess, fetches, batches, num_samples, reducers=None, out_files=None, log=None):
+    """
+    Running fetches on streamed batches and storing the (reduced) outputs.
+    The next batch is prepared in a background thread while the current one runs. Output buffers are allocated
+    after the first batch, with the reduced shape, so e.g. 4-D conv activations reduced by global_average_pool never
+    occupy [N, H, W, C] memory.
+    :param sess: tf.Session
+    :param fetches: list of tf tensors
+    :param batches: generator of (b, e, feed_dict)
+    :param num_samples: total number of samples in all the batches
+    :param reducers: optional list of callables (or None for identity), one per fetch, applied on every batch output
+    :param out_files: optional list of .npy paths (or None for in-memory), one per fetch. Outputs are written to
+                      memory-mapped files
+    :param log: logger. If None, progress is printed
+    :return: tuple of np.ndarray (or np.memmap), as float32
+    """
+    if reducers is None:
+        reducers = [None] * len(fetches)
+    if out_files is None:
+        out_files = [None] * len(fetches)
+
+    fetches_np = [None] * len(fetches)
+    progress_step = max(1, num_samples // 10)
+    next_progress = progress_step
+
+    for b, e, feed_dict in prefetch(batches):
+        fetches_out = sess.run(fetches=fetches, feed_dict=feed_dict)
+        for i in range(len(fetches)):
+            out = np.asarray(fetches_out[i])
+            if reducers[i] is not None:
+                out = reducers[i](out)
+            if fetches_np[i] is None:
+                shape = (num_samples,) + out.shape[1:]
+                if out_files[i] is None:
+                    fetches_np[i] = np.empty(shape, dtype=np.float32)
+                else:
+                    if not os.path.exists(os.path.dirname(os.path.abspath(out_files[i]))):
+                        os.makedirs(os.path.dirname(os.path.abspath(out_files[i])))
+                    fetches_np[i] = np.lib.format.open_memmap(out_files[i], mode='w+', dtype=np.float32, shape=shape)
+            fetches_np[i][b:e] = np.reshape(out, (e - b,) + fetches_np[i].shape[1:])
+
+        if e >= next_progress or e == num_samples:
+            next_progress = e + progress_step
+            progress_str = 'Storing completed: {}%'.format(int(100.0 * e / num_samples))
+            if log is None:
+                print(progress_str)
+            else:
+                log.info(progress_str)
+
+    for arr in fetches_np:
+        if isinstance(arr, np.memmap):
+            arr.flush()
+    return tuple(fetches_np)
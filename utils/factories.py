@@ -145,7 +145,10 @@ class Factories(object):
                                'most_uncertained_knn'               : alf.most_uncertained_knn,
                                'min_mul_dnn_max_knn_same'           : alf.min_mul_dnn_max_knn_same,
                                'most_uncertained_following_min_corr': alf.most_uncertained_following_min_corr,
-                               'min_corr_following_most_uncertained': alf.min_corr_following_most_uncertained}
+                               'min_corr_following_most_uncertained': alf.min_corr_following_most_uncertained,
+                               'most_uncertained_dnn_entropy'       : alf.most_uncertained_dnn_entropy,
+                               'most_uncertained_dnn_margin'        : alf.most_uncertained_dnn_margin,
+                               'max_expected_cross_entropy'         : alf.max_expected_cross_entropy}
         if self.active_selection_criterion in available_functions:
             function = available_functions[self.active_selection_criterion]
             self.log.info('get_active_selection_fn: returning ' + self.active_selection_criterion)
@@ -14,6 +14,7 @@ from math import ceil
 import time
 import datetime
 import re
+from tensorflow_TB.utils.collector import init_dataset_iterator, dataset_batches, numpy_batches, stream_collect
 
 def numericalSort(value):
     numbers = re.compile(r'(\d+)')
@@ -101,13 +102,14 @@ def get_plain_session(sess):
         session = session._sess
     return session
 
-def np_evaluate(sess, fetches, x_set, y_set, x, y, batch_size, feed_dict=None, log=None, y_adv=None, y_adv_set=None):
+def np_evaluate(sess, fetches, x_set, y_set, x, y, batch_size, feed_dict=None, log=None, y_adv=None, y_adv_set=None,
+                reducers=None, out_files=None):
     """
     Collecting tensorfow operators in a numpy API
     :param sess: tf.Session
     :param fetches: list of all the tf tensors (tf.Tensor) to collect
     :param x_set: dataset in np.ndarray
-    :param y_set: dataset labels in np.ndarray
+    :param y_set: dataset labels in np.ndarray. None if y is not fed
     :param x: input placeholder (tf.placeholder) with size of [? , x_set.shape[1:]]
     :param y: label placeholder (tf.placeholder). one hot
     :param batch_size: batch size to process
@@ -115,43 +117,27 @@ def np_evaluate(sess, fetches, x_set, y_set, x, y, batch_size, feed_dict=None, l
     :param log: logger
     :param y_adv: adversarial placeholder (tf.placeholder)
     :param y_adv_set: adversarial data in np.array
+    :param reducers: optional list of per-fetch reducers (see utils.collector), e.g. global_average_pool
+    :param out_files: optional list of per-fetch .npy paths to write memory-mapped outputs to
     :return: fetches as np.ndarray.
     """
-
     if feed_dict is None:
         feed_dict = {}
 
-    num_samples = len(x_set)
-    batch_count = int(ceil(num_samples / batch_size))
-    last_batch_size = num_samples % batch_size
+    placeholders_and_sets = [(x, x_set)]
+    if y_set is not None:
+        placeholders_and_sets.append((y, y_set))
+    if y_adv is not None:
+        placeholders_and_sets.append((y_adv, y_adv_set))
 
-    fetches_dims = [(num_samples,) + tuple(fetches[i].get_shape().as_list()[1:]) for i in xrange(len(fetches))]
-    fetches_np = [np.empty(fetches_dims[i], dtype=np.float32) for i in xrange(len(fetches))]
+    def batches():
+        for b, e, tmp_feed_dict in numpy_batches(len(x_set), batch_size, placeholders_and_sets):
+            tmp_feed_dict.update(feed_dict)
+            yield b, e, tmp_feed_dict
 
-    for i in range(batch_count):
-        b = i * batch_size
-        if i < (batch_count - 1) or (last_batch_size == 0):
-            e = (i + 1) * batch_size
-        else:
-            e = i * batch_size + last_batch_size
-        images = x_set[b:e]
-        labels = y_set[b:e]
-        tmp_feed_dict = {x: images, y: labels}
-        if y_adv is not None:
-            adv_labels = y_adv_set[b:e]
-            tmp_feed_dict.update({y_adv: adv_labels})
-        tmp_feed_dict.update(feed_dict)
-        fetches_out = sess.run(fetches=fetches, feed_dict=tmp_feed_dict)
-        for i in xrange(len(fetches)):
-            fetches_np[i][b:e] = np.reshape(fetches_out[i], (e - b,) + fetches_dims[i][1:])
-        progress_str = 'Storing completed: {}%'.format(int(100.0 * e / num_samples))
-        if log is None:
-            print(progress_str)
-        else:
-            log.info(progress_str)
-    return tuple(fetches_np)
+    return stream_collect(sess, fetches, batches(), len(x_set), reducers=reducers, out_files=out_files, log=log)
 
-def collect_features(agent, dataset_name, fetches, feed_dict=None):
+def collect_features(agent, dataset_name, fetches, feed_dict=None, reducers=None, out_files=None):
     """Collecting all fetches from the DNN in the dataset (train/validation/test/train_eval)
     :param agent: The agent (trainer/tester).
                   Must have a session (sess), batch size (eval_batch_size), logger (log) and dataset wrapper (dataset)
@@ -159,64 +145,44 @@ def collect_features(agent, dataset_name, fetches, feed_dict=None):
     :param dataset_name: 'train', 'validation' or "test"
     :param fetches: list of all the fetches to sample from the DNN.
     :param feed_dict: feed_dict to sess.run, other than images/labels/is_training.
+    :param reducers: optional list of per-fetch reducers (see utils.collector), e.g. global_average_pool
+    :param out_files: optional list of per-fetch .npy paths to write memory-mapped outputs to
     :return: fetches, as numpy float32.
     """
     if feed_dict is None:
         feed_dict = {}
 
-    batch_size = agent.eval_batch_size
-    log        = agent.log
-    model      = agent.model
-    dataset    = agent.dataset
-    sess       = agent.plain_sess
+    num_samples, dataset_batches_gen = dataset_batches(agent, dataset_name)
 
-    if dataset_name == 'train_eval':
-        num_samples = dataset.train_set_size
-        sess.run(dataset.train_eval_iterator.initializer)
-    elif dataset_name == 'train_pool_eval':
-        num_samples = dataset.pool_size
-        sess.run(dataset.train_pool_eval_iterator.initializer)
-    elif dataset_name == 'train_unpool_eval':
-        num_samples = dataset.unpool_size
-        sess.run(dataset.train_unpool_eval_iterator.initializer)
-    elif dataset_name == 'train_random_eval':
-        num_samples = dataset.train_set_size
-        sess.run(dataset.train_random_eval_iterator.initializer)
-    elif dataset_name == 'validation':
-        num_samples = dataset.validation_set_size
-        sess.run(dataset.validation_iterator.initializer)
-    elif dataset_name == 'test':
-        num_samples = dataset.test_set_size
-        sess.run(dataset.test_iterator.initializer)
-    else:
-        err_str = 'dataset_name={} is not supported'.format(dataset_name)
-        log.error(err_str)
-        raise AssertionError(err_str)
+    def batches():
+        for b, e, tmp_feed_dict in dataset_batches_gen:
+            tmp_feed_dict.update(feed_dict)
+            yield b, e, tmp_feed_dict
 
-    fetches_dims = [(num_samples,) + tuple(fetches[i].get_shape().as_list()[1:]) for i in xrange(len(fetches))]
+    agent.log.info('start storing 2d fetches for {} samples in the {} set.'.format(num_samples, dataset_name))
+    return stream_collect(agent.plain_sess, fetches, batches(), num_samples,
+                          reducers=reducers, out_files=out_files, log=agent.log)
 
-    batch_count     = int(ceil(num_samples / batch_size))
-    last_batch_size =          num_samples % batch_size
-    fetches_np = [np.empty(fetches_dims[i], dtype=np.float32) for i in xrange(len(fetches))]
 
-    log.info('start storing 2d fetches for {} samples in the {} set.'.format(num_samples, dataset_name))
-    for i in range(batch_count):
-        b = i * batch_size
-        if i < (batch_count - 1) or (last_batch_size == 0):
-            e = (i + 1) * batch_size
-        else:
-            e = i * batch_size + last_batch_size
-        _, images, labels = dataset.get_mini_batch(dataset_name, sess)
-        tmp_feed_dict = {model.images: images,
-                         model.labels: labels,
-                         model.is_training: False}
-        tmp_feed_dict.update(feed_dict)
-        fetches_out = sess.run(fetches=fetches, feed_dict=tmp_feed_dict)
-        for i in xrange(len(fetches)):
-            fetches_np[i][b:e] = np.reshape(fetches_out[i], (e - b,) + fetches_dims[i][1:])
-        log.info('Storing completed: {}%'.format(int(100.0 * e / num_samples)))
+def mc_dropout(x, keep_prob, num_samples, normalize=False, rand_gen=None):
+    """Monte-Carlo dropout samples of pre-dropout features, equivalent to running tf.nn.dropout (followed by
+    tf.nn.l2_normalize if normalize) num_samples times, without running the network again
+    :param x: pre-dropout features ([N, D])
+    :param keep_prob: probability to keep every feature
+    :param num_samples: number of stochastic samples
+    :param normalize: whether or not to L2-normalize every sample after the dropout
+    :param rand_gen: np.random.RandomState. If None, the global numpy random generator is used
+    :return: generator of num_samples np.ndarray of float32 ([N, D]), drawn one at a time
+    """
+    if rand_gen is None:
+        rand_gen = np.random
+    x = np.asarray(x, dtype=np.float32) / np.float32(keep_prob)
+    for _ in range(num_samples):
+        sample = x * (rand_gen.uniform(size=x.shape) < keep_prob)
+        if normalize:
+            sample /= np.sqrt(np.maximum(np.sum(sample ** 2, axis=-1, keepdims=True), 1e-12))
+        yield sample
 
-    return tuple(fetches_np)
 
 def collect_features_1d(agent, dataset_name, fetches, feed_dict=None):
     """Collecting all fetches from the DNN in the dataset (train/validation/test/train_eval)
@@ -239,29 +205,7 @@ def collect_features_1d(agent, dataset_name, fetches, feed_dict=None):
     dataset    = agent.dataset
     sess       = agent.plain_sess
 
-    if dataset_name == 'train':
-        num_samples = dataset.train_set_size
-    elif dataset_name == 'train_pool':
-        num_samples = dataset.pool_size
-    elif dataset_name == 'train_eval':
-        num_samples = dataset.train_set_size
-        sess.run(dataset.train_eval_iterator.initializer)
-    elif dataset_name == 'train_pool_eval':
-        num_samples = dataset.pool_size
-        sess.run(dataset.train_pool_eval_iterator.initializer)
-    elif dataset_name == 'train_random_eval':
-        num_samples = dataset.train_set_size
-        sess.run(dataset.train_random_eval_iterator.initializer)
-    elif dataset_name == 'validation':
-        num_samples = dataset.validation_set_size
-        sess.run(dataset.validation_iterator.initializer)
-    elif dataset_name == 'test':
-        num_samples = dataset.test_set_size
-        sess.run(dataset.test_iterator.initializer)
-    else:
-        err_str = 'dataset_name={} is not supported'.format(dataset_name)
-        log.error(err_str)
-        raise AssertionError(err_str)
+    num_samples = init_dataset_iterator(dataset, dataset_name, sess, log)
 
     batch_count     = int(ceil(num_samples / batch_size))
     last_batch_size =          num_samples % batch_size
@@ -332,6 +332,7 @@ class ParametersTrainControl(parser_utils.FrozenClass):
         self.STEPS_FOR_NEW_ANNOTATIONS = None # integer: global steps to add annotations
         self.INIT_AFTER_ANNOT      = None  # Whether or not to initialize network weights after annotation phase
         self.ACTIVE_SELECTION_CRITERION = None  # string: the method for the active learning
+        self.GRAPH_INPUT           = None  # boolean: wire the model inputs to the dataset iterator instead of feeding placeholders
 
         self.learning_rate_setter     = ParametersTrainControlLearningRateSetter()
         self.margin_multiplier_setter = ParametersTrainControlMarginMultiplierSetter()
@@ -370,6 +371,7 @@ class ParametersTrainControl(parser_utils.FrozenClass):
         self.set_to_config(do_save_none, section_name, config, 'STEPS_FOR_NEW_ANNOTATIONS' , self.STEPS_FOR_NEW_ANNOTATIONS)
         self.set_to_config(do_save_none, section_name, config, 'INIT_AFTER_ANNOT'     , self.INIT_AFTER_ANNOT)
         self.set_to_config(do_save_none, section_name, config, 'ACTIVE_SELECTION_CRITERION', self.ACTIVE_SELECTION_CRITERION)
+        self.set_to_config(do_save_none, section_name, config, 'GRAPH_INPUT'          , self.GRAPH_INPUT)
 
         self.learning_rate_setter.save_to_ini(do_save_none, section_name, config)
         self.margin_multiplier_setter.save_to_ini(do_save_none, section_name, config)
@@ -403,6 +405,7 @@ class ParametersTrainControl(parser_utils.FrozenClass):
         self.parse_from_config(self, override_mode, section_name, parser, 'STEPS_FOR_NEW_ANNOTATIONS' , np.array)
         self.parse_from_config(self, override_mode, section_name, parser, 'INIT_AFTER_ANNOT'     , bool)
         self.parse_from_config(self, override_mode, section_name, parser, 'ACTIVE_SELECTION_CRITERION', str)
+        self.parse_from_config(self, override_mode, section_name, parser, 'GRAPH_INPUT'          , bool)
 
         self.learning_rate_setter.set_from_file(override_mode, section_name, parser)
         self.margin_multiplier_setter.set_from_file(override_mode, section_name, parser)
@@ -553,6 +556,8 @@ class ParametersTestControl(parser_utils.FrozenClass):
         self.COLLECTED_LAYERS      = None  # list of strings: layers to collect knn scores from
         self.APPLY_RELU            = None  # boolean: whether to apply ReLU activation for the sampled layer
         self.APPLY_GAP             = None  # boolean: whether to apply global average pooling for the sampled layer
+        self.FEATURE_STORE_DIR     = None  # string: root dir of the persistent feature store. None disables the store
+        self.ASYNC_METRICS         = None  # boolean: whether to evaluate the KNN/SVM/LR metrics in a background process
 
         self._freeze()
 
@@ -578,6 +583,8 @@ class ParametersTestControl(parser_utils.FrozenClass):
         self.set_to_config(do_save_none, section_name, config, 'COLLECTED_LAYERS'     , self.COLLECTED_LAYERS)
         self.set_to_config(do_save_none, section_name, config, 'APPLY_RELU'           , self.APPLY_RELU)
         self.set_to_config(do_save_none, section_name, config, 'APPLY_GAP'            , self.APPLY_GAP)
+        self.set_to_config(do_save_none, section_name, config, 'FEATURE_STORE_DIR'    , self.FEATURE_STORE_DIR)
+        self.set_to_config(do_save_none, section_name, config, 'ASYNC_METRICS'        , self.ASYNC_METRICS)
 
     def set_from_file(self, override_mode, txt, parser):
         section_name = self.add_section(txt, self.name())
@@ -598,6 +605,8 @@ class ParametersTestControl(parser_utils.FrozenClass):
         self.parse_from_config(self, override_mode, section_name, parser, 'COLLECTED_LAYERS', list)
         self.parse_from_config(self, override_mode, section_name, parser, 'APPLY_RELU'      , bool)
         self.parse_from_config(self, override_mode, section_name, parser, 'APPLY_GAP'       , bool)
+        self.parse_from_config(self, override_mode, section_name, parser, 'FEATURE_STORE_DIR', str)
+        self.parse_from_config(self, override_mode, section_name, parser, 'ASYNC_METRICS'   , bool)
 
 class ParametersTestEnsemble(parser_utils.FrozenClass):
     def __init__(self):
@@ -0,0 +1,236 @@
+'''Local work distribution utilities: a persistent completion manifest, a sharded process pool and a job queue with
+CPU/GPU resource slots'''
+from __future__ import division
+from __future__ import absolute_import
+from __future__ import print_function
+
+import os
+import json
+import time
+import fcntl
+import subprocess
+import multiprocessing
+from contextlib import contextmanager
+
+# thread pool sizes of the numerical libraries, limited to the CPUs of every job slot
+THREAD_ENV_VARS = ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS']
+
+
+@contextmanager
+def file_lock(lock_path):
+    """Exclusive inter-process lock on lock_path (created if missing), released on exit"""
+    with open(lock_path, 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+class Manifest(object):
+    """
+    Persistent {key: {'status': ..., ...}} state, shared by processes on the same machine.
+    Every update re-reads the file under an exclusive lock and rewrites it atomically (temp file + rename), so
+    concurrent workers never lose each other's updates and a crash never leaves a corrupted manifest.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: path to the manifest .json file
+        """
+        self.path = path
+        self.lock_path = path + '.lock'
+        out_dir = os.path.dirname(os.path.abspath(path))
+        if not os.path.exists(out_dir):
+            os.makedirs(out_dir)
+
+    def _locked(self):
+        return file_lock(self.lock_path)
+
+    def _read(self):
+        if not os.path.isfile(self.path):
+            return {}
+        with open(self.path, 'r') as f:
+            return json.load(f)
+
+    def _write(self, state):
+        tmp_path = self.path + '.tmp.{}'.format(os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f, sort_keys=True, indent=2)
+        os.rename(tmp_path, self.path)
+
+    def load(self):
+        """:return: the entire state (dictionary)"""
+        with self._locked():
+            return self._read()
+
+    def status(self, key):
+        """:return: the status of key, or None if it was never recorded"""
+        return self.load().get(key, {}).get('status')
+
+    def mark(self, key, status, **info):
+        """
+        Recording the status of key
+        :param key: string
+        :param status: string, e.g. 'running', 'done', 'failed'
+        :param info: any other (json serializable) info to record
+        :return: None
+        """
+        with self._locked():
+            state = self._read()
+            entry = {'status': status, 'time': time.time()}
+            entry.update(info)
+            state[key] = entry
+            self._write(state)
+
+    def pending(self, keys, done_statuses=('done',)):
+        """:return: the keys which are not in done_statuses, in their original order"""
+        state = self.load()
+        return [key for key in keys if state.get(key, {}).get('status') not in done_statuses]
+
+
+def shard(items, shard_index, num_shards):
+    """Interleaved split of items, so every shard gets a similar mix of early and late items"""
+    if num_shards <= 1:
+        return items
+    return items[shard_index::num_shards]
+
+
+def run_sharded(cmd_fn, num_shards, gpus=None, retries=0, poll_secs=5, log=print):
+    """
+    Running num_shards worker processes concurrently, retrying failed shards.
+    Workers are expected to be resumable (e.g. skip work marked as done in a Manifest), so a retry only redoes
+    the work that was not finished.
+    :param cmd_fn: function mapping a shard index to a shell command
+    :param num_shards: number of shards (processes)
+    :param gpus: optional list of GPU ids. Shard i runs with CUDA_VISIBLE_DEVICES=gpus[i % len(gpus)]
+    :param retries: number of times to re-run a failed shard
+    :param poll_secs: seconds between polling the processes
+    :param log: logging function
+    :return: list of the shards that failed after all the retries
+    """
+    def launch(shard_index):
+        env = os.environ.copy()
+        if gpus:
+            env['CUDA_VISIBLE_DEVICES'] = str(gpus[shard_index % len(gpus)])
+        cmd = cmd_fn(shard_index)
+        log('launching shard {}/{}: {}'.format(shard_index, num_shards, cmd))
+        return subprocess.Popen(cmd, shell=True, env=env)
+
+    attempts  = {i: 0 for i in range(num_shards)}
+    running   = {i: launch(i) for i in range(num_shards)}
+    failed    = []
+    while running:
+        time.sleep(poll_secs)
+        for shard_index, process in list(running.items()):
+            ret = process.poll()
+            if ret is None:
+                continue
+            del running[shard_index]
+            if ret == 0:
+                log('shard {} finished'.format(shard_index))
+            elif attempts[shard_index] < retries:
+                attempts[shard_index] += 1
+                log('shard {} failed with exit code {}. Retrying ({}/{})'
+                    .format(shard_index, ret, attempts[shard_index], retries))
+                running[shard_index] = launch(shard_index)
+            else:
+                log('shard {} failed with exit code {}'.format(shard_index, ret))
+                failed.append(shard_index)
+    return failed
+
+
+def available_cpus():
+    """:return: sorted list of the CPU ids this process may run on"""
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(multiprocessing.cpu_count()))
+
+
+def slot_cpus(num_slots, cpus_per_slot, cpus=None):
+    """
+    Splitting the CPUs into disjoint sets, one per slot
+    :param num_slots: number of concurrent slots
+    :param cpus_per_slot: number of CPUs of every slot. 0 to split all the available CPUs evenly
+    :param cpus: CPU ids to split. Default: available_cpus()
+    :return: list (one per slot) of lists of CPU ids
+    """
+    if cpus is None:
+        cpus = available_cpus()
+    if cpus_per_slot == 0:
+        cpus_per_slot = max(1, len(cpus) // num_slots)
+    if num_slots * cpus_per_slot > len(cpus):
+        raise AssertionError('{} slots of {} CPUs need {} CPUs, but only {} are available'
+                             .format(num_slots, cpus_per_slot, num_slots * cpus_per_slot, len(cpus)))
+    return [cpus[i * cpus_per_slot:(i + 1) * cpus_per_slot] for i in range(num_slots)]
+
+
+def slot_env(cpus, gpu=None):
+    """:return: environment limiting the BLAS/OpenMP thread pools to the slot CPUs, and pinning the slot GPU"""
+    env = os.environ.copy()
+    for var in THREAD_ENV_VARS:
+        env[var] = str(len(cpus))
+    if gpu is not None:
+        env['CUDA_VISIBLE_DEVICES'] = str(gpu)
+    return env
+
+
+def run_queue(jobs, manifest, num_slots, cpus_per_slot=0, gpus=None, retries=0, poll_secs=5, log=print):
+    """
+    Running a queue of shell commands in num_slots concurrent slots. Every slot is pinned to its own CPUs (taskset)
+    and limits the threads of its job to them (OMP/MKL/OpenBLAS env vars, and {threads} in the command, e.g.
+    --KNN_JOBS {threads}). Jobs recorded as done in the manifest are skipped, so re-running a queue after a crash or
+    a restart only runs the unfinished jobs.
+    :param jobs: list of (name, cmd). name is the manifest key. cmd may contain {threads}, {slot} and {gpu}
+    :param manifest: Manifest of the jobs state
+    :param num_slots: number of jobs to run concurrently
+    :param cpus_per_slot: number of CPUs of every slot. 0 to split all the available CPUs evenly
+    :param gpus: optional list of GPU ids. Slot i runs with CUDA_VISIBLE_DEVICES=gpus[i % len(gpus)]
+    :param retries: number of times to re-run a failed job
+    :param poll_secs: seconds between polling the processes
+    :param log: logging function
+    :return: list of the names of the jobs that failed after all the retries
+    """
+    cpus_of_slot = slot_cpus(num_slots, cpus_per_slot)
+    pending      = set(manifest.pending([name for name, _ in jobs]))
+    queue        = [(name, cmd) for name, cmd in jobs if name in pending]
+    log('{} of {} jobs are pending, running in {} slots of {} CPUs'
+        .format(len(queue), len(jobs), num_slots, len(cpus_of_slot[0])))
+
+    def launch(slot, name, cmd, attempt):
+        cpus = cpus_of_slot[slot]
+        gpu  = gpus[slot % len(gpus)] if gpus else None
+        cmd  = cmd.replace('{threads}', str(len(cpus))).replace('{slot}', str(slot)).replace('{gpu}', str(gpu))
+        log('slot {}: launching job {} (attempt {}): {}'.format(slot, name, attempt, cmd))
+        manifest.mark(name, 'running', slot=slot, attempt=attempt, cmd=cmd)
+        return subprocess.Popen('taskset -c {} {}'.format(','.join(str(cpu) for cpu in cpus), cmd),
+                                shell=True, env=slot_env(cpus, gpu))
+
+    attempts = {}
+    running  = {}  # slot -> (name, cmd, process)
+    failed   = []
+    while queue or running:
+        for slot in range(num_slots):
+            if slot not in running and queue:
+                name, cmd = queue.pop(0)
+                attempts[name] = attempts.get(name, 0) + 1
+                running[slot]  = (name, cmd, launch(slot, name, cmd, attempts[name]))
+        time.sleep(poll_secs)
+        for slot, (name, cmd, process) in list(running.items()):
+            ret = process.poll()
+            if ret is None:
+                continue
+            del running[slot]
+            if ret == 0:
+                log('slot {}: job {} finished'.format(slot, name))
+                manifest.mark(name, 'done', slot=slot, attempt=attempts[name])
+            elif attempts[name] <= retries:
+                log('slot {}: job {} failed with exit code {}. Re-queued ({}/{})'
+                    .format(slot, name, ret, attempts[name], retries))
+                manifest.mark(name, 'failed', slot=slot, attempt=attempts[name], exit_code=ret)
+                queue.append((name, cmd))
+            else:
+                log('slot {}: job {} failed with exit code {}'.format(slot, name, ret))
+                manifest.mark(name, 'failed', slot=slot, attempt=attempts[name], exit_code=ret)
+                failed.append(name)
+    return failed